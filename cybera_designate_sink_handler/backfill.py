@@ -0,0 +1,346 @@
+# cybera-sink-backfill: create records for existing instances and floating
+# IPs
+
+import argparse
+import collections
+import functools
+import ipaddress
+import json
+import os
+import sys
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from designate import rpc
+from designate.objects import Record
+from keystoneauth1 import adapter
+
+from cybera_designate_sink_handler import clients
+from cybera_designate_sink_handler import executor
+from cybera_designate_sink_handler import hostnames
+from cybera_designate_sink_handler import record_index
+from cybera_designate_sink_handler import reconcile
+from cybera_designate_sink_handler.neutronfloatinghandler import \
+    NeutronFloatingHandler
+from cybera_designate_sink_handler.v6handler import NovaFixedV6Handler
+
+LOG = logging.getLogger(__name__)
+
+# A recordset to create or extend
+Write = collections.namedtuple('Write', ['zone_id', 'name', 'type',
+                                         'records'])
+
+
+class Checkpoint(object):
+    """Progress through each phase, saved after every page.
+
+    ``marker`` is the id of the last instance or floating IP whose
+    records were written. Without a path nothing is saved.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.state = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def marker(self, phase):
+        return self.state.get(phase, {}).get('marker')
+
+    def done(self, phase):
+        return self.state.get(phase, {}).get('done', False)
+
+    def save(self, phase, marker, done=False):
+        self.state[phase] = {'marker': marker, 'done': done}
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.path)
+
+
+class Backfiller(object):
+    """Writes the records the handlers would have written for resources
+    that existed before they ran.
+
+    The zones each resource already has managed records in are indexed
+    first. Nova and Neutron are then streamed a page at a time. Hostnames
+    and reverse pointers for the page are worked out together, and
+    reverse zones come from the handler's zone index. Only recordsets
+    missing from a zone are written. Each page's writes are sorted by
+    zone and applied with the runner's concurrency, at most ``max_rate``
+    per second.
+    """
+
+    def __init__(self, reconciler, runner, checkpoint, dry_run=False,
+                 max_rate=0, out=sys.stdout):
+        self.reconciler = reconciler
+        self.runner = runner
+        self.checkpoint = checkpoint
+        self.dry_run = dry_run
+        self.max_rate = max_rate
+        self.out = out
+        self.counts = collections.Counter()
+        self._started = None
+
+    @property
+    def page_size(self):
+        return self.reconciler.page_size
+
+    def existing(self, handler):
+        """Map resource ids to the zones they have managed records in."""
+        zones = collections.defaultdict(set)
+        for record in record_index.managed_records(
+                handler.central_api, self.reconciler.context,
+                handler.get_plugin_name(), self.page_size):
+            zones[record['managed_resource_id']].add(record['zone_id'])
+        LOG.info('%s manages records for %d resources',
+                 handler.get_plugin_name(), len(zones))
+        return zones
+
+    @staticmethod
+    def _record(handler, resource_id, data, extra=None):
+        values = {
+            'data': data,
+            'managed': True,
+            'managed_plugin_name': handler.get_plugin_name(),
+            'managed_plugin_type': handler.get_plugin_type(),
+            'managed_resource_type': 'instance',
+            'managed_resource_id': resource_id,
+        }
+        if extra is not None:
+            values['managed_extra'] = extra
+        return Record(**values)
+
+    def _throttle(self):
+        if not self.max_rate:
+            return
+        if self._started is None:
+            self._started = time.monotonic()
+        ahead = self.counts['written'] / float(self.max_rate) - \
+            (time.monotonic() - self._started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def _write(self, handler, write):
+        try:
+            handler._create_or_update_recordset(
+                self.reconciler.context, write.records, zone_id=write.zone_id,
+                name=write.name, type=write.type)
+            return True
+        except Exception as e:
+            LOG.warning("Couldn't write {0} {1}: {2}".format(
+                write.type, write.name, e))
+            return False
+
+    def apply(self, handler, writes):
+        """Write a page's recordsets, grouped by zone."""
+        writes = sorted(writes, key=lambda w: (w.zone_id, w.name))
+        for write in writes:
+            self.counts[write.type] += 1
+            if self.dry_run:
+                self.out.write('would write %s %s in %s\n' % (
+                    write.type, write.name, write.zone_id))
+        if self.dry_run:
+            return
+
+        workers = max(1, self.runner.max_workers)
+        for batch in reconcile.chunks(writes, workers):
+            self._throttle()
+            results = self.runner.run([
+                ('%s %s' % (write.type, write.name),
+                 functools.partial(self._write, handler, write))
+                for write in batch])
+            self.counts['written'] += len(batch)
+            self.counts['errors'] += results.count(False)
+
+    def v6_writes(self, handler, page, zone, reverse_zone_id, existing):
+        writes = []
+        for server, instance_name, addresses in page:
+            v6_addresses = [address['addr'] for address in addresses
+                            if address['version'] == 6 and
+                            handler.managed.fixed_ip(
+                                {'address': address['addr'],
+                                 'label': address['label']})]
+            if not v6_addresses:
+                continue
+
+            zones = existing.get(server.id, ())
+            hostname = '%s.%s' % (hostnames.ec2id_from_name(instance_name),
+                                  zone['name'])
+            if zone['id'] not in zones:
+                writes.append(Write(zone['id'], hostname, 'AAAA', [
+                    self._record(handler, server.id, address)
+                    for address in v6_addresses]))
+            if reverse_zone_id not in zones:
+                pointers = [ipaddress.ip_address(address).reverse_pointer
+                            for address in v6_addresses]
+                writes.extend(
+                    Write(reverse_zone_id, pointer + '.', 'PTR',
+                          [self._record(handler, server.id, hostname)])
+                    for pointer in pointers)
+        return writes
+
+    def backfill_v6(self):
+        handler = self.reconciler.v6_handler
+        conf = cfg.CONF[reconcile.V6_GROUP]
+        zone = handler.zone_cache.get_zone(conf.zone_id)
+        reverse_zone_id = handler.zone_cache.get_zone(
+            conf.reverse_zone_id)['id']
+        existing = self.existing(handler)
+
+        marker = self.checkpoint.marker('v6')
+        for page in reconcile.chunks(self.reconciler.instances(marker),
+                                     self.page_size):
+            self.apply(handler, self.v6_writes(handler, page, zone,
+                                               reverse_zone_id, existing))
+            marker = page[-1][0].id
+            if not self.dry_run:
+                self.checkpoint.save('v6', marker)
+        if not self.dry_run:
+            self.checkpoint.save('v6', marker, done=True)
+
+    def floating_writes(self, handler, page, zone, owner_tenant_id,
+                        existing):
+        associated = []
+        for floatingip in page:
+            if not floatingip['fixed_ip_address'] or \
+                    not handler.managed.floating_ip(floatingip):
+                continue
+            instance_id = self.reconciler.instance_by_ip.get(
+                (floatingip['fixed_ip_address'], floatingip['tenant_id']))
+            if instance_id is not None:
+                associated.append((floatingip, instance_id))
+
+        pointers = [ipaddress.ip_address(
+            floatingip['floating_ip_address']).reverse_pointer + '.'
+            for floatingip, _ in associated]
+
+        writes = []
+        for (floatingip, instance_id), pointer in zip(associated, pointers):
+            zones = existing.get(floatingip['id'], ())
+            hostname = '%s.%s' % (self.reconciler.ec2ids[instance_id],
+                                  zone['name'])
+            extra = 'instance:%s' % instance_id
+            if zone['id'] not in zones:
+                writes.append(Write(zone['id'], hostname, 'A', [
+                    self._record(handler, floatingip['id'],
+                                 floatingip['floating_ip_address'], extra)]))
+
+            reverse_id, pointer = handler.zone_cache.find_reverse_zone(
+                pointer, owner_tenant_id)
+            if reverse_id is None:
+                self.counts['no reverse zone'] += 1
+            elif reverse_id not in zones:
+                writes.append(Write(reverse_id, pointer, 'PTR', [
+                    self._record(handler, floatingip['id'], hostname,
+                                 extra)]))
+        return writes
+
+    def backfill_floating(self):
+        handler = self.reconciler.floating_handler
+        conf = cfg.CONF[reconcile.FLOATING_GROUP]
+        zone = handler.zone_cache.get_zone(conf.zone_id)
+        existing = self.existing(handler)
+        network = adapter.Adapter(self.reconciler.manager.session,
+                                  service_type='network')
+
+        marker = self.checkpoint.marker('floating')
+        for page in reconcile.chunks(
+                reconcile.floating_ips(network, self.page_size, marker),
+                self.page_size):
+            self.apply(handler, self.floating_writes(
+                handler, page, zone, conf.zone_owner_tenant_id, existing))
+            marker = page[-1]['id']
+            if not self.dry_run:
+                self.checkpoint.save('floating', marker)
+        if not self.dry_run:
+            self.checkpoint.save('floating', marker, done=True)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Create the records the sink handlers would have '
+                    'written for existing instances and floating IPs.')
+    parser.add_argument('--config-file', action='append',
+                        help='Designate configuration with the handler '
+                             'sections. May be given more than once')
+    parser.add_argument('--handler', choices=['v6', 'floating', 'both'],
+                        default='both')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only print the recordsets that would be '
+                             'written')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Recordsets written at once')
+    parser.add_argument('--max-rate', type=float, default=0,
+                        help='Most recordsets written per second, to leave '
+                             'room for live events. 0 for no limit')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='Items requested per page from each service')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='Save progress here and resume from it')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.register_options(cfg.CONF)
+    cfg.CONF(args=[], project='designate',
+             default_config_files=args.config_file)
+    logging.setup(cfg.CONF, 'cybera-sink-backfill')
+
+    for group in (reconcile.V6_GROUP, reconcile.FLOATING_GROUP):
+        # Rebuilding the record index here would only repeat the sink's
+        # own rebuild
+        cfg.CONF.set_override('record_index_rebuild', False, group=group)
+        # Writes made here are not events the sink applied, and mustn't
+        # end up in its dedup store
+        cfg.CONF.set_override('dedup_window', 0, group=group)
+
+    rpc.init(cfg.CONF)
+    v6_handler = NovaFixedV6Handler()
+    floating_handler = NeutronFloatingHandler()
+    manager = clients.get_client_manager(reconcile.V6_GROUP)
+
+    reconciler = reconcile.Reconciler(v6_handler, floating_handler, manager,
+                                      page_size=args.page_size,
+                                      netbox=False)
+    checkpoint = Checkpoint(args.checkpoint)
+    backfiller = Backfiller(reconciler,
+                            executor.OperationRunner(args.workers),
+                            checkpoint, dry_run=args.dry_run,
+                            max_rate=args.max_rate)
+    start = time.monotonic()
+
+    v6 = args.handler in ('v6', 'both') and not checkpoint.done('v6')
+    floating = args.handler in ('floating', 'both') and \
+        not checkpoint.done('floating')
+    # Floating IPs are matched against every instance, which the v6
+    # phase only sees when it starts from the beginning
+    all_instances = v6 and checkpoint.marker('v6') is None
+
+    if v6:
+        backfiller.backfill_v6()
+    if floating:
+        if not all_instances:
+            collections.deque(reconciler.instances(), maxlen=0)
+        backfiller.backfill_floating()
+
+    counts = backfiller.counts
+    elapsed = time.monotonic() - start
+    sys.stdout.write('%s %d AAAA, %d A and %d PTR recordsets in %.1fs '
+                     '(%.1f/s), %d without a reverse zone, %d failed\n' % (
+                         'Found' if args.dry_run else 'Wrote',
+                         counts['AAAA'], counts['A'], counts['PTR'],
+                         elapsed, counts['written'] / elapsed
+                         if elapsed else 0.0,
+                         counts['no reverse zone'], counts['errors']))
+    return 1 if counts['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
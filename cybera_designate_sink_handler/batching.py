@@ -0,0 +1,117 @@
+# Batched notification processing
+
+import atexit
+import collections
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+batching_opts = [
+    cfg.BoolOpt('batching', default=False,
+                help='Buffer notifications briefly and coalesce events for '
+                     'the same resource before processing them'),
+    cfg.FloatOpt('batch-max-latency', default=0.5,
+                 help='Maximum seconds an event is buffered before its '
+                      'batch is processed, plus the time taken by a batch '
+                      'that is still being applied'),
+    cfg.IntOpt('batch-max-size', default=100,
+               help='Number of buffered resources that triggers an '
+                    'immediate flush'),
+]
+
+
+class EventBatcher(object):
+    """Buffers notifications and applies only the latest per resource.
+
+    ``resource_key(event_type, payload)`` names the resource an event is
+    about. A later event for the same resource replaces the earlier one,
+    so an update followed by a delete is applied as just the delete.
+    Events without a key are never coalesced.
+
+    A batch is applied by ``apply(context, event_type, payload)`` once it
+    holds ``max_size`` resources or its first event has waited
+    ``max_latency`` seconds. Batches are applied one at a time, so while
+    one is being applied the next keeps buffering and coalescing, and an
+    event can wait ``max_latency`` plus the time left on the batch in
+    progress. With several dispatch workers ``apply`` only queues the
+    event, so that extra wait is short.
+    """
+
+    def __init__(self, apply, resource_key, max_latency=0.5, max_size=100):
+        self._apply = apply
+        self._resource_key = resource_key
+        self.max_latency = max_latency
+        self.max_size = max_size
+        self.coalesced = 0
+
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._first_at = None
+        self._thread = None
+        self._apply_lock = threading.Lock()
+
+    def submit(self, context, event_type, payload):
+        key = self._resource_key(event_type, payload)
+        if key is None:
+            key = object()
+
+        with self._cond:
+            if key in self._pending:
+                LOG.debug('Coalescing %s for %s into earlier event',
+                          event_type, key)
+                del self._pending[key]
+                self.coalesced += 1
+            self._pending[key] = (context, event_type, payload)
+            if self._first_at is None:
+                self._first_at = time.monotonic()
+
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='event-batcher')
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.flush)
+            self._cond.notify()
+
+    def _take(self):
+        batch = list(self._pending.values())
+        self._pending = collections.OrderedDict()
+        self._first_at = None
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                while len(self._pending) < self.max_size:
+                    remaining = self._first_at + self.max_latency - \
+                        time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take()
+
+            self._apply_batch(batch)
+
+    def _apply_batch(self, batch):
+        LOG.debug('Applying batch of %d events (%d coalesced so far)',
+                  len(batch), self.coalesced)
+        with self._apply_lock:
+            for context, event_type, payload in batch:
+                try:
+                    self._apply(context, event_type, payload)
+                except Exception:
+                    LOG.exception('Failed to process batched %s event',
+                                  event_type)
+
+    def flush(self):
+        """Apply everything buffered in the calling thread."""
+        with self._cond:
+            batch = self._take()
+        if batch:
+            self._apply_batch(batch)
@@ -0,0 +1,6 @@
+"""Offline benchmark for the sink handlers.
+
+Runs the handlers against in-process stand-ins for Designate central,
+Keystone and Nova and a local HTTP stand-in for NetBox, so it needs no
+network access. See ``cybera-sink-bench --help``.
+"""
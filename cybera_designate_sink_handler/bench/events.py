@@ -0,0 +1,68 @@
+# Synthetic notification streams
+
+import ipaddress
+import uuid
+
+from cybera_designate_sink_handler.bench import fakes
+
+TENANT_ID = 'b3f1c2d4e5f64718293a4b5c6d7e8f90'
+CONTEXT = {'project_name': 'bench', 'project_id': TENANT_ID}
+
+FIXED_V4 = ipaddress.ip_network('10.0.0.0/16')
+FIXED_V6 = ipaddress.ip_network('2001:db8:10::/64')
+FLOATING_V4 = ipaddress.ip_network('198.51.100.0/22')
+
+
+def add_instances(nova, count):
+    """Create ``count`` instances in the fake Nova and return them."""
+    servers = []
+    for i in range(1, count + 1):
+        server = fakes.FakeServer(
+            str(uuid.uuid4()), 'instance-%08x' % i, TENANT_ID,
+            [{'addr': str(FIXED_V4[i]), 'version': 4},
+             {'addr': str(FIXED_V6[i]), 'version': 6}])
+        nova.servers.servers[server.id] = server
+        servers.append(server)
+    return servers
+
+
+def v6_events(servers):
+    """Create then delete every instance."""
+    for server in servers:
+        yield 'compute.instance.create.end', {
+            'instance_id': server.id,
+            'tenant_id': server.tenant_id,
+            'fixed_ips': [{'address': address['addr'],
+                           'version': address['version']}
+                          for address in server.addresses['default']],
+        }
+    for server in servers:
+        yield 'compute.instance.delete.start', {
+            'instance_id': server.id,
+            'tenant_id': server.tenant_id,
+        }
+
+
+def floating_addresses(count):
+    return [FLOATING_V4[i] for i in range(1, count + 1)]
+
+
+def floating_events(servers):
+    """Associate, disassociate and delete a floating IP per instance."""
+    floating = []
+    for server, address in zip(servers, floating_addresses(len(servers))):
+        floating.append({
+            'id': str(uuid.uuid4()),
+            'floating_ip_address': str(address),
+            'fixed_ip_address': server.addresses['default'][0]['addr'],
+            'tenant_id': server.tenant_id,
+        })
+
+    for fip in floating:
+        yield 'floatingip.update.end', {'floatingip': dict(fip)}
+    for fip in floating:
+        yield 'floatingip.update.end', {
+            'floatingip': dict(fip, fixed_ip_address=None)}
+    for fip in floating:
+        # Neutron only sends the id when a floating IP is being deleted
+        yield 'floatingip.delete.start', {'floatingip_id': fip['id']}
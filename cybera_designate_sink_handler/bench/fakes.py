@@ -0,0 +1,260 @@
+# In-process stand-ins for Designate central, Keystone and Nova
+
+import collections
+import threading
+import time
+import uuid
+
+from designate import exceptions
+from novaclient import exceptions as nova_exceptions
+
+RECORD_FIELDS = (
+    'data',
+    'managed',
+    'managed_plugin_name',
+    'managed_plugin_type',
+    'managed_resource_type',
+    'managed_resource_id',
+    'managed_extra',
+)
+
+
+class Stats(object):
+    """Thread safe counter of remote calls, keyed by ``dependency.call``."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = collections.Counter()
+
+    def count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return collections.Counter(self._counts)
+
+
+class Obj(dict):
+    """A dict that also allows attribute access, like designate objects."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+def _field(obj, name):
+    if isinstance(obj, dict):
+        return obj.get(name)
+    if hasattr(obj, 'obj_attr_is_set') and not obj.obj_attr_is_set(name):
+        return None
+    return getattr(obj, name, None)
+
+
+class FakeCentralAPI(object):
+    """Enough of designate's central RPC API for the handlers.
+
+    Zones, recordsets and records are kept in memory. Every call is
+    counted in ``stats`` and delayed by ``latency`` seconds.
+    """
+
+    def __init__(self, stats, latency=0.0):
+        self.stats = stats
+        self.latency = latency
+        self._lock = threading.RLock()
+        self.zones = {}
+        self.recordsets = {}
+
+    def _call(self, name):
+        self.stats.count('central.%s' % name)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add_zone(self, name, tenant_id):
+        zone = Obj(id=str(uuid.uuid4()), name=name, tenant_id=tenant_id)
+        self.zones[zone.id] = zone
+        return zone
+
+    def _record(self, record, recordset):
+        values = Obj((name, _field(record, name)) for name in RECORD_FIELDS)
+        values.id = _field(record, 'id') or str(uuid.uuid4())
+        values.zone_id = recordset.zone_id
+        values.recordset_id = recordset.id
+        return values
+
+    def _store(self, zone_id, recordset, recordset_id=None):
+        stored = Obj(id=recordset_id or str(uuid.uuid4()), zone_id=zone_id,
+                     name=_field(recordset, 'name'),
+                     type=_field(recordset, 'type'), records=[])
+        stored.records = [self._record(record, stored)
+                          for record in (_field(recordset, 'records') or [])]
+        self.recordsets[stored.id] = stored
+        return stored
+
+    @staticmethod
+    def _matches(obj, criterion):
+        return all(obj.get(key) == value
+                   for key, value in criterion.items())
+
+    def get_zone(self, context, zone_id):
+        self._call('get_zone')
+        try:
+            return self.zones[zone_id]
+        except KeyError:
+            raise exceptions.ZoneNotFound()
+
+    def find_zones(self, context, criterion=None, *args, **kwargs):
+        self._call('find_zones')
+        return [zone for zone in self.zones.values()
+                if self._matches(zone, criterion or {})]
+
+    def create_recordset(self, context, zone_id, recordset, *args, **kwargs):
+        self._call('create_recordset')
+        with self._lock:
+            for existing in self.recordsets.values():
+                if existing.zone_id == zone_id and \
+                        existing.name == recordset.name and \
+                        existing.type == recordset.type:
+                    raise exceptions.DuplicateRecordSet()
+            return self._store(zone_id, recordset)
+
+    def _find_recordsets(self, criterion):
+        return [recordset for recordset in self.recordsets.values()
+                if self._matches(recordset, criterion)]
+
+    def find_recordsets(self, context, criterion=None, *args, **kwargs):
+        self._call('find_recordsets')
+        with self._lock:
+            return self._find_recordsets(criterion or {})
+
+    def find_recordset(self, context, criterion=None, *args, **kwargs):
+        self._call('find_recordset')
+        with self._lock:
+            found = self._find_recordsets(criterion or {})
+        if len(found) != 1:
+            raise exceptions.RecordSetNotFound()
+        return found[0]
+
+    def get_recordset(self, context, zone_id, recordset_id, *args, **kwargs):
+        self._call('get_recordset')
+        try:
+            return self.recordsets[recordset_id]
+        except KeyError:
+            raise exceptions.RecordSetNotFound()
+
+    def update_recordset(self, context, recordset, *args, **kwargs):
+        self._call('update_recordset')
+        with self._lock:
+            if recordset.id not in self.recordsets:
+                raise exceptions.RecordSetNotFound()
+            return self._store(recordset.zone_id, recordset, recordset.id)
+
+    def delete_recordset(self, context, zone_id, recordset_id, *args,
+                         **kwargs):
+        self._call('delete_recordset')
+        with self._lock:
+            if self.recordsets.pop(recordset_id, None) is None:
+                raise exceptions.RecordSetNotFound()
+
+    def find_records(self, context, criterion=None, *args, **kwargs):
+        self._call('find_records')
+        with self._lock:
+            return [record for recordset in self.recordsets.values()
+                    for record in recordset.records
+                    if self._matches(record, criterion or {})]
+
+    def delete_managed_records(self, context, zone_id=None, criterion=None,
+                               *args, **kwargs):
+        self._call('delete_managed_records')
+        criterion = dict(criterion or {})
+        if zone_id is not None:
+            criterion['zone_id'] = zone_id
+        with self._lock:
+            for recordset_id, recordset in list(self.recordsets.items()):
+                recordset.records = [
+                    record for record in recordset.records
+                    if not self._matches(record, criterion)]
+                if not recordset.records:
+                    del self.recordsets[recordset_id]
+
+
+class FakeServer(object):
+    def __init__(self, instance_id, instance_name, tenant_id, addresses):
+        self.id = instance_id
+        setattr(self, 'OS-EXT-SRV-ATTR:instance_name', instance_name)
+        self.tenant_id = tenant_id
+        self.status = 'ACTIVE'
+        self.addresses = {'default': addresses}
+        self.metadata = {}
+
+
+class FakeServers(object):
+    def __init__(self, stats, latency):
+        self.stats = stats
+        self.latency = latency
+        self.servers = {}
+
+    def _call(self, name):
+        self.stats.count('nova.%s' % name)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get(self, server):
+        self._call('servers.get')
+        try:
+            return self.servers[getattr(server, 'id', server)]
+        except KeyError:
+            raise nova_exceptions.NotFound(404)
+
+    def list(self, detailed=True, search_opts=None):
+        self._call('servers.list')
+        search_opts = search_opts or {}
+        found = []
+        for server in self.servers.values():
+            addresses = [address['addr']
+                         for address in server.addresses['default']]
+            if 'ip' in search_opts and search_opts['ip'] not in addresses:
+                continue
+            if search_opts.get('tenant_id') not in (None, server.tenant_id):
+                continue
+            if search_opts.get('status') not in (None, server.status):
+                continue
+            found.append(server)
+        return found
+
+    def set_meta_item(self, server, key, value):
+        self._call('servers.set_meta_item')
+        self.servers[getattr(server, 'id', server)].metadata[key] = value
+
+
+class FakeNova(object):
+    def __init__(self, stats, latency=0.0):
+        self.servers = FakeServers(stats, latency)
+
+
+class FakeClientManager(object):
+    """Stands in for clients.ClientManager.
+
+    The first use of ``nova`` costs one Keystone token request, as a
+    fresh session would.
+    """
+
+    def __init__(self, nova, stats, keystone_latency=0.0):
+        self._nova = nova
+        self.stats = stats
+        self.keystone_latency = keystone_latency
+        self._authenticated = False
+
+    @property
+    def nova(self):
+        if not self._authenticated:
+            self.stats.count('keystone.token')
+            if self.keystone_latency:
+                time.sleep(self.keystone_latency)
+            self._authenticated = True
+        return self._nova
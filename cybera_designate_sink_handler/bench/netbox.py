@@ -0,0 +1,178 @@
+# Local HTTP stand-in for the parts of the NetBox API that IPHandler uses
+
+from http import server
+import ipaddress
+import itertools
+import json
+import threading
+import time
+from urllib import parse
+
+IP_ADDRESSES = '/api/ipam/ip-addresses/'
+PREFIXES = '/api/ipam/prefixes/'
+
+
+class NetBoxState(object):
+    def __init__(self, stats, latency, prefixes):
+        self.stats = stats
+        self.latency = latency
+        self.prefixes = set(prefixes)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.addresses = {}
+        self.base_url = None
+
+    def add(self, address, description=''):
+        ip = ipaddress.ip_interface(str(address))
+        if '/' not in str(address):
+            ip = ipaddress.ip_interface(
+                '%s/%d' % (address, 32 if ip.version == 4 else 64))
+        ip_id = next(self.ids)
+        obj = {
+            'id': ip_id,
+            'url': '%s%s%d/' % (self.base_url, IP_ADDRESSES, ip_id),
+            'display': str(ip),
+            'family': {'value': ip.version, 'label': 'IPv%d' % ip.version},
+            'address': str(ip),
+            'description': description,
+        }
+        self.addresses[ip_id] = obj
+        return obj
+
+
+class _Handler(server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _begin(self):
+        self.state.stats.count('netbox.%s' % self.command)
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        url = parse.urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        return url.path, parse.parse_qs(url.query), body
+
+    def _reply(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('API-Version', '3.2')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _object_id(self, path, base):
+        rest = path[len(base):].strip('/')
+        return int(rest) if rest else None
+
+    def do_GET(self):
+        path, query, _ = self._begin()
+        state = self.state
+
+        if path.startswith(PREFIXES):
+            prefix_id = self._object_id(path, PREFIXES)
+            if prefix_id in state.prefixes:
+                return self._reply(200, {'id': prefix_id})
+            return self._reply(404, {'detail': 'Not found.'})
+
+        if path.startswith(IP_ADDRESSES):
+            ip_id = self._object_id(path, IP_ADDRESSES)
+            with state.lock:
+                if ip_id is not None:
+                    if ip_id not in state.addresses:
+                        return self._reply(404, {'detail': 'Not found.'})
+                    return self._reply(200, state.addresses[ip_id])
+
+                wanted = set(str(ipaddress.ip_address(address))
+                             for address in query.get('address', []))
+                results = [
+                    obj for obj in state.addresses.values()
+                    if not wanted or
+                    str(ipaddress.ip_interface(obj['address']).ip) in wanted]
+            return self._reply(200, {'count': len(results), 'next': None,
+                                     'previous': None, 'results': results})
+
+        return self._reply(200, {})
+
+    def do_POST(self):
+        path, _, body = self._begin()
+        if not path.startswith(IP_ADDRESSES):
+            return self._reply(404, {'detail': 'Not found.'})
+
+        with self.state.lock:
+            if isinstance(body, list):
+                created = [self.state.add(item['address'],
+                                          item.get('description', ''))
+                           for item in body]
+            else:
+                created = self.state.add(body['address'],
+                                         body.get('description', ''))
+        return self._reply(201, created)
+
+    def do_PATCH(self):
+        path, _, body = self._begin()
+        if not path.startswith(IP_ADDRESSES):
+            return self._reply(404, {'detail': 'Not found.'})
+
+        ip_id = self._object_id(path, IP_ADDRESSES)
+        items = body if ip_id is None else [dict(body, id=ip_id)]
+        updated = []
+        with self.state.lock:
+            for item in items:
+                obj = self.state.addresses.get(item['id'])
+                if obj is None:
+                    return self._reply(404, {'detail': 'Not found.'})
+                obj.update((key, value) for key, value in item.items()
+                           if key in ('description',))
+                updated.append(obj)
+        return self._reply(200, updated if ip_id is None else updated[0])
+
+    def do_DELETE(self):
+        path, _, body = self._begin()
+        if not path.startswith(IP_ADDRESSES):
+            return self._reply(404, {'detail': 'Not found.'})
+
+        ip_id = self._object_id(path, IP_ADDRESSES)
+        ids = [item['id'] for item in body] if ip_id is None else [ip_id]
+        with self.state.lock:
+            for item_id in ids:
+                self.state.addresses.pop(item_id, None)
+        return self._reply(204)
+
+
+class FakeNetBox(object):
+    """Serves a small in-memory NetBox on a local port.
+
+    ``start`` returns the base URL to give IPHandler. Each request is
+    counted in ``stats`` as ``netbox.<METHOD>`` and delayed by
+    ``latency`` seconds.
+    """
+
+    def __init__(self, stats, latency=0.0, prefixes=(71,)):
+        self.state = NetBoxState(stats, latency, prefixes)
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        self._server = server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.state = self.state
+        self.state.base_url = 'http://127.0.0.1:%d' % \
+            self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='fake-netbox')
+        self._thread.daemon = True
+        self._thread.start()
+        return self.state.base_url + '/'
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
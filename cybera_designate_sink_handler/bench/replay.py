@@ -0,0 +1,216 @@
+# cybera-sink-replay: replay captured notifications against the handlers
+
+import argparse
+import collections
+import ipaddress
+import sys
+import time
+from unittest import mock
+
+from oslo_config import cfg
+
+from cybera_designate_sink_handler import capture
+from cybera_designate_sink_handler import clients
+from cybera_designate_sink_handler.bench import fakes
+from cybera_designate_sink_handler.bench import run
+from cybera_designate_sink_handler.neutronfloatinghandler import \
+    NeutronFloatingHandler
+from cybera_designate_sink_handler.v6handler import NovaFixedV6Handler
+
+HANDLERS = {
+    'handler:nova_fixed_v6': NovaFixedV6Handler,
+    'handler:neutron_floating': NeutronFloatingHandler,
+}
+
+
+def load(paths):
+    """Read capture files into one list of records sorted by time."""
+    records = []
+    for path in paths:
+        records.extend(record for record in capture.read(path)
+                       if record.get('handler') in HANDLERS)
+    records.sort(key=lambda record: record['time'])
+    return records
+
+
+def seed(env, records):
+    """Give the stand-ins the instances, reverse zones and floating IPs
+    the captured events refer to.
+    """
+    servers = {}
+    fixed_ips = {}
+    for record in records:
+        payload = record['payload']
+        if record['event_type'] == 'compute.instance.create.end':
+            addresses = [{'addr': ip['address'], 'version': ip['version']}
+                         for ip in payload.get('fixed_ips', [])]
+            server = fakes.FakeServer(
+                payload['instance_id'],
+                payload.get('instance_name') or
+                'instance-%08x' % (len(servers) + 1),
+                payload.get('tenant_id'), addresses)
+            servers[server.id] = server
+            for address in addresses:
+                fixed_ips[address['addr']] = server
+
+    reverse_v4 = set()
+    floating = set()
+    for record in records:
+        floatingip = record['payload'].get('floatingip')
+        if not isinstance(floatingip, dict):
+            continue
+        address = floatingip.get('floating_ip_address')
+        if address:
+            floating.add(address)
+            labels = ipaddress.ip_address(address).reverse_pointer.split('.')
+            reverse_v4.add('.'.join(labels[1:]) + '.')
+
+        # Floating IPs of instances created before the capture started
+        fixed = floatingip.get('fixed_ip_address')
+        if fixed and fixed not in fixed_ips:
+            server = fakes.FakeServer(
+                'replay-%d' % (len(servers) + 1),
+                'instance-%08x' % (len(servers) + 1),
+                floatingip.get('tenant_id'),
+                [{'addr': fixed, 'version': 4}])
+            servers[server.id] = server
+            fixed_ips[fixed] = server
+
+    env.nova.servers.servers.update(servers)
+    existing = set(zone.name for zone in env.central.zones.values())
+    for name in reverse_v4 - existing:
+        env.central.add_zone(name, run.OWNER_TENANT_ID)
+    with env.netbox.state.lock:
+        for address in floating:
+            env.netbox.state.add(address, 'Floating IP')
+
+
+def replay(env, handlers, records, speed=1.0):
+    """Send records to their handlers, serially, keeping the captured gaps
+    between them divided by ``speed``. A speed of 0 sends them as fast as
+    possible.
+
+    Returns per handler results like run.run_stream, the scheduling lag of
+    each event and the elapsed time.
+    """
+    results = dict((name, collections.defaultdict(lambda: {
+        'latencies': [], 'errors': 0, 'calls': collections.Counter()}))
+        for name in handlers)
+    lags = []
+
+    start = time.monotonic()
+    first = records[0]['time'] if records else 0
+    for record in records:
+        due = start
+        if speed:
+            due += (record['time'] - first) / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        lags.append(max(0.0, time.monotonic() - due))
+
+        result = results[record['handler']][record['event_type']]
+        before = env.stats.snapshot()
+        began = time.monotonic()
+        try:
+            handlers[record['handler']].process_notification(
+                record['context'], record['event_type'], record['payload'])
+        except Exception:
+            result['errors'] += 1
+        result['latencies'].append(time.monotonic() - began)
+        after = env.stats.snapshot()
+        after.subtract(before)
+        result['calls'].update(+after)
+
+    return results, lags, time.monotonic() - start
+
+
+def report(records, results, lags, elapsed, speed, out):
+    captured = records[-1]['time'] - records[0]['time'] if records else 0
+    out.write('Replayed %d events captured over %.1fs in %.2fs '
+              '(%.1f events/s)\n' % (
+                  len(records), captured, elapsed,
+                  len(records) / elapsed if elapsed else 0.0))
+    if speed and captured:
+        out.write('Offered rate %.1f events/s, scheduling lag p50 %.2f ms '
+                  'p95 %.2f ms p99 %.2f ms\n' % (
+                      len(records) * speed / captured,
+                      run.percentile(lags, 50) * 1000,
+                      run.percentile(lags, 95) * 1000,
+                      run.percentile(lags, 99) * 1000))
+    for name, handler_results in sorted(results.items()):
+        handled = sum(len(r['latencies']) for r in handler_results.values())
+        if handled:
+            run.report(name.split(':', 1)[-1], handler_results, elapsed, out)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Replay notifications captured with capture_file '
+                    'against the sink handlers, using local stand-ins for '
+                    'Designate, Keystone, Nova and NetBox.')
+    parser.add_argument('files', nargs='+', metavar='FILE',
+                        help='Capture files, including rotated and gzip '
+                             'compressed ones')
+    timing = parser.add_mutually_exclusive_group()
+    timing.add_argument('--speed', type=float, default=1.0,
+                        help='Replay this many times faster than captured '
+                             '(default: original timing)')
+    timing.add_argument('--fast', action='store_const', const=0.0,
+                        dest='speed',
+                        help='Replay as fast as the handlers allow')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='event_workers setting for the handlers')
+    parser.add_argument('--netbox-async', action='store_true',
+                        help='Use the background NetBox queue')
+    for dependency in ('central', 'nova', 'keystone', 'netbox'):
+        parser.add_argument('--%s-latency' % dependency, type=float,
+                            default=0.0, metavar='SECONDS',
+                            help='Delay added to each %s call' % dependency)
+    parser.set_defaults(instances=0)
+    args = parser.parse_args(argv)
+    if args.speed < 0:
+        parser.error('--speed must not be negative')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    cfg.CONF(args=[], project='cybera-sink-replay', default_config_files=[])
+
+    records = load(args.files)
+    if not records:
+        sys.stderr.write('No notifications to replay\n')
+        return 1
+
+    env = run.Environment(args)
+    try:
+        seed(env, records)
+        with mock.patch.object(clients, 'get_client_manager',
+                               lambda group: env.manager):
+            overrides = {
+                'handler:nova_fixed_v6': {
+                    'reverse_zone_id': env.reverse_v6_zone.id},
+                'handler:neutron_floating': {
+                    'zone_owner_tenant_id': run.OWNER_TENANT_ID},
+            }
+            handlers = {}
+            for name in sorted(set(record['handler'] for record in records)):
+                # Don't capture the replay itself
+                env.configure(name, args, capture_file=None,
+                              **overrides[name])
+                handlers[name] = env.build(HANDLERS[name])
+
+            results, lags, elapsed = replay(env, handlers, records,
+                                            args.speed)
+            report(records, results, lags, elapsed, args.speed, sys.stdout)
+
+        run.wait_for_netbox()
+    finally:
+        env.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
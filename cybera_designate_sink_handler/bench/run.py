@@ -0,0 +1,208 @@
+# cybera-sink-bench: offline throughput and latency benchmark
+
+import argparse
+import collections
+import sys
+import time
+from unittest import mock
+
+from oslo_config import cfg
+
+from designate.central import rpcapi as central_rpcapi
+from designate import policy
+
+from cybera_designate_sink_handler import clients
+from cybera_designate_sink_handler.bench import events
+from cybera_designate_sink_handler.bench import fakes
+from cybera_designate_sink_handler.bench import netbox
+from cybera_designate_sink_handler.neutronfloatinghandler import \
+    NeutronFloatingHandler
+from cybera_designate_sink_handler.v6handler import NovaFixedV6Handler
+
+OWNER_TENANT_ID = '0f0e0d0c0b0a49988776655443322110'
+PREFIX_ID = 71
+
+
+class _CentralFactory(object):
+    """Replaces CentralAPI while a handler is built so no RPC transport is
+    needed.
+    """
+
+    def __init__(self, central):
+        self.central = central
+
+    def __call__(self, *args, **kwargs):
+        return self.central
+
+    def get_instance(self, *args, **kwargs):
+        return self.central
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(0, int(round(pct / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class Environment(object):
+    """The fake cloud the handlers run against."""
+
+    def __init__(self, args):
+        # Admin contexts are checked against policy, as in designate-sink
+        policy.init()
+
+        self.stats = fakes.Stats()
+        self.central = fakes.FakeCentralAPI(self.stats, args.central_latency)
+        self.nova = fakes.FakeNova(self.stats, args.nova_latency)
+        self.manager = fakes.FakeClientManager(self.nova, self.stats,
+                                               args.keystone_latency)
+        self.netbox = netbox.FakeNetBox(self.stats, args.netbox_latency,
+                                        prefixes=[PREFIX_ID])
+        self.netbox_url = self.netbox.start()
+
+        self.zone = self.central.add_zone('cloud.example.org.',
+                                          OWNER_TENANT_ID)
+        v6_labels = events.FIXED_V6.network_address.reverse_pointer.split(
+            '.')
+        self.reverse_v6_zone = self.central.add_zone(
+            '.'.join(v6_labels[32 - events.FIXED_V6.prefixlen // 4:]) + '.',
+            OWNER_TENANT_ID)
+        for subnet in events.FLOATING_V4.subnets(new_prefix=24):
+            labels = subnet.network_address.reverse_pointer.split('.')
+            self.central.add_zone('.'.join(labels[1:]) + '.',
+                                  OWNER_TENANT_ID)
+
+        self.servers = events.add_instances(self.nova, args.instances)
+        with self.netbox.state.lock:
+            for address in events.floating_addresses(args.instances):
+                self.netbox.state.add(address, 'Floating IP')
+
+    def configure(self, group, args, **overrides):
+        values = {
+            'zone_id': self.zone.id,
+            'floating_ip_prefix_id': str(PREFIX_ID),
+            'netbox_api_key': 'bench',
+            'netbox_url': self.netbox_url,
+            'netbox_async': args.netbox_async,
+            'event_workers': args.workers,
+        }
+        values.update(overrides)
+        for name, value in values.items():
+            cfg.CONF.set_override(name, value, group=group)
+
+    def build(self, handler_cls):
+        with mock.patch.object(central_rpcapi, 'CentralAPI',
+                               _CentralFactory(self.central)):
+            handler = handler_cls()
+        handler.central_api = self.central
+        return handler
+
+    def close(self):
+        self.netbox.stop()
+
+
+def run_stream(env, handler, stream):
+    """Process a stream serially, returning per event type results."""
+    results = collections.defaultdict(lambda: {
+        'latencies': [], 'errors': 0, 'calls': collections.Counter()})
+
+    start = time.monotonic()
+    for event_type, payload in stream:
+        result = results[event_type]
+        before = env.stats.snapshot()
+        began = time.monotonic()
+        try:
+            handler.process_notification(dict(events.CONTEXT), event_type,
+                                         payload)
+        except Exception:
+            result['errors'] += 1
+        result['latencies'].append(time.monotonic() - began)
+        after = env.stats.snapshot()
+        after.subtract(before)
+        result['calls'].update(+after)
+
+    return results, time.monotonic() - start
+
+
+def report(name, results, elapsed, out):
+    total = sum(len(r['latencies']) for r in results.values())
+    out.write('\n%s: %d events in %.2fs (%.1f events/s)\n' % (
+        name, total, elapsed, total / elapsed if elapsed else 0.0))
+    out.write('  %-32s %6s %6s %9s %9s %9s\n' % (
+        'event type', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for event_type, result in sorted(results.items()):
+        latencies = result['latencies']
+        out.write('  %-32s %6d %6d %9.2f %9.2f %9.2f\n' % (
+            event_type, len(latencies), result['errors'],
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 95) * 1000,
+            percentile(latencies, 99) * 1000))
+        for call, count in sorted(result['calls'].items()):
+            out.write('      %-40s %8.2f per event\n' % (
+                call, float(count) / len(latencies)))
+
+
+def wait_for_netbox(timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not any(len(queue) for queue in clients._queues.values()):
+            return
+        time.sleep(0.05)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the sink handlers against local stand-ins '
+                    'for Designate, Keystone, Nova and NetBox.')
+    parser.add_argument('--handler', choices=['v6', 'floating', 'both'],
+                        default='both')
+    parser.add_argument('--instances', type=int, default=200,
+                        help='Instances, and floating IPs, to generate '
+                             'events for')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='event_workers setting for the handlers')
+    parser.add_argument('--netbox-async', action='store_true',
+                        help='Use the background NetBox queue. Its calls '
+                             'are then not counted against events')
+    for dependency in ('central', 'nova', 'keystone', 'netbox'):
+        parser.add_argument('--%s-latency' % dependency, type=float,
+                            default=0.0, metavar='SECONDS',
+                            help='Delay added to each %s call' % dependency)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    cfg.CONF(args=[], project='cybera-sink-bench', default_config_files=[])
+
+    env = Environment(args)
+    try:
+        with mock.patch.object(clients, 'get_client_manager',
+                               lambda group: env.manager):
+            if args.handler in ('v6', 'both'):
+                env.configure('handler:nova_fixed_v6', args,
+                              reverse_zone_id=env.reverse_v6_zone.id)
+                handler = env.build(NovaFixedV6Handler)
+                results, elapsed = run_stream(
+                    env, handler, events.v6_events(env.servers))
+                report('nova_fixed_v6', results, elapsed, sys.stdout)
+
+            if args.handler in ('floating', 'both'):
+                env.configure('handler:neutron_floating', args,
+                              zone_owner_tenant_id=OWNER_TENANT_ID)
+                handler = env.build(NeutronFloatingHandler)
+                results, elapsed = run_stream(
+                    env, handler, events.floating_events(env.servers))
+                report('neutron_floating', results, elapsed, sys.stdout)
+
+        wait_for_netbox()
+    finally:
+        env.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+# Circuit breakers for Keystone, Nova and NetBox
+
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from cybera_designate_sink_handler import metrics
+
+LOG = logging.getLogger(__name__)
+
+breaker_opts = [
+    cfg.IntOpt('breaker-failure-threshold', default=5,
+               help='Consecutive failures of Keystone, Nova or NetBox after '
+                    'which calls to it fail fast'),
+    cfg.FloatOpt('breaker-reset-timeout', default=30.0,
+                 help='Seconds a tripped dependency is left alone before a '
+                      'single trial call is let through'),
+]
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a dependency that is failing."""
+
+    def __init__(self, name, retry_after):
+        super(CircuitOpen, self).__init__(
+            '%s is unavailable, retrying in %.0fs' % (name, retry_after))
+        self.name = name
+        self.retry_after = retry_after
+
+
+def _status(error):
+    """Return the HTTP status carried by a client exception, if any."""
+    for attr in ('code', 'http_status', 'status_code'):
+        status = getattr(error, attr, None)
+        if isinstance(status, int):
+            return status
+    request = getattr(error, 'req', None)
+    return getattr(request, 'status_code', None)
+
+
+def is_failure(error):
+    """Whether an error means the dependency itself is unhealthy.
+
+    Client errors such as a 404 for a deleted instance show that the
+    service is answering, so they don't count.
+    """
+    if isinstance(error, CircuitOpen):
+        return False
+    status = _status(error)
+    return status is None or status >= 500
+
+
+class CircuitBreaker(object):
+    """Fails calls to a dependency fast once it keeps failing.
+
+    Used as a context manager around each call. After
+    ``failure_threshold`` consecutive failures the breaker opens and
+    entering it raises CircuitOpen. Once ``reset_timeout`` seconds have
+    passed one trial call is let through: success closes the breaker
+    again, failure reopens it.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        metrics.breaker_state(self.name, state)
+        if state == OPEN:
+            LOG.warning('%s failed %d times in a row, failing fast for '
+                        '%.0fs', self.name, self.failures,
+                        self.reset_timeout)
+        elif state == HALF_OPEN:
+            LOG.info('Trying %s again', self.name)
+        else:
+            LOG.info('%s has recovered', self.name)
+
+    def retry_after(self):
+        """Seconds until a trial call will be allowed."""
+        with self._lock:
+            if self.state == CLOSED:
+                return 0
+            return max(0, self.opened_at + self.reset_timeout -
+                       time.monotonic())
+
+    def is_open(self):
+        with self._lock:
+            return self.state != CLOSED
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() >= \
+                    self.opened_at + self.reset_timeout:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial = False
+            self._set_state(CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def check(self):
+        """Raise CircuitOpen unless a call may be made now."""
+        if not self.allow():
+            raise CircuitOpen(self.name, self.retry_after())
+
+    def __enter__(self):
+        self.check()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None and is_failure(exc):
+            self.failure()
+        else:
+            self.success()
+        return False
+
+
+# Shared by both handlers and IPHandler, one per dependency
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get(name):
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+def configure(conf):
+    """Apply a handler group's breaker settings to every breaker."""
+    for name in ('keystone', 'nova', 'netbox'):
+        breaker = get(name)
+        breaker.failure_threshold = conf.breaker_failure_threshold
+        breaker.reset_timeout = conf.breaker_reset_timeout
@@ -0,0 +1,168 @@
+# Optional capture of received notifications for later replay
+
+import atexit
+import gzip
+import json
+import os
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+capture_opts = [
+    cfg.StrOpt('capture-file',
+               help='Append every notification the handler receives to this '
+                    'JSON lines file for cybera-sink-replay. Files ending in '
+                    '.gz are gzip compressed'),
+    cfg.IntOpt('capture-max-bytes', default=100 * 1024 * 1024,
+               help='Uncompressed size after which the capture file is '
+                    'rotated'),
+    cfg.IntOpt('capture-backups', default=5,
+               help='Number of rotated capture files to keep'),
+    cfg.ListOpt('capture-redact',
+                default=['token', 'password', 'secret', 'credential',
+                         'service_catalog'],
+                help='Context and payload keys containing any of these '
+                     'strings have their values replaced in the capture'),
+]
+
+REDACTED = '***'
+
+# Seconds between flushes of a compressed capture file
+GZIP_FLUSH_INTERVAL = 1.0
+
+
+def redact(value, patterns):
+    """Return a copy of value with the values of sensitive keys replaced."""
+    if isinstance(value, dict):
+        return dict((key, REDACTED
+                     if any(p in str(key).lower() for p in patterns)
+                     else redact(item, patterns))
+                    for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [redact(item, patterns) for item in value]
+    return value
+
+
+def read(path):
+    """Yield the records of a capture file, compressed or not."""
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    opener = gzip.open if compressed else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class Recorder(object):
+    """Appends notifications to a rotated JSON lines file.
+
+    Each line holds the receive time, handler name, event type, context
+    and payload, with values of keys matching ``redact_patterns``
+    replaced. Once ``max_bytes`` have been written the file is renamed
+    to ``<path>.1``, older files shift up and at most ``backups`` are
+    kept.
+    """
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, backups=5,
+                 redact_patterns=()):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.redact_patterns = [p.lower() for p in redact_patterns]
+        self.compressed = path.endswith('.gz')
+        self._lock = threading.Lock()
+        self._file = None
+        self._written = 0
+        self._flushed = 0
+
+    def _open(self):
+        if self.compressed:
+            self._file = gzip.open(self.path, 'at', encoding='utf-8')
+            # Sizes count uncompressed data, which a gzip file can't tell
+            self._written = 0
+        else:
+            self._file = open(self.path, 'a', encoding='utf-8', buffering=1)
+            self._written = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for i in range(self.backups - 1, 0, -1):
+            source = '%s.%d' % (self.path, i)
+            if os.path.exists(source):
+                os.replace(source, '%s.%d' % (self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+    def record(self, handler, event_type, context, payload):
+        if hasattr(context, 'to_dict'):
+            context = context.to_dict()
+        line = json.dumps({
+            'time': time.time(),
+            'handler': handler,
+            'event_type': event_type,
+            'context': redact(context, self.redact_patterns),
+            'payload': redact(payload, self.redact_patterns),
+        }, sort_keys=True, separators=(',', ':'), default=str) + '\n'
+
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._open()
+                self._file.write(line)
+                self._written += len(line)
+                if self.compressed and time.monotonic() >= \
+                        self._flushed + GZIP_FLUSH_INTERVAL:
+                    self._file.flush()
+                    self._flushed = time.monotonic()
+                if self._written >= self.max_bytes:
+                    self._rotate()
+            except Exception as e:
+                # Capturing is a diagnostic aid and must not fail events
+                LOG.warning("Couldn't capture {0}: {1}".format(
+                    event_type, e))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+
+def _close_all():
+    for recorder in list(_recorders.values()):
+        recorder.close()
+
+
+atexit.register(_close_all)
+
+
+def get_recorder(conf):
+    """Return the Recorder for a handler group, or None if capture is off.
+
+    Handlers capturing to the same file share one Recorder.
+    """
+    if not conf.capture_file:
+        return None
+    with _recorders_lock:
+        recorder = _recorders.get(conf.capture_file)
+        if recorder is None:
+            recorder = Recorder(conf.capture_file,
+                                max_bytes=conf.capture_max_bytes,
+                                backups=conf.capture_backups,
+                                redact_patterns=conf.capture_redact)
+            _recorders[conf.capture_file] = recorder
+            LOG.info('Capturing notifications to %s', conf.capture_file)
+        return recorder
@@ -0,0 +1,230 @@
+# Shared OpenStack clients
+
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from cybera_designate_sink_handler import breaker
+from cybera_designate_sink_handler.ip_handler import IPHandler
+from cybera_designate_sink_handler import metrics
+from cybera_designate_sink_handler import netbox_queue
+from cybera_designate_sink_handler import tracing
+
+import requests
+from requests import adapters
+
+LOG = logging.getLogger(__name__)
+
+# Registered into each handler's group alongside its own options.
+client_opts = [
+    cfg.IntOpt('token-refresh-margin', default=300,
+               help='Seconds before token expiry at which a new Keystone '
+                    'token is fetched'),
+    cfg.IntOpt('http-pool-size', default=10,
+               help='Number of pooled HTTP connections per host used for '
+                    'Keystone and Nova'),
+    cfg.FloatOpt('keystone-timeout', default=30.0,
+                 help='Seconds to wait for a Keystone response'),
+    cfg.FloatOpt('nova-timeout', default=30.0,
+                 help='Seconds to wait for a Nova response'),
+]
+
+netbox_opts = [
+    cfg.StrOpt('netbox-url', default='https://netbox.cybera.ca/',
+               help='Base URL of the NetBox API'),
+    cfg.IntOpt('netbox-pool-size', default=10,
+               help='Number of pooled HTTP connections to NetBox'),
+    cfg.BoolOpt('netbox-keep-alive', default=True,
+                help='Keep NetBox HTTP connections open between requests'),
+    cfg.FloatOpt('netbox-timeout', default=30.0,
+                 help='Seconds to wait for a NetBox response'),
+    cfg.IntOpt('netbox-prefix-ttl', default=3600,
+               help='Seconds to cache the resolved NetBox prefix'),
+    cfg.IntOpt('netbox-address-cache-ttl', default=300,
+               help='Seconds to cache NetBox addresses looked up or created '
+                    'by the sink'),
+    cfg.IntOpt('netbox-negative-cache-ttl', default=60,
+               help='Seconds to remember that NetBox has no entry for an '
+                    'address'),
+    cfg.IntOpt('netbox-address-cache-size', default=10000,
+               help='Number of NetBox addresses cached'),
+]
+
+
+class ClientManager(object):
+    """Keystone session and Nova client shared between notifications.
+
+    The session is built once, so the token and service catalog are reused
+    across events and HTTP connections stay in the requests pool. The token
+    is refreshed when it is within ``refresh_margin`` seconds of expiry.
+    Token requests go through the keystone circuit breaker.
+
+    Nova gets its own keystoneauth session, sharing the token and the
+    connection pool, because novaclient ignores its ``timeout`` argument
+    when given a session.
+    """
+
+    def __init__(self, auth_url, username, password, project_name,
+                 refresh_margin=300, pool_size=10, keystone_timeout=30.0,
+                 nova_timeout=30.0):
+        # The client libraries are imported when clients are first built
+        # so loading the handlers stays quick
+        from keystoneauth1.identity import v3
+        from keystoneauth1 import session
+
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._nova = None
+
+        self.auth = v3.Password(username=username, password=password,
+                                project_name=project_name,
+                                project_domain_name='default',
+                                user_domain_name='default',
+                                auth_url=auth_url)
+
+        http = requests.Session()
+        adapter = adapters.HTTPAdapter(pool_connections=pool_size,
+                                       pool_maxsize=pool_size)
+        http.mount('http://', adapter)
+        http.mount('https://', adapter)
+        self.session = session.Session(auth=self.auth, session=http,
+                                       timeout=keystone_timeout)
+        self.nova_session = session.Session(auth=self.auth, session=http,
+                                            timeout=nova_timeout)
+
+    def _token_expiring(self):
+        auth_ref = self.auth.auth_ref
+        return auth_ref is None or \
+            auth_ref.will_expire_soon(self.refresh_margin)
+
+    def _refresh_token(self):
+        if not self._token_expiring():
+            return
+
+        # Callers only wait for the first token. Once there is one, it is
+        # still valid for refresh_margin seconds, so others keep using it
+        # while a single thread fetches the next.
+        if not self._refresh_lock.acquire(
+                blocking=self.auth.auth_ref is None):
+            return
+        try:
+            if not self._token_expiring():
+                return
+            LOG.debug('Fetching new keystone token for %s',
+                      self.auth.auth_url)
+            current = self.auth.auth_ref
+            try:
+                with breaker.get('keystone'), \
+                        metrics.timed('keystone', 'token'):
+                    auth_ref = self.auth.get_auth_ref(self.session)
+            except Exception as e:
+                # The refresh is early, so a Keystone outage only matters
+                # once the current token has actually expired
+                if current is None or current.will_expire_soon(0):
+                    raise
+                LOG.warning("Keystone token refresh failed, keeping the "
+                            "current token: {0}".format(e))
+                return
+            # Swapped in whole, so other threads never see no token
+            self.auth.auth_ref = auth_ref
+        finally:
+            self._refresh_lock.release()
+
+    @property
+    def nova(self):
+        self._refresh_token()
+        with self._lock:
+            if self._nova is None:
+                from novaclient import client as nova_c
+                self._nova = nova_c.Client(2.1, session=self.nova_session)
+            return self._nova
+
+
+# ClientManagers are keyed by their settings so handlers configured with the
+# same credentials share one session. _owners tracks which key each handler
+# group last used so a manager is dropped once no group refers to it.
+_managers = {}
+_owners = {}
+_managers_lock = threading.Lock()
+
+
+def _manager_key(conf):
+    return (conf.auth_url, conf.admin_user, conf.admin_password,
+            conf.admin_tenant_name, conf.token_refresh_margin,
+            conf.http_pool_size, conf.keystone_timeout, conf.nova_timeout)
+
+
+def get_client_manager(group):
+    """Return the shared ClientManager for a handler config group.
+
+    If the group's credentials have changed since the last call a new
+    manager is built. The old one is dropped once unused and left for the
+    garbage collector, as other threads may still be using its session.
+    """
+    key = _manager_key(cfg.CONF[group])
+
+    with _managers_lock:
+        old_key = _owners.get(group)
+        _owners[group] = key
+
+        if old_key is not None and old_key != key and \
+                old_key not in _owners.values():
+            LOG.info('Configuration for %s changed, rebuilding clients',
+                     group)
+            _managers.pop(old_key, None)
+
+        manager = _managers.get(key)
+        if manager is None:
+            manager = ClientManager(*key)
+            _managers[key] = manager
+
+    return manager
+
+
+def get_ip_handler(group, ip_ver, prefix_id):
+    """Return the shared IPHandler configured by a handler config group."""
+    conf = cfg.CONF[group]
+    return IPHandler.get_instance(
+        ip_ver=ip_ver,
+        netbox_api_key=str(conf.netbox_api_key),
+        floating_ip_prefix_id=prefix_id,
+        url=conf.netbox_url,
+        pool_size=conf.netbox_pool_size,
+        keep_alive=conf.netbox_keep_alive,
+        timeout=conf.netbox_timeout,
+        prefix_ttl=conf.netbox_prefix_ttl,
+        address_ttl=conf.netbox_address_cache_ttl,
+        negative_ttl=conf.netbox_negative_cache_ttl,
+        cache_size=conf.netbox_address_cache_size)
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_netbox_queue(group, ip_ver, prefix_id):
+    """Return the NetBoxQueue feeding the shared IPHandler of a group."""
+    conf = cfg.CONF[group]
+    ip_handler = get_ip_handler(group, ip_ver, prefix_id)
+
+    with _queues_lock:
+        queue = _queues.get(ip_handler)
+        if queue is None:
+            journal = None
+            if conf.netbox_journal:
+                journal = netbox_queue.Journal(
+                    conf.netbox_journal, 'v%s:%s' % (ip_ver, prefix_id))
+            queue = netbox_queue.NetBoxQueue(
+                ip_handler,
+                async_mode=conf.netbox_async,
+                max_size=conf.netbox_queue_size,
+                max_retries=conf.netbox_max_retries,
+                backoff=conf.netbox_retry_backoff,
+                max_backoff=conf.netbox_retry_max_backoff,
+                journal=journal,
+                dead_letter_file=conf.netbox_dead_letter_file,
+                tracer=tracing.get_tracer(conf))
+            _queues[ip_handler] = queue
+        return queue
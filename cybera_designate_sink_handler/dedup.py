@@ -0,0 +1,169 @@
+# Suppression of duplicate and redelivered notifications
+
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+dedup_opts = [
+    cfg.IntOpt('dedup-window', default=300,
+               help='Seconds during which an event identical to the last '
+                    'one applied for the same resource is skipped. 0 '
+                    'disables duplicate suppression'),
+    cfg.IntOpt('dedup-cache-size', default=10000,
+               help='Number of resources whose last event is remembered'),
+    cfg.StrOpt('dedup-store',
+               help='SQLite file used to share applied events between sink '
+                    'processes on the same host'),
+]
+
+
+def fingerprint(event_type, fields):
+    """Hash an event type and the payload fields that affect the result."""
+    data = json.dumps([event_type, fields], sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class FileStore(object):
+    """SQLite table of applied events that several processes can share."""
+
+    def __init__(self, path, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=5,
+                                   check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS applied_events ('
+                'key TEXT PRIMARY KEY, fingerprint TEXT, expires REAL)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS applied_events_expires '
+                'ON applied_events (expires)')
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT fingerprint FROM applied_events '
+                'WHERE key = ? AND expires > ?',
+                (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, value, ttl):
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO applied_events VALUES (?, ?, ?)',
+                (key, value, time.time() + ttl))
+            # Expired rows go first, then the oldest beyond max_entries
+            self._db.execute(
+                'DELETE FROM applied_events WHERE expires <= ?',
+                (time.time(),))
+            self._db.execute(
+                'DELETE FROM applied_events WHERE key IN ('
+                'SELECT key FROM applied_events ORDER BY expires DESC '
+                'LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+
+class Deduplicator(object):
+    """Remembers the last event applied to each resource.
+
+    An event is a duplicate when its fingerprint matches the last one
+    applied to the same resource within ``window`` seconds, so a repeat
+    of an older event after something else happened to the resource is
+    still processed. Entries are kept in an LRU of ``max_entries`` and,
+    if ``store`` is given, in a FileStore shared with other processes.
+    The store is then what's checked, since another process may have
+    applied a later event; the LRU is only used if it can't be read.
+
+    Events must be checked and marked applied where they are applied, in
+    order per resource. Checking on intake would compare against the
+    last event applied while earlier ones are still queued.
+    """
+
+    def __init__(self, name, window=300, max_entries=10000, store=None):
+        self.name = name
+        self.window = window
+        self.max_entries = max_entries
+        self.store = store
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._applied = collections.OrderedDict()
+
+    def _key(self, resource_key):
+        return '%s:%s' % (self.name, resource_key)
+
+    def _last(self, key):
+        """The fingerprint last applied to a resource, from the shared
+        store when there is one, else from this process.
+        """
+        if self.store is not None:
+            try:
+                return self.store.get(key)
+            except Exception as e:
+                LOG.warning("Couldn't read applied events: {0}".format(e))
+
+        with self._lock:
+            cached = self._applied.get(key)
+            if cached is not None and cached[0] <= time.monotonic():
+                del self._applied[key]
+                cached = None
+        return cached[1] if cached is not None else None
+
+    def is_duplicate(self, resource_key, event_fingerprint):
+        if not self.window or resource_key is None:
+            return False
+
+        key = self._key(resource_key)
+        last = self._last(key)
+        if last != event_fingerprint:
+            return False
+
+        with self._lock:
+            self.skipped += 1
+        LOG.debug('Skipping duplicate event for %s (%d skipped)', key,
+                  self.skipped)
+        return True
+
+    def applied(self, resource_key, event_fingerprint):
+        if not self.window or resource_key is None:
+            return
+
+        key = self._key(resource_key)
+        with self._lock:
+            self._applied.pop(key, None)
+            self._applied[key] = (time.monotonic() + self.window,
+                                  event_fingerprint)
+            while len(self._applied) > self.max_entries:
+                self._applied.popitem(last=False)
+
+        if self.store is not None:
+            try:
+                self.store.put(key, event_fingerprint, self.window)
+            except Exception as e:
+                LOG.warning("Couldn't record applied event: {0}".format(e))
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_deduplicator(name, conf):
+    """Build the Deduplicator for a handler from its config group.
+
+    Handlers configured with the same store file share one connection.
+    """
+    store = None
+    if conf.dedup_store and conf.dedup_window:
+        with _stores_lock:
+            store = _stores.get(conf.dedup_store)
+            if store is None:
+                store = FileStore(conf.dedup_store, conf.dedup_cache_size)
+                _stores[conf.dedup_store] = store
+    return Deduplicator(name, window=conf.dedup_window,
+                        max_entries=conf.dedup_cache_size, store=store)
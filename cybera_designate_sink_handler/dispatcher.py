@@ -0,0 +1,123 @@
+# Parallel notification processing that keeps each resource's order
+
+import atexit
+import itertools
+import queue
+import threading
+import time
+import zlib
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from cybera_designate_sink_handler import metrics
+
+LOG = logging.getLogger(__name__)
+
+dispatcher_opts = [
+    cfg.IntOpt('dispatch-workers', default=1,
+               help='Number of notifications processed at once. Events '
+                    'for the same instance or floating IP are still '
+                    'processed in order. 1 processes them one after another '
+                    'as they arrive'),
+    cfg.IntOpt('dispatch-queue-size', default=100,
+               help='Events queued per worker before new notifications '
+                    'wait for room'),
+]
+
+# Seconds to let queued events finish when the process exits
+DRAIN_TIMEOUT = 30
+
+# Seconds between warnings about full queues
+WARN_INTERVAL = 10
+
+
+class ShardedDispatcher(object):
+    """Processes notifications on ``workers`` threads, in order per
+    resource.
+
+    ``resource_key(event_type, payload)`` picks the worker, so all events
+    for one resource run one after another on the same worker while
+    other resources proceed. Events without a key are spread round
+    robin. Each worker has a queue of ``queue_size`` events; when it is
+    full ``submit`` blocks, which holds back the notification consumer
+    instead of buffering without bound.
+    """
+
+    def __init__(self, name, apply, resource_key, workers=4,
+                 queue_size=100):
+        self.name = name
+        self._apply = apply
+        self._resource_key = resource_key
+        self.waits = 0
+        self._warned_at = 0
+        self._queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self._next = itertools.count()
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            for shard, events in enumerate(self._queues):
+                thread = threading.Thread(
+                    target=self._run, args=(shard, events),
+                    name='dispatch %s %d' % (self.name, shard))
+                thread.daemon = True
+                thread.start()
+            atexit.register(self.drain)
+            self._started = True
+
+    def _shard(self, event_type, payload):
+        key = self._resource_key(event_type, payload)
+        if key is None:
+            return next(self._next) % len(self._queues)
+        return zlib.crc32(str(key).encode('utf-8')) % len(self._queues)
+
+    def submit(self, context, event_type, payload):
+        if not self._started:
+            self._start()
+
+        shard = self._shard(event_type, payload)
+        events = self._queues[shard]
+        try:
+            events.put_nowait((context, event_type, payload))
+        except queue.Full:
+            self.waits += 1
+            start = time.monotonic()
+            if start >= self._warned_at + WARN_INTERVAL:
+                self._warned_at = start
+                LOG.warning('%s: worker %d is full with %d events queued '
+                            '(%d waits so far)', self.name, shard,
+                            events.qsize(), self.waits)
+            events.put((context, event_type, payload))
+            LOG.debug('%s: waited %.3fs to queue %s', self.name,
+                      time.monotonic() - start, event_type)
+        metrics.queue_depth(self.name, shard, events.qsize())
+
+    def _run(self, shard, events):
+        while True:
+            context, event_type, payload = events.get()
+            try:
+                self._apply(context, event_type, payload)
+            except Exception:
+                LOG.exception('Failed to process %s event', event_type)
+            finally:
+                events.task_done()
+                metrics.queue_depth(self.name, shard, events.qsize())
+
+    def depths(self):
+        """Number of events queued for each worker."""
+        return [events.qsize() for events in self._queues]
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """Wait up to ``timeout`` seconds for queued events to finish."""
+        deadline = time.monotonic() + timeout
+        while any(events.unfinished_tasks for events in self._queues):
+            if time.monotonic() >= deadline:
+                LOG.warning('%s: gave up waiting for %d queued events',
+                            self.name, sum(self.depths()))
+                return False
+            time.sleep(0.05)
+        return True
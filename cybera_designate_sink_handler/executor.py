@@ -0,0 +1,103 @@
+# Concurrent execution of independent operations within an event
+
+from concurrent import futures
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from cybera_designate_sink_handler import metrics
+from cybera_designate_sink_handler import tracing
+
+LOG = logging.getLogger(__name__)
+
+executor_opts = [
+    cfg.IntOpt('event-workers', default=1,
+               help='Number of independent remote calls of a single event '
+                    'that may run at once. 1 runs them one after another'),
+]
+
+
+def _green_pool(size):
+    """Return an eventlet GreenPool if the process is monkey patched.
+
+    designate-sink runs under eventlet, where green threads are the
+    natural unit of concurrency; elsewhere native threads are used.
+    """
+    try:
+        import eventlet
+        from eventlet import patcher
+    except ImportError:
+        return None
+    if not patcher.is_monkey_patched('thread'):
+        return None
+    return eventlet.GreenPool(size)
+
+
+class OperationRunner(object):
+    """Runs the independent remote calls of an event concurrently.
+
+    ``run`` takes a list of ``(name, callable)`` pairs with no ordering
+    between them, waits for all of them and returns their results in the
+    same order. If any failed, the first error is raised once the rest
+    have finished. Each call's duration is logged at debug level.
+    """
+
+    def __init__(self, max_workers=1):
+        self.max_workers = max_workers
+        self._green = None
+        self._threads = None
+        if max_workers > 1:
+            self._green = _green_pool(max_workers)
+            if self._green is None:
+                self._threads = futures.ThreadPoolExecutor(max_workers)
+
+    @staticmethod
+    def _timed(name, func, event_type=None, trace=None):
+        start = time.monotonic()
+        try:
+            if event_type is None and trace is None:
+                return func()
+            # Calls made on other threads still count against the event
+            with metrics.event_type(event_type or ''), \
+                    tracing.activate(trace):
+                return func()
+        finally:
+            LOG.debug('Operation %s took %.3fs', name,
+                      time.monotonic() - start)
+
+    def run(self, operations):
+        if len(operations) < 2 or self.max_workers <= 1:
+            return [self._timed(name, func) for name, func in operations]
+
+        start = time.monotonic()
+        event_type = None
+        if metrics.registry.enabled:
+            event_type = metrics.current_event_type()
+        trace = tracing.current()
+        if self._green is not None:
+            pending = [self._green.spawn(self._timed, name, func, event_type,
+                                         trace)
+                       for name, func in operations]
+            wait = [thread.wait for thread in pending]
+        else:
+            pending = [self._threads.submit(self._timed, name, func,
+                                            event_type, trace)
+                       for name, func in operations]
+            wait = [future.result for future in pending]
+
+        results = []
+        error = None
+        for waiter in wait:
+            try:
+                results.append(waiter())
+            except Exception as e:
+                results.append(None)
+                if error is None:
+                    error = e
+
+        LOG.debug('Ran %d operations in %.3fs', len(operations),
+                  time.monotonic() - start)
+        if error is not None:
+            raise error
+        return results
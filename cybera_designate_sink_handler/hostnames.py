@@ -0,0 +1,134 @@
+# Instance hostname resolution
+
+import collections
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+hostname_opts = [
+    cfg.IntOpt('hostname-cache-size', default=10000,
+               help='Number of instances whose ec2id is remembered from '
+                    'earlier events'),
+    cfg.BoolOpt('hostname-from-metadata', default=False,
+                help='Trust the dns instance metadata in compute payloads. '
+                     'Users can set metadata themselves, so only enable '
+                     'this if that is prevented'),
+]
+
+
+def ec2id_from_name(instance_name):
+    """Turn an instance name like ``instance-0000abcd`` into ``abcd``."""
+    return instance_name.split('-', 1)[1].lstrip('0')
+
+
+class HostnameResolver(object):
+    """Works out an instance's ec2id hostname with as few Nova calls as
+    possible.
+
+    The notification payload is tried first, then ec2ids remembered from
+    earlier events, and only then Nova. ``counts`` records how often each
+    source answered, keyed by ``payload``, ``local`` and ``nova``.
+    """
+
+    def __init__(self, max_entries=10000, trust_metadata=False):
+        self.max_entries = max_entries
+        self.trust_metadata = trust_metadata
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._ec2ids = collections.OrderedDict()
+        self._by_ip = collections.OrderedDict()
+
+    def _store(self, entries, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def remember(self, instance_id, ec2id, fixed_ips=(), tenant_id=None):
+        with self._lock:
+            self._store(self._ec2ids, instance_id, ec2id)
+            for fixed_ip in fixed_ips:
+                self._store(self._by_ip, (fixed_ip, tenant_id), instance_id)
+
+    def forget(self, instance_id):
+        with self._lock:
+            self._ec2ids.pop(instance_id, None)
+            for key in [key for key, value in self._by_ip.items()
+                        if value == instance_id]:
+                del self._by_ip[key]
+
+    def from_payload(self, payload, zone_name):
+        """Return the ec2id carried by a compute payload, if any.
+
+        Legacy Nova payloads don't usually include the instance name. They
+        do carry instance metadata, where the handler stores the hostname
+        it assigned under ``dns``, but that is only used when
+        ``trust_metadata`` is set.
+        """
+        instance_name = payload.get('instance_name')
+        if instance_name and '-' in instance_name:
+            return ec2id_from_name(instance_name)
+
+        if not self.trust_metadata:
+            return None
+
+        dns = (payload.get('metadata') or {}).get('dns')
+        if dns and ('%s.' % dns).endswith('.' + zone_name):
+            return dns.split('.', 1)[0]
+        return None
+
+    def _count(self, source):
+        with self._lock:
+            self.counts[source] += 1
+        LOG.debug('Hostname resolved from %s (%s)', source,
+                  dict(self.counts))
+
+    def resolve(self, instance_id, zone_name, nova_lookup, payload=None):
+        """Return the hostname for an instance id."""
+        ec2id = None
+        if payload is not None:
+            ec2id = self.from_payload(payload, zone_name)
+            if ec2id:
+                self._count('payload')
+
+        if not ec2id:
+            with self._lock:
+                ec2id = self._ec2ids.get(instance_id)
+            if ec2id:
+                self._count('local')
+
+        if not ec2id:
+            ec2id = ec2id_from_name(nova_lookup.by_id(instance_id)[1])
+            self._count('nova')
+
+        self.remember(instance_id, ec2id)
+        return '%s.%s' % (ec2id, zone_name)
+
+    def resolve_fixed_ip(self, fixed_ip, tenant_id, zone_name, nova_lookup):
+        """Return ``(instance_id, hostname)`` for the instance holding a
+        fixed IP, or None if it can't be determined.
+        """
+        with self._lock:
+            instance_id = self._by_ip.get((fixed_ip, tenant_id))
+            ec2id = self._ec2ids.get(instance_id)
+        if ec2id:
+            self._count('local')
+            return instance_id, '%s.%s' % (ec2id, zone_name)
+
+        found = nova_lookup.by_fixed_ip(fixed_ip, tenant_id)
+        self._count('nova')
+        if found is None:
+            return None
+
+        instance_id, instance_name = found
+        ec2id = ec2id_from_name(instance_name)
+        self.remember(instance_id, ec2id, [fixed_ip], tenant_id)
+        return instance_id, '%s.%s' % (ec2id, zone_name)
+
+
+# Shared by both handlers so create events seen by the v6 handler let the
+# floating IP handler name instances without asking Nova.
+resolver = HostnameResolver()
@@ -1,63 +1,339 @@
+import collections
+import ipaddress
 import logging
+import threading
+import time
 
-from time import sleep
+import requests
+from requests import adapters
 
-import pynetbox
-from pynetbox.core.response import RecordSet
+from cybera_designate_sink_handler import breaker
+from cybera_designate_sink_handler import metrics
 
 LOG = logging.getLogger(__name__)
 
+DEFAULT_NETBOX_URL = "https://netbox.cybera.ca/"
+DEFAULT_PREFIX = 71
+
+
+class GuardedAdapter(adapters.HTTPAdapter):
+    """Applies a default timeout and the netbox circuit breaker to every
+    request pynetbox makes.
+    """
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super(GuardedAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        netbox = breaker.get('netbox')
+        netbox.check()
+        try:
+            response = super(GuardedAdapter, self).send(request, **kwargs)
+        except Exception:
+            netbox.failure()
+            raise
+
+        # Server errors are still returned for pynetbox to report
+        if response.status_code >= 500:
+            netbox.failure()
+        else:
+            netbox.success()
+        return response
+
 
 class IPHandler(object):
-    def __init__(self, ip_ver, netbox_api_key, floating_ip_prefix_id):
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, ip_ver, netbox_api_key, floating_ip_prefix_id,
+                 url=DEFAULT_NETBOX_URL, pool_size=10, keep_alive=True,
+                 prefix_ttl=3600, address_ttl=300, negative_ttl=60,
+                 cache_size=10000, timeout=30.0):
         self.ip_ver = ip_ver
-        self.nb = pynetbox.api("https://netbox.cybera.ca/", netbox_api_key)
+        self.floating_ip_prefix_id = floating_ip_prefix_id
+        self.prefix_ttl = prefix_ttl
+        self.address_ttl = address_ttl
+        self.negative_ttl = negative_ttl
+        self.cache_size = cache_size
 
-        self.prefix = 71
-        try:
-            self.prefix = dict(self.nb.ipam.prefixes.get(
-                floating_ip_prefix_id))['id']
-        except:
-            pass
+        # pynetbox is only imported once NetBox is first needed
+        import pynetbox
+        self.nb = pynetbox.api(url, netbox_api_key)
+        self.nb.http_session = self._build_session(pool_size, keep_alive,
+                                                   timeout)
+
+        self.skipped_writes = 0
+
+        # address -> (expires, IP object or None if NetBox doesn't have it)
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._create_lock = threading.Lock()
+
+        self._prefix = DEFAULT_PREFIX
+        self._prefix_expires = 0
+        self._prefix_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls, ip_ver, netbox_api_key, floating_ip_prefix_id,
+                     **kwargs):
+        """Return the shared IPHandler for these settings.
+
+        Handlers are kept for the life of the process so the HTTP session
+        and the resolved prefix are reused between notifications.
+        """
+        key = (ip_ver, floating_ip_prefix_id, netbox_api_key,
+               tuple(sorted(kwargs.items())))
+        with cls._instances_lock:
+            handler = cls._instances.get(key)
+            if handler is None:
+                handler = cls(ip_ver, netbox_api_key, floating_ip_prefix_id,
+                              **kwargs)
+                cls._instances[key] = handler
+            return handler
+
+    @staticmethod
+    def _build_session(pool_size, keep_alive, timeout=None):
+        session = requests.Session()
+        adapter = GuardedAdapter(timeout=timeout, pool_connections=pool_size,
+                                 pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    @property
+    def prefix(self):
+        with self._prefix_lock:
+            if time.monotonic() < self._prefix_expires:
+                return self._prefix
+
+            try:
+                with metrics.timed('netbox', 'prefixes.get'):
+                    self._prefix = dict(self.nb.ipam.prefixes.get(
+                        self.floating_ip_prefix_id))['id']
+                self._prefix_expires = time.monotonic() + self.prefix_ttl
+            except Exception as e:
+                # Keep the last known prefix and retry again shortly
+                LOG.warning("Couldn't resolve prefix {0}: {1}".format(
+                    self.floating_ip_prefix_id, e))
+                self._prefix_expires = time.monotonic() + \
+                    min(self.prefix_ttl, 60)
+
+            return self._prefix
+
+    @staticmethod
+    def _host(ip):
+        return str(ipaddress.ip_interface(str(ip.address)).ip)
+
+    @staticmethod
+    def _normalize(address):
+        return str(ipaddress.ip_address(str(address).split('/')[0]))
+
+    def _cached(self, address, negative=True):
+        """Return ``(hit, ip)`` for an address; ``ip`` is None for an
+        address NetBox was found not to have.
+        """
+        with self._cache_lock:
+            cached = self._cache.get(address)
+            if cached is None:
+                return False, None
+            if cached[0] <= time.monotonic():
+                del self._cache[address]
+                return False, None
+            if cached[1] is None and not negative:
+                return False, None
+            self._cache.move_to_end(address)
+            return True, cached[1]
+
+    def _remember(self, address, ip):
+        ttl = self.address_ttl if ip is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        with self._cache_lock:
+            self._cache[address] = (time.monotonic() + ttl, ip)
+            self._cache.move_to_end(address)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _forget(self, ips):
+        with self._cache_lock:
+            for ip in ips:
+                self._cache.pop(self._host(ip), None)
 
     def create_ip(self, address):
         try:
-            self.nb.ipam.ip_addresses.create(address=address)
-            created_ip = self.nb.ipam.ip_addresses.filter(
-                address=address).__iter__().__next__()
+            with metrics.timed('netbox', 'ip_addresses.create'):
+                created_ip = self.nb.ipam.ip_addresses.create(
+                    address=address)
 
             if created_ip:
+                self._remember(self._host(created_ip), created_ip)
                 return created_ip
         except Exception as e:
             LOG.warning("v6 Address not created: {0}".format(e))
 
     def get_ip(self, address):
-        address = str(address)
+        address = self._normalize(address)
 
-        ip = self.nb.ipam.ip_addresses.filter(address=address, prefix=self.prefix)
-        it = ip.__iter__()
         if self.ip_ver == 6:
-            return self.create_ip(address)
-        try:
-            return it.__next__()
-        except StopIteration:
-            LOG.warning("get_ip() failed:  TYPE: {1}".format(dir(ip.__iter__())))
+            # Only create the address if NetBox doesn't have it yet
+            try:
+                return self.ensure_ips([address], cached=False).get(address)
+            except Exception as e:
+                LOG.warning("v6 Address not created: {0}".format(e))
+                return None
+
+        found = self.get_ips([address], cached=False).get(address)
+        if found is None:
+            LOG.warning("get_ip() failed: no address {0} in prefix {1}".format(
+                address, self.prefix))
             return False
+        return found
+
+    def get_ips(self, addresses, negative=True, cached=True):
+        """Look up several addresses with at most one request.
+
+        Returns a dict of address to IP object for the addresses NetBox
+        knows about; missing addresses are left out. Addresses are served
+        from the cache where possible, including ones recently found to be
+        missing unless ``negative`` is False. With ``cached`` False they
+        are all fetched, as callers about to write need objects that
+        reflect NetBox now. Like the other bulk methods, errors are raised
+        so callers can retry.
+        """
+        addresses = [self._normalize(address) for address in addresses]
+
+        ips = {}
+        misses = []
+        for address in addresses:
+            hit, ip = self._cached(address, negative) if cached else \
+                (False, None)
+            if not hit:
+                misses.append(address)
+            elif ip is not None:
+                ips[address] = ip
+        if not misses:
+            return ips
+
+        query = {'address': misses}
+        if self.ip_ver == 4:
+            query['prefix'] = self.prefix
+
+        with metrics.timed('netbox', 'ip_addresses.filter'):
+            found = dict((self._host(ip), ip)
+                         for ip in self.nb.ipam.ip_addresses.filter(**query))
+        for address in misses:
+            self._remember(address, found.get(address))
+        ips.update(found)
+        return ips
+
+    def ensure_ips(self, addresses, cached=True):
+        """Look up several addresses, creating the missing ones in bulk.
+
+        Addresses cached as missing are looked up again first, and
+        creation is serialized, so an address is never created twice.
+        ``cached`` is passed on to ``get_ips``.
+        """
+        addresses = [self._normalize(address) for address in addresses]
+        with self._create_lock:
+            ips = self.get_ips(addresses, negative=False, cached=cached)
+
+            missing = [address for address in addresses if address not in ips]
+            if missing:
+                with metrics.timed('netbox', 'ip_addresses.create'):
+                    created = self.nb.ipam.ip_addresses.create(
+                        [{'address': address} for address in missing])
+                for ip in created:
+                    ips[self._host(ip)] = ip
+                    self._remember(self._host(ip), ip)
+
+        return ips
+
+    def _needs_update(self, ips, description):
+        """Return the IPs whose description differs, counting the rest as
+        skipped writes.
+
+        Other sink processes and operators change NetBox too, so ``ips``
+        must have been fetched for this write, with ``cached=False``.
+        """
+        changed = [ip for ip in ips
+                   if getattr(ip, 'description', None) != description]
+        skipped = len(ips) - len(changed)
+        if skipped:
+            self.skipped_writes += skipped
+            for _ in range(skipped):
+                metrics.skipped('netbox', 'ip_addresses.update')
+            LOG.debug("Skipped {0} NetBox updates, {1} in total".format(
+                skipped, self.skipped_writes))
+        return changed
+
+    def _update_descriptions(self, ips, description):
+        """PATCH the descriptions of several IPs by id in one request."""
+        try:
+            with metrics.timed('netbox', 'ip_addresses.update'):
+                self.nb.ipam.ip_addresses.update(
+                    [{'id': ip.id, 'description': description}
+                     for ip in ips])
+        except Exception:
+            # The cached objects may be stale, look them up again next time
+            self._forget(ips)
+            raise
+        for ip in ips:
+            ip.description = description
 
     def unassign_ip(self, ip):
         if self.ip_ver == 4:
+            if not self._needs_update([ip], 'Floating IP'):
+                return
             try:
-                ip.update({'description': 'Floating IP'})
+                with metrics.timed('netbox', 'ip_addresses.update'):
+                    ip.update({'description': 'Floating IP'})
             except Exception as e:
                 LOG.warning("Couldn't run unassign method: {0}".format(e))
 
         elif self.ip_ver == 6:
-            ip.delete()
+            self._forget([ip])
+            with metrics.timed('netbox', 'ip_addresses.delete'):
+                ip.delete()
+
+    def unassign_ips(self, ips):
+        ips = list(ips)
+        if not ips:
+            return
+
+        if self.ip_ver == 4:
+            ips = self._needs_update(ips, 'Floating IP')
+            if ips:
+                self._update_descriptions(ips, 'Floating IP')
+        elif self.ip_ver == 6:
+            self._forget(ips)
+            with metrics.timed('netbox', 'ip_addresses.delete'):
+                self.nb.ipam.ip_addresses.delete(ips)
+            for ip in ips:
+                self._remember(self._host(ip), None)
 
     def assign_ip(self, ip, dns, project):
 
         try:
             description = "{0} ({1})".format(project, dns)
-            ip.update({'description': description})
+            if not self._needs_update([ip], description):
+                return
+            with metrics.timed('netbox', 'ip_addresses.update'):
+                ip.update({'description': description})
         except Exception as e:
             LOG.warning("Couldn't run assign method: {0}".format(e))
+
+    def assign_ips(self, ips, dns, project):
+        ips = list(ips)
+        if not ips:
+            return
+
+        description = "{0} ({1})".format(project, dns)
+        ips = self._needs_update(ips, description)
+        if ips:
+            self._update_descriptions(ips, description)
@@ -0,0 +1,153 @@
+# Nova instance lookups
+
+import collections
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from cybera_designate_sink_handler import breaker
+from cybera_designate_sink_handler import metrics
+
+LOG = logging.getLogger(__name__)
+
+lookup_opts = [
+    cfg.IntOpt('instance-cache-ttl', default=60,
+               help='Seconds to cache instance names looked up in Nova'),
+    cfg.IntOpt('instance-cache-size', default=10000,
+               help='Number of instances whose Nova lookups are cached'),
+]
+
+
+class InstanceCache(object):
+    """Short lived cache of ``(instance_id, instance_name)`` tuples.
+
+    Entries are reachable by instance id and by ``(fixed_ip, tenant_id)``,
+    and are dropped by ``invalidate`` when the instance is deleted. Each
+    map holds at most ``max_entries``; expired entries are dropped as new
+    ones are added, and the oldest beyond the limit are evicted.
+    """
+
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._by_id = collections.OrderedDict()
+        self._by_ip = collections.OrderedDict()
+
+    def _get(self, entries, key):
+        with self._lock:
+            cached = entries.get(key)
+            if cached is None:
+                return None
+            if cached[0] <= time.monotonic():
+                del entries[key]
+                return None
+            return cached[1]
+
+    def _store(self, entries, key, value, now):
+        entries[key] = value
+        entries.move_to_end(key)
+        # Entries are kept in the order they expire
+        while entries and (len(entries) > self.max_entries or
+                           next(iter(entries.values()))[0] <= now):
+            entries.popitem(last=False)
+
+    def get_by_id(self, instance_id):
+        return self._get(self._by_id, instance_id)
+
+    def get_by_ip(self, fixed_ip, tenant_id):
+        return self._get(self._by_ip, (fixed_ip, tenant_id))
+
+    def put(self, instance_id, instance_name, fixed_ip=None, tenant_id=None):
+        now = time.monotonic()
+        cached = (now + self.ttl, (instance_id, instance_name))
+        with self._lock:
+            self._store(self._by_id, instance_id, cached, now)
+            if fixed_ip is not None:
+                self._store(self._by_ip, (fixed_ip, tenant_id), cached, now)
+
+    def invalidate(self, instance_id):
+        with self._lock:
+            self._by_id.pop(instance_id, None)
+            for key in [key for key, cached in self._by_ip.items()
+                        if cached[1][0] == instance_id]:
+                del self._by_ip[key]
+
+
+# Shared by both handlers so compute delete events seen by the v6 handler
+# also drop entries the floating IP handler would use.
+instance_cache = InstanceCache()
+
+
+class InstanceLookup(object):
+    """Instance lookups for a single notification.
+
+    Nova is only contacted when a lookup misses the cache, and each
+    instance is fetched at most once per event. ``get_nova`` is called on
+    first use so events that never need Nova don't authenticate.
+    """
+
+    def __init__(self, get_nova, cache=None):
+        self._get_nova = get_nova
+        self._nova = None
+        self.cache = cache if cache is not None else instance_cache
+        self._servers = {}
+
+    @property
+    def nova(self):
+        if self._nova is None:
+            self._nova = self._get_nova()
+        return self._nova
+
+    @staticmethod
+    def _name(server):
+        return getattr(server, 'OS-EXT-SRV-ATTR:instance_name')
+
+    def get(self, instance_id):
+        """Return the full server, fetching it at most once."""
+        if instance_id not in self._servers:
+            nova = self.nova
+            with breaker.get('nova'), metrics.timed('nova', 'servers.get'):
+                server = nova.servers.get(instance_id)
+            self._servers[instance_id] = server
+            self.cache.put(server.id, self._name(server))
+        return self._servers[instance_id]
+
+    def by_id(self, instance_id):
+        """Return ``(instance_id, instance_name)`` for an instance id."""
+        found = self.cache.get_by_id(instance_id)
+        if found is None:
+            server = self.get(instance_id)
+            found = (server.id, self._name(server))
+        return found
+
+    def by_fixed_ip(self, fixed_ip, tenant_id):
+        """Return ``(instance_id, instance_name)`` for the active instance
+        with this fixed IP, or None unless exactly one matches.
+        """
+        found = self.cache.get_by_ip(fixed_ip, tenant_id)
+        if found is not None:
+            return found
+
+        search_opts = {
+            'ip': fixed_ip,
+            'status': 'ACTIVE',
+            'all_tenants': True,
+            'tenant_id': tenant_id,
+        }
+        nova = self.nova
+        with breaker.get('nova'), metrics.timed('nova', 'servers.list'):
+            instances = nova.servers.list(
+                detailed=True, search_opts=search_opts)
+        if len(instances) != 1:
+            LOG.debug('Found %d instances with fixed ip %s',
+                      len(instances), fixed_ip)
+            return None
+
+        server = instances[0]
+        self._servers[server.id] = server
+        found = (server.id, self._name(server))
+        self.cache.put(server.id, found[1], fixed_ip, tenant_id)
+        return found
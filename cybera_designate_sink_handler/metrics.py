@@ -0,0 +1,364 @@
+# Latency and call-count metrics in Prometheus text format
+
+import bisect
+import collections
+import contextlib
+from http import server
+import os
+import tempfile
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from cybera_designate_sink_handler import tracing
+
+LOG = logging.getLogger(__name__)
+
+metrics_opts = [
+    cfg.BoolOpt('metrics', default=False,
+                help='Record latency, error and in-flight metrics for '
+                     'Keystone, Nova, Designate and NetBox calls'),
+    cfg.StrOpt('metrics-host', default='127.0.0.1',
+               help='Address the metrics endpoint listens on'),
+    cfg.IntOpt('metrics-port', default=0,
+               help='Serve metrics over HTTP on this port. 0 disables the '
+                    'endpoint'),
+    cfg.StrOpt('metrics-file',
+               help='File the metrics are periodically written to, for '
+                    'the node exporter textfile collector'),
+    cfg.IntOpt('metrics-file-interval', default=15,
+               help='Seconds between writes of the metrics file'),
+]
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0)
+
+_local = threading.local()
+
+
+def current_event_type():
+    return getattr(_local, 'event_type', '')
+
+
+@contextlib.contextmanager
+def event_type(name):
+    """Attribute the calls made in this thread to an event type."""
+    previous = current_event_type()
+    _local.event_type = name
+    try:
+        yield
+    finally:
+        _local.event_type = previous
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(BUCKETS, value)
+        if index < len(BUCKETS):
+            self.counts[index] += 1
+        self.total += 1
+        self.sum += value
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                          .replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs)
+
+
+class Registry(object):
+    """Collects the metrics of the sink handlers.
+
+    Remote calls are labelled by dependency, call and the event type being
+    processed; whole events by handler and event type. Nothing is recorded
+    until ``enabled`` is set, and ``timed`` then costs one attribute check.
+    """
+
+    CALL_LABELS = ('dependency', 'call', 'event_type')
+    EVENT_LABELS = ('handler', 'event_type')
+    BREAKER_LABELS = ('dependency',)
+    QUEUE_LABELS = ('handler', 'worker')
+    BREAKER_STATES = {'closed': 0, 'open': 1, 'half-open': 2}
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._calls = collections.defaultdict(Histogram)
+        self._call_errors = collections.Counter()
+        self._in_flight = collections.Counter()
+        self._skipped = collections.Counter()
+        self._breakers = {}
+        self._trips = collections.Counter()
+        self._events = collections.defaultdict(Histogram)
+        self._event_errors = collections.Counter()
+        self._filtered = collections.Counter()
+        self._queue_depths = {}
+
+    @contextlib.contextmanager
+    def _timed(self, labels, histograms, errors, in_flight=None):
+        if in_flight is not None:
+            with self._lock:
+                in_flight[labels] += 1
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            with self._lock:
+                errors[labels] += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                histograms[labels].observe(elapsed)
+                if in_flight is not None:
+                    in_flight[labels] -= 1
+
+    def timed(self, dependency, call):
+        """Time a remote call, counting it as an error if it raises."""
+        if not self.enabled:
+            return _NOOP
+        labels = (dependency, call, current_event_type())
+        return self._timed(labels, self._calls, self._call_errors,
+                           self._in_flight)
+
+    def skipped(self, dependency, call):
+        """Count a write that was skipped as it would change nothing."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._skipped[(dependency, call, current_event_type())] += 1
+
+    def breaker_state(self, dependency, state):
+        """Record a circuit breaker changing state."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._breakers[(dependency,)] = self.BREAKER_STATES[state]
+            if state == 'open':
+                self._trips[(dependency,)] += 1
+
+    def filtered(self, handler, name):
+        """Count a notification dropped as it concerns nothing managed."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._filtered[(handler, name)] += 1
+
+    def queue_depth(self, handler, worker, depth):
+        """Record how many events wait for a dispatch worker."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._queue_depths[(handler, str(worker))] = depth
+
+    def event(self, handler, name):
+        """Time a whole notification and label the calls it makes."""
+        if not self.enabled:
+            return _NOOP
+        return self._event(handler, name)
+
+    @contextlib.contextmanager
+    def _event(self, handler, name):
+        with event_type(name), self._timed((handler, name), self._events,
+                                           self._event_errors):
+            yield
+
+    def _histogram(self, out, name, help, label_names, histograms):
+        out.append('# HELP %s %s' % (name, help))
+        out.append('# TYPE %s histogram' % name)
+        for labels, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                out.append('%s_bucket%s %d' % (
+                    name, _labels(label_names, labels, 'le="%s"' % bound),
+                    cumulative))
+            out.append('%s_bucket%s %d' % (
+                name, _labels(label_names, labels, 'le="+Inf"'),
+                histogram.total))
+            out.append('%s_sum%s %f' % (
+                name, _labels(label_names, labels), histogram.sum))
+            out.append('%s_count%s %d' % (
+                name, _labels(label_names, labels), histogram.total))
+
+    def _simple(self, out, name, help, kind, label_names, values):
+        out.append('# HELP %s %s' % (name, help))
+        out.append('# TYPE %s %s' % (name, kind))
+        for labels, value in sorted(values.items()):
+            out.append('%s%s %d' % (name, _labels(label_names, labels),
+                                    value))
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        out = []
+        with self._lock:
+            self._histogram(out, 'designate_sink_call_seconds',
+                            'Duration of calls to external services',
+                            self.CALL_LABELS, self._calls)
+            self._simple(out, 'designate_sink_call_errors_total',
+                         'Calls to external services that raised',
+                         'counter', self.CALL_LABELS, self._call_errors)
+            self._simple(out, 'designate_sink_calls_in_flight',
+                         'Calls to external services in progress',
+                         'gauge', self.CALL_LABELS, self._in_flight)
+            self._simple(out, 'designate_sink_skipped_writes_total',
+                         'Writes skipped because nothing would change',
+                         'counter', self.CALL_LABELS, self._skipped)
+            self._simple(out, 'designate_sink_breaker_state',
+                         'Circuit breaker state, 0 closed, 1 open and 2 '
+                         'half open', 'gauge', self.BREAKER_LABELS,
+                         self._breakers)
+            self._simple(out, 'designate_sink_breaker_trips_total',
+                         'Times a circuit breaker opened', 'counter',
+                         self.BREAKER_LABELS, self._trips)
+            self._histogram(out, 'designate_sink_event_seconds',
+                            'Duration of notification processing',
+                            self.EVENT_LABELS, self._events)
+            self._simple(out, 'designate_sink_event_errors_total',
+                         'Notifications that failed to process',
+                         'counter', self.EVENT_LABELS, self._event_errors)
+            self._simple(out, 'designate_sink_filtered_events_total',
+                         'Notifications dropped as they concern no managed '
+                         'prefix or network', 'counter', self.EVENT_LABELS,
+                         self._filtered)
+            self._simple(out, 'designate_sink_dispatch_queue_depth',
+                         'Events waiting for each dispatch worker', 'gauge',
+                         self.QUEUE_LABELS, self._queue_depths)
+        return '\n'.join(out) + '\n'
+
+
+class _Noop(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _Noop()
+
+registry = Registry()
+
+
+@contextlib.contextmanager
+def _traced(timer, span):
+    with timer, span:
+        yield
+
+
+def timed(dependency, call):
+    """Time a remote call, and add it to the event's trace if there is
+    one.
+    """
+    timer = registry.timed(dependency, call)
+    span = tracing.span(dependency, call)
+    if span is None:
+        return timer
+    return _traced(timer, span)
+
+
+def skipped(dependency, call):
+    registry.skipped(dependency, call)
+
+
+def breaker_state(dependency, state):
+    registry.breaker_state(dependency, state)
+
+
+def filtered(handler, name):
+    registry.filtered(handler, name)
+
+
+def queue_depth(handler, worker, depth):
+    registry.queue_depth(handler, worker, depth)
+
+
+def event(handler, name):
+    return registry.event(handler, name)
+
+
+class _MetricsHandler(server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_file(path):
+    """Atomically replace ``path`` with the current metrics."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(registry.render())
+        os.rename(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def _write_file_loop(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_file(path)
+        except Exception as e:
+            LOG.warning("Couldn't write metrics file {0}: {1}".format(
+                path, e))
+
+
+_exporters = set()
+_exporters_lock = threading.Lock()
+
+
+def _start(target, name, *args):
+    thread = threading.Thread(target=target, name=name, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+def configure(conf):
+    """Enable metrics and start the exporters a handler group asks for.
+
+    Exporters are shared by the handlers of the process, so one that is
+    already running is not started again.
+    """
+    if not conf.metrics:
+        return
+    registry.enabled = True
+
+    with _exporters_lock:
+        if conf.metrics_port:
+            address = (conf.metrics_host, conf.metrics_port)
+            if address not in _exporters:
+                try:
+                    httpd = server.ThreadingHTTPServer(address,
+                                                       _MetricsHandler)
+                except Exception as e:
+                    LOG.warning("Couldn't serve metrics on {0}:{1}: "
+                                "{2}".format(address[0], address[1], e))
+                else:
+                    httpd.daemon_threads = True
+                    _start(httpd.serve_forever, 'metrics-http')
+                    _exporters.add(address)
+
+        if conf.metrics_file and conf.metrics_file not in _exporters:
+            _start(_write_file_loop, 'metrics-file', conf.metrics_file,
+                   conf.metrics_file_interval)
+            _exporters.add(conf.metrics_file)
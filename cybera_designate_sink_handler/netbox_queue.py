@@ -0,0 +1,328 @@
+# Background NetBox synchronization
+
+import collections
+import ipaddress
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from cybera_designate_sink_handler import breaker
+from cybera_designate_sink_handler import tracing
+
+LOG = logging.getLogger(__name__)
+
+netbox_queue_opts = [
+    cfg.BoolOpt('netbox-async', default=True,
+                help='Update NetBox from a background worker instead of '
+                     'inline with the DNS changes'),
+    cfg.IntOpt('netbox-queue-size', default=1000,
+               help='Maximum number of addresses waiting for NetBox. '
+                    'Notifications block while the queue is full'),
+    cfg.IntOpt('netbox-max-retries', default=8,
+               help='Attempts made for a NetBox update before it is '
+                    'dead-lettered'),
+    cfg.FloatOpt('netbox-retry-backoff', default=1.0,
+                 help='Seconds before the first retry, doubled for each '
+                      'further attempt'),
+    cfg.FloatOpt('netbox-retry-max-backoff', default=300.0,
+                 help='Upper bound on the delay between retries'),
+    cfg.StrOpt('netbox-journal',
+               help='SQLite file where queued NetBox updates are kept so '
+                    'they survive restarts'),
+    cfg.StrOpt('netbox-dead-letter-file',
+               help='File that NetBox updates which ran out of retries are '
+                    'appended to, one JSON object per line'),
+]
+
+
+class Journal(object):
+    """SQLite copy of the pending operations of a NetBoxQueue."""
+
+    def __init__(self, path, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS netbox_ops ('
+                'queue TEXT, address TEXT, op_id TEXT, op TEXT, '
+                'PRIMARY KEY (queue, address))')
+
+    def load(self):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT op FROM netbox_ops WHERE queue = ?',
+                (self.name,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def save(self, op):
+        # Trace contexts only mean something to this process
+        saved = dict((key, value) for key, value in op.items()
+                     if key != 'trace')
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO netbox_ops VALUES (?, ?, ?, ?)',
+                (self.name, op['address'], op['id'], json.dumps(saved)))
+
+    def remove(self, op):
+        # Only remove the row if it hasn't been replaced by a newer op
+        with self._lock, self._db:
+            self._db.execute(
+                'DELETE FROM netbox_ops '
+                'WHERE queue = ? AND address = ? AND op_id = ?',
+                (self.name, op['address'], op['id']))
+
+
+class NetBoxQueue(object):
+    """Applies NetBox address updates in the background.
+
+    Operations are keyed by address, so a newer assign or unassign for an
+    address replaces one that hasn't been applied yet and replaying an
+    operation is harmless. Pending operations are applied in groups using
+    the bulk IPHandler methods. Failures are retried with exponential
+    backoff and dead-lettered after ``max_retries`` attempts.
+
+    With ``async_mode`` off, operations are applied in the calling thread
+    and failures are only logged, as the handlers used to do.
+
+    Each operation carries the trace of the notification that queued it.
+    With a ``tracer``, every group applied in the background is traced
+    on its own and linked to those notifications.
+    """
+
+    # Largest group of addresses sent to NetBox in one bulk request
+    batch_size = 100
+
+    def __init__(self, ip_handler, async_mode=True, max_size=1000,
+                 max_retries=8, backoff=1.0, max_backoff=300.0,
+                 journal=None, dead_letter_file=None, tracer=None):
+        self.ip_handler = ip_handler
+        self.async_mode = async_mode
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.journal = journal
+        self.dead_letter_file = dead_letter_file
+        self.tracer = tracer
+        self.dead_letters = 0
+
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._thread = None
+
+        if self.journal is not None:
+            for op in self.journal.load():
+                op['next_at'] = 0
+                self._pending[op['address']] = op
+            if self._pending:
+                LOG.info('Resuming %d NetBox updates from journal',
+                         len(self._pending))
+                self._start()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def assign(self, addresses, dns, project):
+        for address in addresses:
+            self._submit({'action': 'assign', 'address': address,
+                          'dns': dns, 'project': project})
+        self._flush_inline()
+
+    def unassign(self, addresses):
+        for address in addresses:
+            self._submit({'action': 'unassign', 'address': address})
+        self._flush_inline()
+
+    def _submit(self, op):
+        op['id'] = uuid.uuid4().hex
+        op['address'] = str(ipaddress.ip_address(str(op['address'])))
+        op['attempts'] = 0
+        op['next_at'] = 0
+        op['trace'] = tracing.current()
+
+        with self._cond:
+            while op['address'] not in self._pending and \
+                    len(self._pending) >= self.max_size:
+                LOG.warning('NetBox queue is full, waiting')
+                self._cond.wait()
+
+            self._pending.pop(op['address'], None)
+            self._pending[op['address']] = op
+            if self.journal is not None:
+                self.journal.save(op)
+            if self.async_mode:
+                self._start()
+                self._cond.notify_all()
+
+    def _flush_inline(self):
+        if self.async_mode:
+            return
+        with self._cond:
+            ops = list(self._pending.values())
+            self._pending.clear()
+        for op in self._apply(ops):
+            LOG.warning('NetBox %s of %s failed', op['action'],
+                        op['address'])
+        for op in ops:
+            self._finished(op)
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='netbox-queue')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _take_ready(self):
+        now = time.monotonic()
+        ready = [op for op in self._pending.values()
+                 if op['next_at'] <= now][:self.batch_size]
+        for op in ready:
+            del self._pending[op['address']]
+        self._cond.notify_all()
+        return ready
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    ready = self._take_ready()
+                    if ready:
+                        break
+                    wait = None
+                    if self._pending:
+                        wait = max(0, min(op['next_at'] for op in
+                                          self._pending.values()) -
+                                   time.monotonic())
+                    self._cond.wait(wait)
+
+            with tracing.follow(self.tracer, 'netbox-queue apply',
+                                [op.get('trace') for op in ready]) as trace:
+                try:
+                    failed = self._apply(ready)
+                except Exception:
+                    LOG.exception('Unexpected error applying NetBox updates')
+                    failed = ready
+                if failed and trace is not None:
+                    trace.error = '%d of %d NetBox updates failed' % (
+                        len(failed), len(ready))
+
+            failed_ids = set(id(op) for op in failed)
+            for op in ready:
+                if id(op) not in failed_ids:
+                    self._finished(op)
+            for op in failed:
+                self._retry(op)
+
+    def _retry(self, op):
+        netbox = breaker.get('netbox')
+        if netbox.is_open():
+            # NetBox is down, wait for it without using up attempts
+            delay = max(netbox.retry_after(), self.backoff)
+        else:
+            op['attempts'] += 1
+            if op['attempts'] >= self.max_retries:
+                self._dead_letter(op)
+                return
+
+            delay = min(self.backoff * 2 ** (op['attempts'] - 1),
+                        self.max_backoff)
+        op['next_at'] = time.monotonic() + delay
+        LOG.debug('Retrying NetBox %s of %s in %.1fs', op['action'],
+                  op['address'], delay)
+
+        with self._cond:
+            # A newer operation for the address supersedes this one
+            if op['address'] not in self._pending:
+                self._pending[op['address']] = op
+                if self.journal is not None:
+                    self.journal.save(op)
+            else:
+                self._finished(op)
+            self._cond.notify_all()
+
+    def _finished(self, op):
+        if self.journal is not None:
+            self.journal.remove(op)
+
+    def _dead_letter(self, op):
+        self.dead_letters += 1
+        LOG.error('Giving up on NetBox %s of %s after %d attempts',
+                  op['action'], op['address'], op['attempts'])
+        if self.dead_letter_file:
+            try:
+                with open(self.dead_letter_file, 'a') as f:
+                    f.write(json.dumps({
+                        'time': time.time(),
+                        'ip_ver': self.ip_handler.ip_ver,
+                        'action': op['action'],
+                        'address': op['address'],
+                        'dns': op.get('dns'),
+                        'project': op.get('project'),
+                        'attempts': op['attempts'],
+                    }) + '\n')
+            except IOError as e:
+                LOG.warning("Couldn't write dead letter: {0}".format(e))
+        self._finished(op)
+
+    def _apply(self, ops):
+        """Apply a group of operations, returning the ones that failed."""
+        handler = self.ip_handler
+        assigns = [op for op in ops if op['action'] == 'assign']
+        unassigns = [op for op in ops if op['action'] == 'unassign']
+        failed = []
+
+        # Addresses are fetched fresh, since writes are skipped when NetBox
+        # already holds the description
+        if assigns:
+            addresses = [op['address'] for op in assigns]
+            try:
+                if handler.ip_ver == 6:
+                    ips = handler.ensure_ips(addresses, cached=False)
+                else:
+                    ips = handler.get_ips(addresses, cached=False)
+            except Exception as e:
+                LOG.warning("NetBox lookup failed: {0}".format(e))
+                ips = None
+                failed.extend(assigns)
+
+            if ips is not None:
+                groups = collections.OrderedDict()
+                for op in assigns:
+                    if op['address'] not in ips:
+                        # Floating IPs must already exist in the prefix,
+                        # retrying won't help
+                        LOG.warning('%s is not in NetBox', op['address'])
+                        if handler.ip_ver == 6:
+                            failed.append(op)
+                        continue
+                    groups.setdefault((op['dns'], op['project']), []).append(
+                        op)
+
+                for (dns, project), group in groups.items():
+                    try:
+                        handler.assign_ips(
+                            [ips[op['address']] for op in group],
+                            dns, project)
+                    except Exception as e:
+                        LOG.warning(
+                            "NetBox assignment failed: {0}".format(e))
+                        failed.extend(group)
+
+        if unassigns:
+            try:
+                ips = handler.get_ips([op['address'] for op in unassigns],
+                                      cached=False)
+                handler.unassign_ips(ips.values())
+            except Exception as e:
+                LOG.warning("NetBox unassignment failed: {0}".format(e))
+                failed.extend(unassigns)
+
+        return failed
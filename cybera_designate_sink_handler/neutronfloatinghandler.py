@@ -8,14 +8,27 @@ from designate.notification_handler.base import BaseAddressHandler
 from designate.context import DesignateContext
 from designate.central import rpcapi as central_api
 
-from keystoneauth1.identity import v3
-from keystoneauth1 import session
-from novaclient import client as nova_c
-from designateclient.v2 import client as designate_c
-
-from cybera_designate_sink_handler.ip_handler import IPHandler
-
+from cybera_designate_sink_handler import batching
+from cybera_designate_sink_handler import breaker
+from cybera_designate_sink_handler import capture
+from cybera_designate_sink_handler import clients
+from cybera_designate_sink_handler import dedup
+from cybera_designate_sink_handler import dispatcher
+from cybera_designate_sink_handler import executor
+from cybera_designate_sink_handler import hostnames
+from cybera_designate_sink_handler import lookup
+from cybera_designate_sink_handler import metrics
+from cybera_designate_sink_handler import netbox_queue
+from cybera_designate_sink_handler import prefixes
+from cybera_designate_sink_handler import record_index
+from cybera_designate_sink_handler import recordsets
+from cybera_designate_sink_handler import tracing
+from cybera_designate_sink_handler import warmup
+from cybera_designate_sink_handler import zone_cache
+
+import functools
 import ipaddress
+import time
 
 LOG = logging.getLogger(__name__)
 
@@ -37,11 +50,81 @@ cfg.CONF.register_opts([
     cfg.StrOpt('netbox_api_key')
 ], group='handler:neutron_floating')
 
+cfg.CONF.register_opts(clients.client_opts + clients.netbox_opts +
+                       zone_cache.zone_cache_opts + batching.batching_opts +
+                       lookup.lookup_opts + hostnames.hostname_opts +
+                       netbox_queue.netbox_queue_opts + executor.executor_opts +
+                       metrics.metrics_opts + dedup.dedup_opts +
+                       recordsets.recordset_opts + breaker.breaker_opts +
+                       warmup.warmup_opts + capture.capture_opts +
+                       prefixes.prefix_opts + dispatcher.dispatcher_opts +
+                       record_index.record_index_opts + tracing.tracing_opts,
+                       group='handler:neutron_floating')
+
 
 class NeutronFloatingHandler(BaseAddressHandler):
     """Handler for Neutron's notifications"""
     __plugin_name__ = 'neutron_floating'
 
+    def __init__(self, *args, **kwargs):
+        start = time.monotonic()
+        super(NeutronFloatingHandler, self).__init__(*args, **kwargs)
+        self.zone_cache = zone_cache.ZoneCache(
+            self.get_zone, self._find_zones,
+            ttl=cfg.CONF[self.name].zone_cache_ttl)
+
+        self.dispatcher = None
+        if cfg.CONF[self.name].dispatch_workers > 1:
+            self.dispatcher = dispatcher.ShardedDispatcher(
+                self.name, self._process_notification, self._resource_key,
+                workers=cfg.CONF[self.name].dispatch_workers,
+                queue_size=cfg.CONF[self.name].dispatch_queue_size)
+
+        self.batcher = None
+        if cfg.CONF[self.name].batching:
+            self.batcher = batching.EventBatcher(
+                self._dispatch, self._resource_key,
+                max_latency=cfg.CONF[self.name].batch_max_latency,
+                max_size=cfg.CONF[self.name].batch_max_size)
+
+        self.runner = executor.OperationRunner(
+            cfg.CONF[self.name].event_workers)
+        metrics.configure(cfg.CONF[self.name])
+        breaker.configure(cfg.CONF[self.name])
+        self.dedup = dedup.get_deduplicator(self.name, cfg.CONF[self.name])
+        self.recorder = capture.get_recorder(cfg.CONF[self.name])
+        self.managed = prefixes.get_filter(cfg.CONF[self.name])
+        self.index = record_index.get_index(cfg.CONF[self.name])
+        self.tracer = tracing.get_tracer(cfg.CONF[self.name])
+        if self.index is not None and \
+                cfg.CONF[self.name].record_index_rebuild:
+            self.index.rebuild_in_background(
+                self.get_plugin_name(), self._managed_records)
+
+        lookup.instance_cache.ttl = cfg.CONF[self.name].instance_cache_ttl
+        lookup.instance_cache.max_entries = \
+            cfg.CONF[self.name].instance_cache_size
+        recordsets.state.ttl = cfg.CONF[self.name].recordset_cache_ttl
+        hostnames.resolver.max_entries = \
+            cfg.CONF[self.name].hostname_cache_size
+        hostnames.resolver.trust_metadata = \
+            cfg.CONF[self.name].hostname_from_metadata
+
+        if cfg.CONF[self.name].warm_up:
+            warmup.warm_up(self.name, self._warm_up_steps())
+        LOG.info('%s started in %.3fs', self.name, time.monotonic() - start)
+
+    def _warm_up_steps(self):
+        conf = cfg.CONF[self.name]
+        return [
+            ('keystone token',
+             lambda: clients.get_client_manager(self.name).nova),
+            ('zones', lambda: self.zone_cache.warm(
+                [conf.zone_id], conf.zone_owner_tenant_id)),
+            ('netbox prefix', lambda: clients.get_ip_handler(
+                self.name, 4, 71).prefix),
+        ]
+
     def get_exchange_topics(self):
         exchange = cfg.CONF[self.name].control_exchange
         topics = [topic for topic in cfg.CONF[self.name].notification_topics]
@@ -52,121 +135,213 @@ class NeutronFloatingHandler(BaseAddressHandler):
         return [
             'floatingip.update.end',
             'floatingip.delete.start',
-        ]
+        ] + zone_cache.ZONE_EVENT_TYPES
+
+    def _find_zones(self, criterion):
+        elevated_context = DesignateContext.get_admin_context(
+            all_tenants=True, edit_managed_records=True)
+        with metrics.timed('designate', 'find_zones'):
+            return self.central_api.find_zones(elevated_context, criterion)
+
+    def _resource_key(self, event_type, payload):
+        if 'floatingip_id' in payload:
+            return payload['floatingip_id']
+        return payload.get('floatingip', {}).get('id')
+
+    def _fingerprint(self, event_type, payload):
+        floatingip = payload.get('floatingip', {})
+        return dedup.fingerprint(event_type, [
+            floatingip.get('floating_ip_address'),
+            floatingip.get('fixed_ip_address'),
+            floatingip.get('port_id'),
+        ])
+
+    def _is_managed(self, event_type, payload):
+        if not self.managed.enabled or 'floatingip' not in payload:
+            # Deletes only carry the floating IP id
+            return True
+        return self.managed.floating_ip(payload['floatingip'])
 
     def process_notification(self, context, event_type, payload):
+        if self.recorder is not None:
+            self.recorder.record(self.name, event_type, context, payload)
+
+        # Events about unmanaged addresses go no further
+        if event_type not in zone_cache.ZONE_EVENT_TYPES and \
+                not self._is_managed(event_type, payload):
+            self.managed.drop(self.name, event_type,
+                              self._resource_key(event_type, payload))
+            return
+
+        if self.batcher is not None and \
+                event_type not in zone_cache.ZONE_EVENT_TYPES:
+            self.batcher.submit(context, event_type, payload)
+            return
+
+        # Zone events only invalidate caches and are handled right away
+        if event_type in zone_cache.ZONE_EVENT_TYPES:
+            self._process_notification(context, event_type, payload)
+            return
+
+        self._dispatch(context, event_type, payload)
+
+    def _dispatch(self, context, event_type, payload):
+        if self.dispatcher is not None:
+            self.dispatcher.submit(context, event_type, payload)
+            return
+
+        self._process_notification(context, event_type, payload)
+
+    def get_zone(self, zone_id):
+        with metrics.timed('designate', 'get_zone'):
+            return super(NeutronFloatingHandler, self).get_zone(zone_id)
+
+    def _create_or_update_recordset(self, context, records, zone_id, name,
+                                    type, ttl=None):
+        # Only writes that change something reach central
+        with metrics.timed('designate', 'create_or_update_recordset'):
+            recordset = recordsets.state.write(self.central_api, context,
+                                               records, zone_id, name, type,
+                                               ttl)
+        if recordset is not None and self.index is not None:
+            self.index.add(self.get_plugin_name(), zone_id, recordset)
+        return recordset
+
+    def _delete(self, *args, **kwargs):
+        recordsets.state.forget(kwargs.get('resource_id'))
+        if self.index is not None:
+            self.index.discard(self.get_plugin_name(),
+                               kwargs.get('resource_id'))
+        with metrics.timed('designate', 'delete'):
+            return super(NeutronFloatingHandler, self)._delete(*args, **kwargs)
+
+    def _managed_records(self):
+        context = DesignateContext.get_admin_context(
+            all_tenants=True, edit_managed_records=True)
+        return record_index.managed_records(
+            self.central_api, context, self.get_plugin_name(),
+            cfg.CONF[self.name].record_index_page_size)
+
+    def _indexed(self, resource_id):
+        """Return the index entry of a resource, or None if Designate
+        has to be searched for its records.
+        """
+        if self.index is None:
+            return None
+        return self.index.lookup(self.get_plugin_name(), resource_id)
+
+    def _delete_indexed(self, resource_id, entry):
+        """Delete the records of an index entry by id.
+
+        Returns False if the entry was out of date, and Designate still
+        has to be searched.
+        """
+        recordsets.state.forget(resource_id)
+        deleted = record_index.delete_records(self.central_api, entry)
+        self.index.discard(self.get_plugin_name(), resource_id)
+        return deleted
+
+    def _process_notification(self, context, event_type, payload):
+        # Checked here, where events for a resource are applied one after
+        # another, so nothing still queued can change the last one applied
+        if event_type not in zone_cache.ZONE_EVENT_TYPES and \
+                self.dedup.is_duplicate(
+                    self._resource_key(event_type, payload),
+                    self._fingerprint(event_type, payload)):
+            return
+
+        with tracing.event(self.tracer, self.name, event_type,
+                           self._resource_key(event_type, payload)), \
+                metrics.event(self.name, event_type):
+            self._handle_notification(context, event_type, payload)
+
+        if event_type not in zone_cache.ZONE_EVENT_TYPES:
+            self.dedup.applied(self._resource_key(event_type, payload),
+                               self._fingerprint(event_type, payload))
+
+    def _handle_notification(self, context, event_type, payload):
         LOG.debug('NeutronFloatingHandler: Event type received: %s', event_type)
         LOG.debug('NeutronFloatingHandler: Event body received: %s', payload)
+        if event_type in zone_cache.ZONE_EVENT_TYPES:
+            self.zone_cache.invalidate(payload.get('id'))
+            recordsets.state.invalidate_zone(payload.get('id'))
+            return
+
         zone_id = cfg.CONF[self.name].zone_id
-        zone = self.get_zone(zone_id)
+        zone = self.zone_cache.get_zone(zone_id)
 
-        # Get a list all all zones owned by the zone tenant owner.
-        # This is so we can find the reverse DNS zone.
         elevated_context = DesignateContext.get_admin_context(
             all_tenants=True, edit_managed_records=True)
 
-        criterion = {
-            "tenant_id": cfg.CONF[self.name].zone_owner_tenant_id,
-        }
-
-        zones = self.central_api.find_zones(elevated_context, criterion)
-
-        # Keystone auth
-        username = cfg.CONF[self.name].admin_user
-        password = cfg.CONF[self.name].admin_password
-        tenant_name = cfg.CONF[self.name].admin_tenant_name
-        auth_url = cfg.CONF[self.name].auth_url
-        auth = v3.Password(username=username, password=password,
-                           project_name=tenant_name, project_domain_name='default',
-                           user_domain_name='default', auth_url=auth_url)
-        sess = session.Session(auth=auth)
-        nvc = nova_c.Client(2.1, session=sess)
-
-        # IP address
-        floatingip = payload['floatingip']['floating_ip_address']
-        v4address = ipaddress.ip_address(floatingip)
-
-        # DNS name
-        search_opts = {
-            'ip': payload['floatingip']['fixed_ip_address'],
-            'status': 'ACTIVE',
-            'all_tenants': True,
-            'tenant_id': payload['floatingip']['tenant_id'],
-        }
-        instances = nvc.servers.list(detailed=True, search_opts=search_opts)
-        instance = instances[0]
-        ec2id = getattr(instance, 'OS-EXT-SRV-ATTR:instance_name')
-        ec2id = ec2id.split('-', 1)[1].lstrip('0')
+        # Instances are only looked up in Nova on paths that need them
+        nova_lookup = lookup.InstanceLookup(
+            lambda: clients.get_client_manager(self.name).nova)
 
         # For netbox updating
-        ip_handler_address = v4address
-        ip_handler_dns = '%s.%s' % (ec2id, zone['name'])
         ip_handler_project = context['project_name']
 
         prefix_id = 71  # int(cfg.CONF[self.name].floating_ip_prefix_id)
-        netbox_api_key = str(cfg.CONF[self.name].netbox_api_key)
 
         try:
-            ip_handler = IPHandler(
-                ip_ver=4,
-                netbox_api_key=netbox_api_key,
-                floating_ip_prefix_id=prefix_id
-            )
+            netbox = clients.get_netbox_queue(self.name, 4, prefix_id)
         except Exception as e:
             LOG.warning("ip handler was not initialized {0}".format(e))
 
         if event_type.startswith('floatingip.delete'):
-            self._delete(zone_id=zone_id,
-                         resource_id=payload['floatingip_id'],
-                         resource_type='instance')
+            # Neutron only sends the id, the index knows the address
+            fip_id = payload['floatingip_id']
+            entry = self._indexed(fip_id)
+            if entry is None or not self._delete_indexed(fip_id, entry):
+                self._delete(zone_id=zone_id,
+                             resource_id=fip_id,
+                             resource_type='instance')
+            if entry is not None:
+                addresses = sorted(entry.addresses)
+            else:
+                address = payload.get('floatingip', {}).get(
+                    'floating_ip_address')
+                addresses = [address] if address else []
 
-            try:
-                LOG.debug(
-                    'Fetching netbox IP entry for %s' %
-                    (ip_handler_address)
-                )
-                nb_ip = ip_handler.get_ip(str(ip_handler_address))
+            if not addresses:
+                LOG.debug('Address of floating ip %s is unknown, leaving '
+                          'netbox alone', fip_id)
+                return
 
+            try:
                 LOG.debug(
-                    'Unassigning IP address in netbox - IP: "%s" DNS: "%s" PROJECT: "%s"' %
-                    (ip_handler_address, ip_handler_dns, ip_handler_project)
+                    'Unassigning IP address in netbox - IP: "%s" PROJECT: "%s"' %
+                    (', '.join(addresses), ip_handler_project)
                 )
-
-                ip_handler.unassign_ip(nb_ip)
+                netbox.unassign(addresses)
 
             except Exception as e:
                 LOG.warning(
                     "v4 address unassignment in netbox failed: {0}".format(e))
 
         elif event_type.startswith('floatingip.update'):
+            # IP address
+            floatingip = payload['floatingip']['floating_ip_address']
+            v4address = ipaddress.ip_address(floatingip)
+            ip_handler_address = v4address
+
             # Calculate Reverse Address
             reverse_address = v4address.reverse_pointer + '.'
-            reverse_network = '.'.join(reverse_address.split('.')[1:])
-            reverse_id = None
 
-            # Loop through all zones and see if one matches the reverse zone
-            reverse_id = None
-            for i in zones:
-                if i.name == reverse_network:
-                    reverse_id = i.id
+            # Find the closest reverse zone owned by the zone tenant owner
+            reverse_id, reverse_address = self.zone_cache.find_reverse_zone(
+                reverse_address, cfg.CONF[self.name].zone_owner_tenant_id)
 
             if payload['floatingip']['fixed_ip_address']:
                 # Search for an instance with the matching fixed ip
-                search_opts = {
-                    'ip': payload['floatingip']['fixed_ip_address'],
-                    'status': 'ACTIVE',
-                    'all_tenants': True,
-                    'tenant_id': payload['floatingip']['tenant_id'],
-                }
-                instances = nvc.servers.list(
-                    detailed=True, search_opts=search_opts)
-
-                if len(instances) == 1:
-                    instance = instances[0]
-                    # Get the ec2 id of the instance and build the hostname from it
-                    ec2id = getattr(instance, 'OS-EXT-SRV-ATTR:instance_name')
-                    ec2id = ec2id.split('-', 1)[1].lstrip('0')
-                    hostname = '%s.%s' % (ec2id, zone['name'])
+                found = hostnames.resolver.resolve_fixed_ip(
+                    payload['floatingip']['fixed_ip_address'],
+                    payload['floatingip']['tenant_id'],
+                    zone['name'], nova_lookup)
+
+                if found is not None:
+                    # The hostname is built from the ec2 id of the instance
+                    instance_id, hostname = found
+                    ip_handler_dns = hostname
 
                     # create a recordset
                     record_type = 'A'
@@ -183,15 +358,18 @@ class NeutronFloatingHandler(BaseAddressHandler):
                         'managed_plugin_type': self.get_plugin_type(),
                         'managed_resource_type': 'instance',
                         'managed_resource_id': payload['floatingip']['id'],
-                        'managed_extra': 'instance:%s' % (getattr(instance, 'id')),
+                        'managed_extra': 'instance:%s' % (instance_id),
                     }
 
                     LOG.debug('NeutronFloatingHandler Creating record in %s / %s with values %r' %
                               (zone_id, hostname, record_values))
-                    recordset = self._create_or_update_recordset(
-                        elevated_context,
-                        [Record(**record_values)],
-                        **recordset_values)
+                    # The forward and reverse writes may run concurrently
+                    operations = [(
+                        'A %s' % hostname,
+                        functools.partial(self._create_or_update_recordset,
+                                          elevated_context,
+                                          [Record(**record_values)],
+                                          **recordset_values))]
 
                     # create a reverse recordset
                     record_type = 'PTR'
@@ -214,32 +392,30 @@ class NeutronFloatingHandler(BaseAddressHandler):
                             'managed_plugin_type': self.get_plugin_type(),
                             'managed_resource_type': 'instance',
                             'managed_resource_id': payload['floatingip']['id'],
-                            'managed_extra': 'instance:%s' % (getattr(instance, 'id')),
+                            'managed_extra': 'instance:%s' % (instance_id),
                         }
 
                         LOG.debug('NeutronFloatingHandler Creating PTR record in %s / %s with values %r' %
                                   (reverse_id, reverse_address, record_values))
 
-                        recordset = self._create_or_update_recordset(
-                            elevated_context,
-                            [Record(**record_values)],
-                            **recordset_values)
+                        operations.append((
+                            'PTR %s' % reverse_address,
+                            functools.partial(self._create_or_update_recordset,
+                                              elevated_context,
+                                              [Record(**record_values)],
+                                              **recordset_values)))
 
-                        try:
-                            # Get netbox ip object, will create one if it's not found
-                            LOG.debug(
-                                'Fetching netbox IP entry for %s' %
-                                (ip_handler_address)
-                            )
-                            nb_ip = ip_handler.get_ip(str(ip_handler_address))
+                    self.runner.run(operations)
 
+                    if reverse_id is not None:
+                        try:
                             LOG.debug(
                                 'Updating netbox with IP address assignment - IP: "%s" DNS: "%s" PROJECT: "%s"' %
                                 (ip_handler_address,
                                  ip_handler_dns, ip_handler_project)
                             )
-                            ip_handler.assign_ip(
-                                nb_ip, ip_handler_dns, ip_handler_project)
+                            netbox.assign([ip_handler_address],
+                                          ip_handler_dns, ip_handler_project)
 
                         except Exception as e:
                             LOG.warning(
@@ -247,35 +423,33 @@ class NeutronFloatingHandler(BaseAddressHandler):
                             # LOG.warning("v4 address update in netbox failed: {0}".format(payload.__dict__))
 
             else:
-                LOG.debug('Deleting records for %s / %s' %
-                          (zone_id, payload['floatingip']['id']))
-                self._delete(
-                    zone_id=zone_id, resource_id=payload['floatingip']['id'], resource_type='instance')
+                def delete_records(zone_id):
+                    LOG.debug('Deleting records for %s / %s' %
+                              (zone_id, payload['floatingip']['id']))
+                    self._delete(
+                        zone_id=zone_id, resource_id=payload['floatingip']['id'], resource_type='instance')
+
+                entry = self._indexed(payload['floatingip']['id'])
+                if entry is None or not self._delete_indexed(
+                        payload['floatingip']['id'], entry):
+                    # The forward and reverse deletes may run concurrently
+                    operations = [('delete forward records',
+                                   lambda: delete_records(zone_id))]
+                    if reverse_id == None:
+                        LOG.debug('UNABLE TO DETERMINE REVERSE ZONE: %s',
+                                  payload['floatingip'])
+                    else:
+                        operations.append(('delete reverse records',
+                                           lambda: delete_records(reverse_id)))
+                    self.runner.run(operations)
 
                 try:
                     LOG.debug(
-                        'Fetching netbox IP entry for %s' %
-                        (ip_handler_address)
-                    )
-                    nb_ip = ip_handler.get_ip(str(ip_handler_address))
-
-                    LOG.debug(
-                        'Unassigning IP address in netbox - IP: "%s" DNS: "%s" PROJECT: "%s"' %
-                        (ip_handler_address, ip_handler_dns, ip_handler_project)
+                        'Unassigning IP address in netbox - IP: "%s" PROJECT: "%s"' %
+                        (ip_handler_address, ip_handler_project)
                     )
-
-                    ip_handler.unassign_ip(nb_ip)
+                    netbox.unassign([ip_handler_address])
 
                 except Exception as e:
                     LOG.warning(
                         "v4 address unassignment in netbox failed: {0}".format(e))
-
-                if reverse_id == None:
-                    LOG.debug('UNABLE TO DETERMINE REVERSE ZONE: %s',
-                              payload['floatingip'])
-                else:
-                    LOG.debug('Deleting records for %s / %s' %
-                              (reverse_id, payload['floatingip']['id']))
-                    self._delete(zone_id=reverse_id,
-                                 resource_id=payload['floatingip']['id'],
-                                 resource_type='instance')
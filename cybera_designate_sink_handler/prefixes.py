@@ -0,0 +1,105 @@
+# Early filtering of events about addresses the sink doesn't manage
+
+import ipaddress
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from cybera_designate_sink_handler import metrics
+
+LOG = logging.getLogger(__name__)
+
+prefix_opts = [
+    cfg.ListOpt('managed-prefixes', default=[],
+                help='IPv4 and IPv6 prefixes records are managed for. '
+                     'Events only about addresses outside them are dropped '
+                     'before any API call. Empty manages every address'),
+    cfg.ListOpt('managed-networks', default=[],
+                help='Neutron network ids, or Nova network labels, records '
+                     'are managed for. Empty manages every network'),
+]
+
+
+class PrefixIndex(object):
+    """Fast membership test for a set of networks.
+
+    Networks are stored as sets of their network address shifted right
+    by the host bits, one set per prefix length, so a lookup is one
+    shift and set probe per distinct prefix length configured.
+    """
+
+    def __init__(self, networks=()):
+        self._index = {4: {}, 6: {}}
+        for network in networks:
+            network = ipaddress.ip_network(str(network).strip(),
+                                           strict=False)
+            host_bits = network.max_prefixlen - network.prefixlen
+            self._index[network.version].setdefault(host_bits, set()).add(
+                int(network.network_address) >> host_bits)
+        self._lengths = dict((version, sorted(index.items()))
+                             for version, index in self._index.items())
+
+    def __bool__(self):
+        return any(self._index.values())
+
+    def __contains__(self, address):
+        try:
+            address = ipaddress.ip_address(str(address).split('/')[0])
+        except ValueError:
+            return False
+        value = int(address)
+        for host_bits, networks in self._lengths[address.version]:
+            if value >> host_bits in networks:
+                return True
+        return False
+
+
+class ManagedFilter(object):
+    """Decides whether an address or network is one the sink manages.
+
+    With no prefixes or networks configured everything is managed and
+    ``enabled`` is False.
+    """
+
+    def __init__(self, prefixes=(), networks=()):
+        self.prefixes = PrefixIndex(prefixes)
+        self.networks = frozenset(network.strip() for network in networks)
+        self.enabled = bool(self.prefixes) or bool(self.networks)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def address(self, address, networks=()):
+        """Whether an address, on any of ``networks``, is managed.
+
+        Networks are only checked when the payload names any.
+        """
+        if self.prefixes and address not in self.prefixes:
+            return False
+        known = [network for network in networks if network]
+        if self.networks and known and \
+                not self.networks.intersection(known):
+            return False
+        return True
+
+    def fixed_ip(self, fixed_ip):
+        """Whether a fixed IP of a compute payload is managed."""
+        return self.address(fixed_ip.get('address'),
+                            (fixed_ip.get('network_id'),
+                             fixed_ip.get('label')))
+
+    def floating_ip(self, floatingip):
+        """Whether the floating IP of a Neutron payload is managed."""
+        return self.address(floatingip.get('floating_ip_address'),
+                            (floatingip.get('floating_network_id'),))
+
+    def drop(self, handler, event_type, resource):
+        with self._lock:
+            self.dropped += 1
+        metrics.filtered(handler, event_type)
+        LOG.debug('Dropped %s for %s, it concerns nothing managed (%d '
+                  'dropped)', event_type, resource, self.dropped)
+
+
+def get_filter(conf):
+    return ManagedFilter(conf.managed_prefixes, conf.managed_networks)
@@ -0,0 +1,476 @@
+# cybera-sink-reconcile: repair drift between Designate, Nova, Neutron and
+# NetBox
+
+import argparse
+import collections
+import functools
+import ipaddress
+import sys
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from designate import rpc
+from designate.context import DesignateContext
+from keystoneauth1 import adapter
+from keystoneclient.v3 import client as keystone_c
+
+from cybera_designate_sink_handler import clients
+from cybera_designate_sink_handler import executor
+from cybera_designate_sink_handler import hostnames
+from cybera_designate_sink_handler import record_index
+from cybera_designate_sink_handler.neutronfloatinghandler import \
+    NeutronFloatingHandler
+from cybera_designate_sink_handler.v6handler import NovaFixedV6Handler
+
+LOG = logging.getLogger(__name__)
+
+V6_GROUP = 'handler:nova_fixed_v6'
+FLOATING_GROUP = 'handler:neutron_floating'
+FLOATING_PREFIX_ID = 71
+
+# Largest group of addresses sent to NetBox in one request
+NETBOX_BATCH_SIZE = 100
+
+# A change to make, and a description of it for dry runs and logs
+Fix = collections.namedtuple('Fix', ['kind', 'description', 'apply'])
+
+
+def servers(nova, page_size, marker=None):
+    """Yield every instance in every project, a page at a time, starting
+    after ``marker`` if given.
+    """
+    while True:
+        page = nova.servers.list(detailed=True,
+                                 search_opts={'all_tenants': True},
+                                 marker=marker, limit=page_size)
+        for server in page:
+            yield server
+        if len(page) < page_size:
+            return
+        marker = page[-1].id
+
+
+def floating_ips(network, page_size, marker=None):
+    """Yield every Neutron floating IP, a page at a time, starting after
+    ``marker`` if given.
+    """
+    params = {
+        'limit': page_size,
+        'fields': ['id', 'floating_ip_address', 'fixed_ip_address',
+                   'floating_network_id', 'tenant_id'],
+    }
+    if marker is not None:
+        params['marker'] = marker
+    while True:
+        page = network.get('/v2.0/floatingips',
+                           params=params).json()['floatingips']
+        for floatingip in page:
+            yield floatingip
+        if len(page) < page_size:
+            return
+        params['marker'] = page[-1]['id']
+
+
+def netbox_addresses(ip_handler, page_size):
+    """Yield the NetBox addresses in the handler's prefix.
+
+    pynetbox fetches the pages lazily as the result is iterated.
+    """
+    return ip_handler.nb.ipam.ip_addresses.filter(prefix=ip_handler.prefix,
+                                                  limit=page_size)
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _description(assignment):
+    return "{0} ({1})".format(*assignment)
+
+
+class Reconciler(object):
+    """Finds and repairs drift for both sink handlers.
+
+    Designate's managed records are indexed by resource id first, then
+    Nova and Neutron are streamed past the index, so memory grows with
+    the number of managed resources rather than with page sizes or API
+    responses. Whatever is left in an index afterwards belongs to
+    resources that no longer exist.
+
+    Missing records are repaired by replaying the notification the
+    handler would have received, so the repair follows the same code
+    path as normal processing.
+    """
+
+    def __init__(self, v6_handler, floating_handler, manager, page_size=1000,
+                 netbox=True):
+        self.v6_handler = v6_handler
+        self.floating_handler = floating_handler
+        self.manager = manager
+        self.page_size = page_size
+        self.netbox = netbox
+        self.context = DesignateContext.get_admin_context(
+            all_tenants=True, edit_managed_records=True)
+
+        self.projects = {}
+        # (fixed_ip, tenant_id) -> instance_id and instance_id -> ec2id,
+        # filled by instances() for the floating IP checks
+        self.instance_by_ip = {}
+        self.ec2ids = {}
+
+    def load_projects(self):
+        keystone = keystone_c.Client(session=self.manager.session)
+        self.projects = dict((project.id, project.name)
+                             for project in keystone.projects.list())
+        LOG.info('Loaded %d projects', len(self.projects))
+
+    def _index(self, handler, forward_zone_id):
+        """Index a plugin's records by resource id.
+
+        Each entry holds the zones the records are in, the forward record
+        data, the managed_extra values and the number of reverse records.
+        """
+        index = {}
+        for record in record_index.managed_records(
+                handler.central_api, self.context, handler.get_plugin_name(),
+                self.page_size):
+            entry = index.get(record['managed_resource_id'])
+            if entry is None:
+                entry = index[record['managed_resource_id']] = \
+                    [set(), set(), set(), 0]
+            entry[0].add(record['zone_id'])
+            if record['zone_id'] == forward_zone_id:
+                entry[1].add(record['data'])
+                entry[2].add(record['managed_extra'])
+            else:
+                entry[3] += 1
+        LOG.info('Indexed records of %d %s resources', len(index),
+                 handler.get_plugin_name())
+        return index
+
+    def _delete_fix(self, handler, resource_id, zone_ids, reason):
+        def apply():
+            for zone_id in zone_ids:
+                handler._delete(zone_id=zone_id, resource_id=resource_id,
+                                resource_type='instance')
+        return Fix('delete', '%s: delete records of %s (%s)' % (
+            handler.get_plugin_name(), resource_id, reason), apply)
+
+    def _replay_fix(self, handler, resource_id, project_id, event_type,
+                    payload, reason):
+        context = {'project_id': project_id,
+                   'project_name': self.projects.get(project_id,
+                                                     project_id)}
+        return Fix('replay', '%s: replay %s for %s (%s)' % (
+            handler.get_plugin_name(), event_type, resource_id, reason),
+            functools.partial(handler._process_notification, context,
+                              event_type, payload))
+
+    def instances(self, marker=None):
+        """Stream Nova, remembering every instance's name and fixed IPs.
+
+        Yields ``(server, instance_name, fixed_addresses)`` tuples.
+        """
+        for server in servers(self.manager.nova, self.page_size, marker):
+            instance_name = getattr(server, 'OS-EXT-SRV-ATTR:instance_name')
+            ec2id = hostnames.ec2id_from_name(instance_name)
+            addresses = [dict(address, label=label)
+                         for label, network in server.addresses.items()
+                         for address in network
+                         if address.get('OS-EXT-IPS:type') != 'floating']
+            fixed_ips = [address['addr'] for address in addresses]
+
+            self.ec2ids[server.id] = ec2id
+            for fixed_ip in fixed_ips:
+                self.instance_by_ip[(fixed_ip, server.tenant_id)] = server.id
+            # Lets replayed events name instances without asking Nova
+            hostnames.resolver.remember(server.id, ec2id, fixed_ips,
+                                        server.tenant_id)
+            yield server, instance_name, addresses
+
+    def v6_fixes(self):
+        """Compare fixed v6 records and NetBox entries against Nova."""
+        handler = self.v6_handler
+        conf = cfg.CONF[V6_GROUP]
+        zone = handler.zone_cache.get_zone(conf.zone_id)
+        index = self._index(handler, zone['id'])
+
+        ip_handler = None
+        if self.netbox:
+            ip_handler = clients.get_ip_handler(
+                V6_GROUP, 6, int(conf.floating_ip_prefix_id))
+
+        for page in chunks(self.instances(), self.page_size):
+            # v6 address -> expected (project, dns) in NetBox
+            expected = {}
+            for server, instance_name, addresses in page:
+                v6_addresses = [address['addr'] for address in addresses
+                                if address['version'] == 6 and
+                                handler.managed.fixed_ip(
+                                    {'address': address['addr'],
+                                     'label': address['label']})]
+
+                entry = index.pop(server.id, None)
+                if not v6_addresses:
+                    if entry is not None:
+                        yield self._delete_fix(handler, server.id, entry[0],
+                                               'instance has no v6 address')
+                    continue
+
+                hostname = '%s.%s' % (self.ec2ids[server.id], zone['name'])
+                if entry is None or entry[1] != set(v6_addresses) or \
+                        entry[3] != len(v6_addresses):
+                    yield self._replay_fix(
+                        handler, server.id, server.tenant_id,
+                        'compute.instance.create.end',
+                        {'instance_id': server.id,
+                         'instance_name': instance_name,
+                         'tenant_id': server.tenant_id,
+                         'fixed_ips': [{'address': address['addr'],
+                                        'version': address['version'],
+                                        'label': address['label']}
+                                       for address in addresses]},
+                        'records missing or out of date')
+                    continue
+
+                project = self.projects.get(server.tenant_id,
+                                            server.tenant_id)
+                for address in v6_addresses:
+                    expected[str(ipaddress.ip_address(address))] = \
+                        (project, hostname)
+
+            if ip_handler is not None and expected:
+                for fix in self._v6_netbox_fixes(ip_handler, expected):
+                    yield fix
+
+        for instance_id, entry in index.items():
+            yield self._delete_fix(handler, instance_id, entry[0],
+                                   'instance no longer exists')
+
+    def _v6_netbox_fixes(self, ip_handler, expected):
+        """Fix v6 NetBox entries that are missing or describe the wrong
+        instance.
+        """
+        for addresses in chunks(sorted(expected), NETBOX_BATCH_SIZE):
+            found = ip_handler.get_ips(addresses)
+            groups = collections.defaultdict(list)
+            for address in addresses:
+                ip = found.get(address)
+                if ip is None or \
+                        ip.description != _description(expected[address]):
+                    groups[expected[address]].append(address)
+
+            for (project, dns), group in groups.items():
+                def apply(group=group, project=project, dns=dns):
+                    ips = ip_handler.ensure_ips(group, cached=False)
+                    ip_handler.assign_ips(ips.values(), dns, project)
+                yield Fix('netbox', 'netbox: assign %s to %s' % (
+                    ', '.join(group), _description((project, dns))), apply)
+
+    def floating_fixes(self):
+        """Compare floating IP records and NetBox entries against
+        Neutron. ``v6_fixes`` must have been consumed first so instances
+        are known.
+        """
+        handler = self.floating_handler
+        conf = cfg.CONF[FLOATING_GROUP]
+        zone = handler.zone_cache.get_zone(conf.zone_id)
+        index = self._index(handler, zone['id'])
+        network = adapter.Adapter(self.manager.session,
+                                  service_type='network')
+
+        # floating address -> expected (project, dns) in NetBox, for
+        # associated floating IPs only
+        assigned = {}
+        managed = set()
+        replayed = set()
+        for floatingip in floating_ips(network, self.page_size):
+            fip_id = floatingip['id']
+            address = floatingip['floating_ip_address']
+            entry = index.pop(fip_id, None)
+            if not handler.managed.floating_ip(floatingip):
+                continue
+            managed.add(address)
+
+            instance_id = None
+            if floatingip['fixed_ip_address']:
+                instance_id = self.instance_by_ip.get(
+                    (floatingip['fixed_ip_address'],
+                     floatingip['tenant_id']))
+
+            if instance_id is None:
+                if entry is not None:
+                    yield self._delete_fix(handler, fip_id, entry[0],
+                                           'floating ip not associated')
+                continue
+
+            hostname = '%s.%s' % (self.ec2ids[instance_id], zone['name'])
+            assigned[address] = (
+                self.projects.get(floatingip['tenant_id'],
+                                  floatingip['tenant_id']), hostname)
+
+            reverse_id, _ = handler.zone_cache.find_reverse_zone(
+                ipaddress.ip_address(address).reverse_pointer + '.',
+                conf.zone_owner_tenant_id)
+            if entry is None or entry[1] != set([address]) or \
+                    entry[2] != set(['instance:%s' % instance_id]) or \
+                    (reverse_id is not None and entry[3] != 1):
+                replayed.add(address)
+                yield self._replay_fix(
+                    handler, fip_id, floatingip['tenant_id'],
+                    'floatingip.update.end', {'floatingip': floatingip},
+                    'records missing or out of date')
+
+        for fip_id, entry in index.items():
+            yield self._delete_fix(handler, fip_id, entry[0],
+                                   'floating ip no longer exists')
+
+        if self.netbox:
+            ip_handler = clients.get_ip_handler(FLOATING_GROUP, 4,
+                                                FLOATING_PREFIX_ID)
+            for fix in self._v4_netbox_fixes(ip_handler, managed, assigned,
+                                             replayed):
+                yield fix
+
+    def _v4_netbox_fixes(self, ip_handler, managed, assigned, replayed):
+        """Fix floating addresses in the NetBox prefix whose description
+        doesn't match their association in Neutron.
+
+        Only addresses of managed Neutron floating IPs are touched, other
+        entries in the prefix belong to someone else.
+        """
+        stale = []
+        wrong = collections.defaultdict(list)
+        for ip in netbox_addresses(ip_handler, self.page_size):
+            address = ip_handler._host(ip)
+            if address in replayed or address not in managed:
+                continue
+            if address in assigned:
+                if ip.description != _description(assigned[address]):
+                    wrong[assigned[address]].append(ip)
+            elif ip.description != 'Floating IP':
+                stale.append(ip)
+
+        for group in chunks(stale, NETBOX_BATCH_SIZE):
+            yield Fix('netbox', 'netbox: unassign %s' % ', '.join(
+                ip_handler._host(ip) for ip in group),
+                functools.partial(ip_handler.unassign_ips, group))
+
+        for (project, dns), ips in wrong.items():
+            for group in chunks(ips, NETBOX_BATCH_SIZE):
+                yield Fix('netbox', 'netbox: assign %s to %s' % (
+                    ', '.join(ip_handler._host(ip) for ip in group),
+                    _description((project, dns))),
+                    functools.partial(ip_handler.assign_ips, group, dns,
+                                      project))
+
+
+def apply_fixes(fixes, runner, batch_size, dry_run, out):
+    """Apply fixes in batches, returning counts by kind and errors."""
+    counts = collections.Counter()
+
+    def attempt(fix):
+        try:
+            fix.apply()
+        except Exception as e:
+            LOG.warning('Fix failed: {0}: {1}'.format(fix.description, e))
+            counts['errors'] += 1
+
+    for batch in chunks(fixes, batch_size):
+        for fix in batch:
+            counts[fix.kind] += 1
+            if dry_run:
+                out.write('would %s\n' % fix.description)
+        if not dry_run:
+            runner.run([(fix.description, functools.partial(attempt, fix))
+                        for fix in batch])
+    return counts
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Repair drift between the records managed by the sink '
+                    'handlers, Nova, Neutron and NetBox.')
+    parser.add_argument('--config-file', action='append',
+                        help='Designate configuration with the handler '
+                             'sections. May be given more than once')
+    parser.add_argument('--handler', choices=['v6', 'floating', 'both'],
+                        default='both')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only print the changes that would be made')
+    parser.add_argument('--no-netbox', action='store_true',
+                        help="Don't check or change NetBox")
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Fixes applied at once')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='Fixes gathered before they are applied')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='Items requested per page from each service')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.register_options(cfg.CONF)
+    cfg.CONF(args=[], project='designate',
+             default_config_files=args.config_file)
+    logging.setup(cfg.CONF, 'cybera-sink-reconcile')
+
+    # Repairs are applied and checked as they go
+    for group in (V6_GROUP, FLOATING_GROUP):
+        cfg.CONF.set_override('batching', False, group=group)
+        cfg.CONF.set_override('netbox_async', False, group=group)
+        # A replay repeats the event that left the records wrong, which
+        # the sink's dedup store may still hold as applied
+        cfg.CONF.set_override('dedup_window', 0, group=group)
+        # The sink rebuilds its own index, changes made here are kept in it
+        cfg.CONF.set_override('record_index_rebuild', False, group=group)
+
+    rpc.init(cfg.CONF)
+    v6_handler = NovaFixedV6Handler()
+    floating_handler = NeutronFloatingHandler()
+    manager = clients.get_client_manager(V6_GROUP)
+
+    reconciler = Reconciler(v6_handler, floating_handler, manager,
+                            page_size=args.page_size,
+                            netbox=not args.no_netbox)
+    # Keep every instance seen so replays never need to ask Nova
+    hostnames.resolver.max_entries = sys.maxsize
+    reconciler.load_projects()
+
+    runner = executor.OperationRunner(args.workers)
+    start = time.monotonic()
+
+    if args.handler in ('v6', 'both'):
+        counts = apply_fixes(reconciler.v6_fixes(), runner, args.batch_size,
+                             args.dry_run, sys.stdout)
+    else:
+        # Floating IPs are matched to instances through Nova
+        collections.deque(reconciler.instances(), maxlen=0)
+        counts = collections.Counter()
+
+    if args.handler in ('floating', 'both'):
+        counts.update(apply_fixes(reconciler.floating_fixes(), runner,
+                                  args.batch_size, args.dry_run,
+                                  sys.stdout))
+
+    sys.stdout.write('%s %d deletes, %d replays and %d NetBox fixes in '
+                     '%.1fs, %d failed\n' % (
+                         'Found' if args.dry_run else 'Applied',
+                         counts['delete'], counts['replay'],
+                         counts['netbox'], time.monotonic() - start,
+                         counts['errors']))
+    return 1 if counts['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,305 @@
+# Local index of the records and addresses each resource owns
+
+import ipaddress
+import json
+import sqlite3
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from designate import exceptions
+from designate import objects
+from designate.context import DesignateContext
+
+from cybera_designate_sink_handler import metrics
+
+LOG = logging.getLogger(__name__)
+
+record_index_opts = [
+    cfg.StrOpt('record-index',
+               help='SQLite file recording the records and NetBox '
+                    'addresses of each instance and floating IP, so deletes '
+                    'need no searches. Shared by both handlers'),
+    cfg.BoolOpt('record-index-rebuild', default=True,
+                help='Rebuild the record index from Designate in the '
+                     'background when the handler starts'),
+    cfg.IntOpt('record-index-page-size', default=1000,
+               help='Records fetched per request while rebuilding the '
+                    'record index'),
+]
+
+
+def _value(record, name):
+    if isinstance(record, dict):
+        return record.get(name)
+    if hasattr(record, 'obj_attr_is_set') and not record.obj_attr_is_set(
+            name):
+        return None
+    return getattr(record, name, None)
+
+
+def _address(data):
+    """The address held by an A or AAAA record, or None for a PTR."""
+    try:
+        return str(ipaddress.ip_address(data))
+    except ValueError:
+        return None
+
+
+def _instance_id(extra):
+    if extra and extra.startswith('instance:'):
+        return extra.split(':', 1)[1]
+    return None
+
+
+def managed_records(central, context, plugin_name, page_size):
+    """Yield every record managed by a sink plugin, a page at a time."""
+    criterion = {'managed': True, 'managed_plugin_name': plugin_name}
+    marker = None
+    while True:
+        page = central.find_records(context, criterion, marker=marker,
+                                    limit=page_size, sort_key='id',
+                                    sort_dir='asc')
+        for record in page:
+            yield record
+        if len(page) < page_size:
+            return
+        marker = page[-1]['id']
+
+
+class Entry(object):
+    """What one instance or floating IP owns.
+
+    ``records`` holds ``(zone_id, recordset_id, record_id)`` tuples and
+    ``addresses`` the addresses of its forward records, which are the
+    ones registered in NetBox.
+    """
+
+    __slots__ = ('records', 'addresses', 'instance_id')
+
+    def __init__(self, records=(), addresses=(), instance_id=None):
+        self.records = set(tuple(record) for record in records)
+        self.addresses = set(addresses)
+        self.instance_id = instance_id
+
+    def add(self, record, zone_id, recordset_id):
+        self.records.add((zone_id, recordset_id, _value(record, 'id')))
+        address = _address(_value(record, 'data'))
+        if address is not None:
+            self.addresses.add(address)
+        instance_id = _instance_id(_value(record, 'managed_extra'))
+        if instance_id is not None:
+            self.instance_id = instance_id
+
+
+class RecordIndex(object):
+    """SQLite table of the records each managed resource owns.
+
+    Rows are keyed by plugin name and managed resource id and written as
+    the handlers create records. Other sink processes, on this host or
+    others, write records this index never sees, so a resource without
+    a row may still own records and is searched for in Designate.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # (plugin, resource_id) pairs changed during a rebuild
+        self._touched = {}
+        self._db = sqlite3.connect(path, timeout=5,
+                                   check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS managed_resources ('
+                'plugin TEXT, resource_id TEXT, instance_id TEXT, '
+                'records TEXT, addresses TEXT, '
+                'PRIMARY KEY (plugin, resource_id))')
+
+    def _touch(self, plugin, resource_id):
+        touched = self._touched.get(plugin)
+        if touched is not None:
+            touched.add(resource_id)
+
+    def _get(self, plugin, resource_id):
+        row = self._db.execute(
+            'SELECT records, addresses, instance_id FROM managed_resources '
+            'WHERE plugin = ? AND resource_id = ?',
+            (plugin, resource_id)).fetchone()
+        if row is None:
+            return None
+        return Entry(json.loads(row[0]), json.loads(row[1]), row[2])
+
+    def _put(self, plugin, resource_id, entry):
+        self._db.execute(
+            'INSERT OR REPLACE INTO managed_resources VALUES (?, ?, ?, ?, ?)',
+            (plugin, resource_id, entry.instance_id,
+             json.dumps(sorted(entry.records)),
+             json.dumps(sorted(entry.addresses))))
+
+    def lookup(self, plugin, resource_id):
+        """Return what a resource owns, or None if the index doesn't know
+        and Designate has to be searched.
+        """
+        with self._lock:
+            return self._get(plugin, resource_id)
+
+    def add(self, plugin, zone_id, recordset):
+        """Record the records of a recordset the handler just wrote.
+
+        Records that belong to other resources or plugins are left
+        alone.
+        """
+        owned = {}
+        for record in _value(recordset, 'records') or []:
+            resource_id = _value(record, 'managed_resource_id')
+            if resource_id is None or \
+                    _value(record, 'managed_plugin_name') != plugin:
+                continue
+            owned.setdefault(resource_id, []).append(record)
+        if not owned:
+            return
+
+        recordset_id = _value(recordset, 'id')
+        with self._lock, self._db:
+            for resource_id, records in owned.items():
+                entry = self._get(plugin, resource_id) or Entry()
+                # The recordset's records replace what was known of it
+                entry.records = set(record for record in entry.records
+                                    if record[1] != recordset_id)
+                for record in records:
+                    entry.add(record, zone_id, recordset_id)
+                self._put(plugin, resource_id, entry)
+                self._touch(plugin, resource_id)
+
+    def discard(self, plugin, resource_id):
+        with self._lock, self._db:
+            self._db.execute(
+                'DELETE FROM managed_resources '
+                'WHERE plugin = ? AND resource_id = ?',
+                (plugin, resource_id))
+            self._touch(plugin, resource_id)
+
+    def rebuild(self, plugin, records):
+        """Replace a plugin's rows with ``records`` read from Designate.
+
+        Resources the handlers change while the records are being read
+        keep their live rows.
+        """
+        start = time.monotonic()
+        with self._lock:
+            self._touched[plugin] = set()
+        try:
+            entries = {}
+            for record in records:
+                resource_id = _value(record, 'managed_resource_id')
+                if resource_id is None:
+                    continue
+                entry = entries.get(resource_id)
+                if entry is None:
+                    entry = entries[resource_id] = Entry()
+                entry.add(record, _value(record, 'zone_id'),
+                          _value(record, 'recordset_id'))
+
+            with self._lock, self._db:
+                touched = self._touched[plugin]
+                for row in self._db.execute(
+                        'SELECT resource_id FROM managed_resources '
+                        'WHERE plugin = ?', (plugin,)).fetchall():
+                    if row[0] not in touched and row[0] not in entries:
+                        self._db.execute(
+                            'DELETE FROM managed_resources '
+                            'WHERE plugin = ? AND resource_id = ?',
+                            (plugin, row[0]))
+                for resource_id, entry in entries.items():
+                    if resource_id not in touched:
+                        self._put(plugin, resource_id, entry)
+        finally:
+            with self._lock:
+                self._touched.pop(plugin, None)
+
+        LOG.info('Rebuilt the %s record index with %d resources in %.1fs',
+                 plugin, len(entries), time.monotonic() - start)
+
+    def rebuild_in_background(self, plugin, records):
+        """Run ``rebuild`` in a daemon thread; ``records`` is called there
+        to produce the records.
+        """
+        def run():
+            try:
+                self.rebuild(plugin, records())
+            except Exception as e:
+                LOG.warning("Couldn't rebuild the {0} record index: "
+                            "{1}".format(plugin, e))
+
+        thread = threading.Thread(target=run,
+                                  name='record index %s' % plugin)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def delete_records(central_api, entry):
+    """Delete the records of an Entry without searching.
+
+    Central has no call to delete a single record, so each recordset is
+    read by id. It is deleted if only the entry's records are left in it,
+    otherwise it is updated without them.
+
+    Returns False if any of the records were already gone. The entry is
+    then out of date, for example because another sink process replaced
+    the records, and the caller has to search Designate.
+    """
+    context = DesignateContext.get_admin_context(
+        all_tenants=True, edit_managed_records=True)
+    owned = {}
+    for zone_id, recordset_id, record_id in entry.records:
+        owned.setdefault((zone_id, recordset_id), set()).add(record_id)
+
+    complete = True
+    for (zone_id, recordset_id), record_ids in sorted(owned.items()):
+        try:
+            with metrics.timed('designate', 'get_recordset'):
+                recordset = central_api.get_recordset(context, zone_id,
+                                                      recordset_id)
+            present = set(_value(record, 'id') for record in recordset.records)
+            if not record_ids <= present:
+                complete = False
+            remaining = [record for record in recordset.records
+                         if _value(record, 'id') not in record_ids]
+            if not remaining:
+                LOG.debug('Deleting recordset %s from %s', recordset_id,
+                          zone_id)
+                with metrics.timed('designate', 'delete_recordset'):
+                    central_api.delete_recordset(context, zone_id,
+                                                 recordset_id)
+            elif len(remaining) < len(recordset.records):
+                LOG.debug('Removing %d records from recordset %s in %s',
+                          len(recordset.records) - len(remaining),
+                          recordset_id, zone_id)
+                recordset.records = objects.RecordList(objects=remaining)
+                with metrics.timed('designate', 'update_recordset'):
+                    central_api.update_recordset(context, recordset)
+        except exceptions.RecordSetNotFound:
+            complete = False
+    return complete
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(conf):
+    """Return the RecordIndex configured for a handler group, or None.
+
+    Handlers using the same file share one connection.
+    """
+    if not conf.record_index:
+        return None
+    with _indexes_lock:
+        index = _indexes.get(conf.record_index)
+        if index is None:
+            index = _indexes[conf.record_index] = RecordIndex(
+                conf.record_index)
+        return index
@@ -0,0 +1,174 @@
+# Recordset writes that skip changes already in place
+
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from designate import exceptions
+from designate import objects
+
+from cybera_designate_sink_handler import metrics
+
+LOG = logging.getLogger(__name__)
+
+recordset_opts = [
+    cfg.IntOpt('recordset-cache-ttl', default=300,
+               help='Seconds to remember recordsets written by the sink. A '
+                    'remembered recordset is read back before a write to '
+                    'it is skipped'),
+]
+
+MANAGED_FIELDS = ('data', 'managed_resource_id', 'managed_extra')
+
+
+def _field(record, name):
+    if hasattr(record, 'obj_attr_is_set') and not record.obj_attr_is_set(
+            name):
+        return None
+    return getattr(record, name, None)
+
+
+def record_state(records):
+    """The parts of a list of records that the handlers decide."""
+    return frozenset(tuple(_field(record, name) for name in MANAGED_FIELDS)
+                     for record in records)
+
+
+class RecordsetState(object):
+    """Recordsets known to hold the records the handlers last wrote.
+
+    Entries are keyed by ``(zone_id, name, type)`` and expire after
+    ``ttl`` seconds. Deleting a resource's records or a zone notification
+    drops the entries they could affect. Other sink processes and
+    operators can change a recordset without this process knowing, so a
+    match is only a hint and is confirmed against Designate before a
+    write is skipped.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._known = {}
+
+    def matches(self, key, state):
+        with self._lock:
+            cached = self._known.get(key)
+            if cached is None:
+                return False
+            if cached[0] <= time.monotonic():
+                del self._known[key]
+                return False
+            return state <= cached[1]
+
+    def drop(self, key):
+        with self._lock:
+            self._known.pop(key, None)
+
+    def remember(self, key, state):
+        with self._lock:
+            self._known[key] = (time.monotonic() + self.ttl, state)
+
+    def forget(self, resource_id):
+        """Drop recordsets holding records of a resource.
+
+        ``resource_id`` is matched against both the managed resource id
+        and the ``instance:<id>`` extra of floating IP records.
+        """
+        if resource_id is None:
+            return
+        extra = 'instance:%s' % resource_id
+        with self._lock:
+            for key in [key for key, cached in self._known.items()
+                        if any(state[1] == resource_id or state[2] == extra
+                               for state in cached[1])]:
+                del self._known[key]
+
+    def invalidate_zone(self, zone_id=None):
+        with self._lock:
+            if zone_id is None:
+                self._known.clear()
+                return
+            for key in [key for key in self._known if key[0] == zone_id]:
+                del self._known[key]
+
+    def _skipped(self, zone_id, name, type):
+        with self._lock:
+            self.skipped += 1
+        metrics.skipped('designate', 'recordset')
+        LOG.debug('%s %s in %s is already up to date (%d writes skipped)',
+                  type, name, zone_id, self.skipped)
+
+    def write(self, central_api, context, records, zone_id, name, type,
+              ttl=None):
+        """Create or update a recordset like the base handler does, but
+        only when the records would change.
+
+        Returns the recordset, or None if the write was skipped because
+        the records were already in place.
+        """
+        name = name.encode('idna').decode('utf-8')
+        key = (zone_id, name, type)
+        desired = record_state(records)
+        if self.matches(key, desired):
+            # Reading it back is cheaper than a create that fails, and
+            # catches recordsets changed outside this process
+            try:
+                with metrics.timed('designate', 'find_recordset'):
+                    current = central_api.find_recordset(context, {
+                        'zone_id': zone_id,
+                        'name': name,
+                        'type': type,
+                    })
+            except exceptions.RecordSetNotFound:
+                current = None
+            if current is not None and \
+                    desired <= record_state(current.records):
+                self._skipped(zone_id, name, type)
+                return None
+            LOG.debug('%s %s in %s changed since it was written', type,
+                      name, zone_id)
+            self.drop(key)
+
+        try:
+            recordset = central_api.create_recordset(
+                context, zone_id,
+                objects.RecordSet(
+                    name=name, type=type, ttl=ttl,
+                    records=objects.RecordList(objects=records)))
+        except exceptions.DuplicateRecordSet:
+            recordset = central_api.find_recordset(context, {
+                'zone_id': zone_id,
+                'name': name,
+                'type': type,
+            })
+            existing = record_state(recordset.records)
+            if desired <= existing:
+                self.remember(key, existing)
+                self._skipped(zone_id, name, type)
+                return recordset
+
+            # Take over records with the same data rather than adding
+            # duplicates of them
+            by_data = dict((_field(record, 'data'), record)
+                           for record in recordset.records)
+            for record in records:
+                current = by_data.get(_field(record, 'data'))
+                if current is None:
+                    recordset.records.append(record)
+                    continue
+                for field in MANAGED_FIELDS[1:]:
+                    setattr(current, field, _field(record, field))
+
+            recordset = central_api.update_recordset(context, recordset)
+
+        self.remember(key, record_state(recordset.records))
+        LOG.debug('Creating record in %s / %s', zone_id, recordset['id'])
+        return recordset
+
+
+# Shared by both handlers since the v6 handler deletes floating IP records
+# when an instance goes away.
+state = RecordsetState()
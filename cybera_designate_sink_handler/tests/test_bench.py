@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from cybera_designate_sink_handler import capture
+from cybera_designate_sink_handler.bench import events
+from cybera_designate_sink_handler.bench import fakes
+from cybera_designate_sink_handler.bench import replay
+from cybera_designate_sink_handler.bench import run
+
+
+def _errors(reports):
+    return dict((name, dict((event_type, result['errors'])
+                            for event_type, result in results.items()))
+                for name, results in reports)
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_small_run_has_no_errors(self):
+        reports = []
+        with mock.patch.object(
+                run, 'report',
+                lambda name, results, elapsed, out: reports.append(
+                    (name, results))):
+            self.assertEqual(0, run.main(['--instances', '3']))
+
+        self.assertEqual(['nova_fixed_v6', 'neutron_floating'],
+                         [name for name, _ in reports])
+        for name, errors in _errors(reports).items():
+            self.assertTrue(errors)
+            self.assertEqual(0, sum(errors.values()), (name, errors))
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def _capture(self):
+        """Capture the benchmark's event streams to a file."""
+        nova = fakes.FakeNova(fakes.Stats())
+        servers = events.add_instances(nova, 3)
+        path = os.path.join(self.path, 'capture.jsonl')
+        recorder = capture.Recorder(path)
+        for handler, stream in (
+                ('handler:nova_fixed_v6', events.v6_events(servers)),
+                ('handler:neutron_floating',
+                 events.floating_events(servers))):
+            for event_type, payload in stream:
+                recorder.record(handler, event_type, dict(events.CONTEXT),
+                                payload)
+        recorder.close()
+        return path
+
+    def test_replays_capture_without_errors(self):
+        path = self._capture()
+        reports = []
+        with mock.patch.object(
+                run, 'report',
+                lambda name, results, elapsed, out: reports.append(
+                    (name, results))):
+            self.assertEqual(0, replay.main([path, '--fast']))
+
+        errors = _errors(reports)
+        self.assertEqual(set(['nova_fixed_v6', 'neutron_floating']),
+                         set(errors))
+        for name, counts in errors.items():
+            self.assertEqual(0, sum(counts.values()), (name, counts))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+from unittest import mock
+
+from cybera_designate_sink_handler import clients
+
+
+class ClientManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = clients.ClientManager(
+            'http://keystone.example.com:5000/v3', 'designate', 'secret',
+            'service', keystone_timeout=30.0, nova_timeout=7.5)
+        # Only the token request would reach Keystone
+        self.manager._refresh_token = lambda: None
+
+    def test_nova_session_uses_nova_timeout(self):
+        nova = self.manager.nova
+        self.assertEqual(7.5, nova.client.session.timeout)
+
+    def test_nova_shares_token_and_connection_pool(self):
+        nova_session = self.manager.nova.client.session
+        self.assertIs(self.manager.auth, nova_session.auth)
+        self.assertIs(self.manager.session.session, nova_session.session)
+        self.assertEqual(30.0, self.manager.session.timeout)
+
+
+
+class TokenRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = clients.ClientManager(
+            'http://keystone.example.com:5000/v3', 'designate', 'secret',
+            'service', refresh_margin=300)
+        self.manager.auth.get_auth_ref = mock.Mock(
+            side_effect=RuntimeError('keystone unavailable'))
+
+    def _token(self, seconds_left):
+        auth_ref = mock.Mock()
+        auth_ref.will_expire_soon.side_effect = \
+            lambda margin: seconds_left <= margin
+        self.manager.auth.auth_ref = auth_ref
+        return auth_ref
+
+    def test_failed_early_refresh_keeps_token(self):
+        auth_ref = self._token(60)
+        self.manager._refresh_token()
+        self.assertIs(auth_ref, self.manager.auth.auth_ref)
+
+    def test_failed_refresh_of_expired_token_raises(self):
+        self._token(0)
+        self.assertRaises(RuntimeError, self.manager._refresh_token)
+
+    def test_failed_first_token_raises(self):
+        self.assertRaises(RuntimeError, self.manager._refresh_token)
+
+
+if __name__ == '__main__':
+    unittest.main()
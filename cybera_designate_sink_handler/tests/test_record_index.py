@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+from oslo_config import cfg
+
+from designate import exceptions
+from designate import objects
+from designate import policy
+
+from cybera_designate_sink_handler import record_index
+
+
+class FakeCentral(object):
+    """Only the central calls the baseline handlers used."""
+
+    def __init__(self, recordsets):
+        self.recordsets = dict((recordset.id, recordset)
+                               for recordset in recordsets)
+        self.calls = []
+
+    def find_records(self, context, criterion, *args, **kwargs):
+        self.calls.append('find_records')
+        return [record for recordset in self.recordsets.values()
+                for record in recordset.records]
+
+    def get_recordset(self, context, zone_id, recordset_id):
+        self.calls.append('get_recordset')
+        try:
+            return self.recordsets[recordset_id]
+        except KeyError:
+            raise exceptions.RecordSetNotFound()
+
+    def update_recordset(self, context, recordset):
+        self.calls.append('update_recordset')
+        self.recordsets[recordset.id] = recordset
+        return recordset
+
+    def delete_recordset(self, context, zone_id, recordset_id):
+        self.calls.append('delete_recordset')
+        if self.recordsets.pop(recordset_id, None) is None:
+            raise exceptions.RecordSetNotFound()
+
+
+ZONE_ID = str(uuid.uuid4())
+
+
+def _record(record_id, data, resource_id):
+    return objects.Record(id=record_id, data=data, managed=True,
+                          managed_plugin_name='neutron_floating',
+                          managed_resource_id=resource_id)
+
+
+def _recordset(name, type, records):
+    return objects.RecordSet(id=str(uuid.uuid4()), zone_id=ZONE_ID,
+                             name=name, type=type,
+                             records=objects.RecordList(objects=records))
+
+
+class DeleteRecordsTest(unittest.TestCase):
+
+    def setUp(self):
+        # delete_records uses an all_tenants admin context
+        cfg.CONF(args=[], project='designate', default_config_files=[])
+        policy.init()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.index = record_index.RecordIndex(
+            os.path.join(self.path, 'index.sqlite'))
+
+        self.fip_1 = str(uuid.uuid4())
+        self.fip_2 = str(uuid.uuid4())
+        self.kept = str(uuid.uuid4())
+        self.forward = _recordset('abc.example.com.', 'A', [
+            _record(str(uuid.uuid4()), '192.0.2.1', self.fip_1),
+            _record(self.kept, '192.0.2.2', self.fip_2),
+        ])
+        self.reverse = _recordset('1.2.0.192.in-addr.arpa.', 'PTR', [
+            _record(str(uuid.uuid4()), 'abc.example.com.', self.fip_1),
+        ])
+        self.central = FakeCentral([self.forward, self.reverse])
+        for recordset in (self.forward, self.reverse):
+            self.index.add('neutron_floating', ZONE_ID, recordset)
+
+    def test_deletes_recordsets_left_empty(self):
+        entry = self.index.lookup('neutron_floating', self.fip_1)
+        record_index.delete_records(self.central, entry)
+
+        self.assertNotIn(self.reverse.id, self.central.recordsets)
+        self.assertIn('delete_recordset', self.central.calls)
+
+    def test_keeps_records_of_other_resources(self):
+        entry = self.index.lookup('neutron_floating', self.fip_1)
+        record_index.delete_records(self.central, entry)
+
+        remaining = self.central.recordsets[self.forward.id].records
+        self.assertEqual([self.kept], [record.id for record in remaining])
+        self.assertIn('update_recordset', self.central.calls)
+        self.assertNotIn('find_records', self.central.calls)
+
+    def test_reports_complete_deletes(self):
+        entry = self.index.lookup('neutron_floating', self.fip_1)
+        self.assertTrue(record_index.delete_records(self.central, entry))
+
+    def test_reports_recordsets_already_gone(self):
+        entry = self.index.lookup('neutron_floating', self.fip_1)
+        del self.central.recordsets[self.reverse.id]
+        self.assertFalse(record_index.delete_records(self.central, entry))
+
+        self.assertEqual(
+            1, len(self.central.recordsets[self.forward.id].records))
+
+    def test_reports_records_already_replaced(self):
+        entry = self.index.lookup('neutron_floating', self.fip_1)
+        self.reverse.records = objects.RecordList(objects=[
+            _record(str(uuid.uuid4()), 'abc.example.com.', self.fip_1)])
+        self.assertFalse(record_index.delete_records(self.central, entry))
+
+    def test_unknown_resources_are_searched(self):
+        self.assertIsNone(
+            self.index.lookup('neutron_floating', str(uuid.uuid4())))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from cybera_designate_sink_handler import netbox_queue
+from cybera_designate_sink_handler import tracing
+
+
+class FakeIPHandler(object):
+    ip_ver = 4
+
+    def get_ips(self, addresses, cached=True):
+        return dict((address, address) for address in addresses)
+
+    def unassign_ips(self, ips):
+        with tracing.span('netbox', 'unassign_ips'):
+            pass
+
+
+class FollowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.tracer = tracing.Tracer(os.path.join(self.path, 'traces'),
+                                     slow_threshold=60, sample_rate=0)
+
+    def traces(self):
+        with open(self.tracer.path) as f:
+            return [json.loads(line)['resourceSpans'][0]['scopeSpans'][0]
+                    ['spans'] for line in f]
+
+    def test_follower_is_written_with_kept_trace(self):
+        with self.assertRaises(RuntimeError):
+            with self.tracer.event('neutron_floating', 'floatingip.delete',
+                                   'fip') as trace:
+                context = tracing.current()
+                with self.tracer.follow('netbox-queue apply', [context]):
+                    with tracing.span('netbox', 'unassign_ips'):
+                        pass
+                raise RuntimeError('designate unavailable')
+
+        event, follower = self.traces()
+        root = [span for span in follower if not span['parentSpanId']][0]
+        self.assertEqual([{'traceId': trace.trace_id,
+                           'spanId': trace.root_id}], root['links'])
+        self.assertEqual(['netbox unassign_ips', 'netbox-queue apply'],
+                         sorted(span['name'] for span in follower))
+
+    def test_follower_of_dropped_trace_is_dropped(self):
+        with self.tracer.event('neutron_floating', 'floatingip.delete',
+                               'fip'):
+            context = tracing.current()
+        with self.tracer.follow('netbox-queue apply', [context]):
+            pass
+
+        self.assertFalse(os.path.exists(self.tracer.path))
+
+    def test_queue_links_updates_to_their_events(self):
+        queue = netbox_queue.NetBoxQueue(FakeIPHandler(), tracer=self.tracer)
+        with self.assertRaises(RuntimeError):
+            with self.tracer.event('neutron_floating', 'floatingip.delete',
+                                   'fip') as trace:
+                queue.unassign(['192.0.2.1'])
+                raise RuntimeError('designate unavailable')
+
+        deadline = time.monotonic() + 5
+        while len(queue) or self.tracer.written < 2:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+        follower = self.traces()[-1]
+        root = [span for span in follower if not span['parentSpanId']][0]
+        self.assertEqual(trace.trace_id, root['links'][0]['traceId'])
+        self.assertIn('netbox unassign_ips',
+                      [span['name'] for span in follower])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,309 @@
+# Per-event traces of remote calls in OpenTelemetry JSON
+
+import contextlib
+import json
+import random
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+tracing_opts = [
+    cfg.StrOpt('trace-file',
+               help='Append a trace of each notification, with a span for '
+                    'every Keystone, Nova, Designate and NetBox call, to '
+                    'this file as OTLP JSON lines'),
+    cfg.FloatOpt('trace-slow-threshold', default=5.0,
+                 help='Notifications taking at least this many seconds, or '
+                      'failing, are always traced'),
+    cfg.FloatOpt('trace-sample-rate', default=0.01,
+                 help='Fraction of faster notifications that are traced'),
+]
+
+SCOPE = 'cybera_designate_sink_handler'
+SERVICE_NAME = 'designate-sink'
+
+# OTLP span kinds and status codes
+KIND_INTERNAL = 1
+KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_local = threading.local()
+
+
+def _attributes(values):
+    return [{'key': key, 'value': {'stringValue': str(value)}}
+            for key, value in sorted(values.items()) if value is not None]
+
+
+class Trace(object):
+    """The spans recorded while one notification was processed.
+
+    Spans are ``(span_id, parent_id, name, kind, start, end, attributes,
+    error)`` tuples with times in nanoseconds since the epoch. Calls on
+    other threads add to the same trace, so appends are locked.
+
+    ``links`` are ``(trace_id, span_id)`` pairs of the spans the root
+    span follows from. ``kept`` is None until the trace is finished, then
+    whether it was written. ``followers`` are traces linked to this one
+    that wait for that decision.
+    """
+
+    __slots__ = ('trace_id', 'root_id', 'spans', 'links', 'error', 'kept',
+                 'followers', 'exported', '_lock')
+
+    def __init__(self):
+        self.trace_id = '%032x' % random.getrandbits(128)
+        self.root_id = '%016x' % random.getrandbits(64)
+        self.spans = []
+        self.links = []
+        self.error = None
+        self.kept = None
+        self.followers = []
+        self.exported = False
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def _links(self, span_id):
+        if span_id != self.root_id:
+            return []
+        return [{'traceId': trace_id, 'spanId': linked_id}
+                for trace_id, linked_id in self.links]
+
+    def to_otlp(self):
+        """Render as an OTLP ExportTraceServiceRequest."""
+        return {'resourceSpans': [{
+            'resource': {'attributes': _attributes(
+                {'service.name': SERVICE_NAME})},
+            'scopeSpans': [{
+                'scope': {'name': SCOPE},
+                'spans': [{
+                    'traceId': self.trace_id,
+                    'spanId': span_id,
+                    'parentSpanId': parent_id or '',
+                    'name': name,
+                    'kind': kind,
+                    'startTimeUnixNano': str(start),
+                    'endTimeUnixNano': str(end),
+                    'attributes': _attributes(attributes),
+                    'links': self._links(span_id),
+                    'status': {'code': STATUS_ERROR, 'message': error}
+                    if error else {'code': STATUS_OK},
+                } for (span_id, parent_id, name, kind, start, end,
+                       attributes, error) in self.spans],
+            }],
+        }]}
+
+
+class Tracer(object):
+    """Traces notifications and keeps the slow and failed ones.
+
+    Every event is traced while it runs, which costs a tuple per remote
+    call. Once it finishes the trace is written if the event failed,
+    took ``slow_threshold`` seconds or more, or was picked with
+    probability ``sample_rate``; otherwise it is dropped.
+    """
+
+    def __init__(self, path, slow_threshold=5.0, sample_rate=0.01):
+        self.path = path
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.written = 0
+        self._lock = threading.Lock()
+        self._file = None
+
+    def _keep(self, elapsed, error):
+        return error is not None or elapsed >= self.slow_threshold or \
+            random.random() < self.sample_rate
+
+    def _write(self, trace):
+        line = json.dumps(trace.to_otlp(), separators=(',', ':')) + '\n'
+        with self._lock:
+            # A follower may be kept for more than one trace
+            if trace.exported:
+                return
+            trace.exported = True
+            try:
+                if self._file is None:
+                    self._file = open(self.path, 'a', encoding='utf-8',
+                                      buffering=1)
+                self._file.write(line)
+                self.written += 1
+            except Exception as e:
+                # Tracing must never fail an event
+                LOG.warning("Couldn't write trace {0}: {1}".format(
+                    trace.trace_id, e))
+
+    @contextlib.contextmanager
+    def event(self, handler, event_type, resource_id):
+        trace = Trace()
+        previous = current()
+        _local.context = (trace, trace.root_id)
+        start = time.time_ns()
+        error = None
+        try:
+            yield trace
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+            raise
+        finally:
+            _local.context = previous
+            end = time.time_ns()
+            trace.add((trace.root_id, None, event_type, KIND_INTERNAL,
+                       start, end, {'sink.handler': handler,
+                                    'sink.event_type': event_type,
+                                    'sink.resource_id': resource_id},
+                       error))
+            keep = self._keep((end - start) / 1e9, error)
+            with trace._lock:
+                trace.kept = keep
+                followers, trace.followers = trace.followers, []
+            if keep:
+                self._write(trace)
+                for follower in followers:
+                    self._write(follower)
+
+    @contextlib.contextmanager
+    def follow(self, name, contexts):
+        """Trace work done later for earlier notifications, such as
+        queued NetBox updates.
+
+        ``contexts`` are the ``current()`` values of the code that queued
+        the work. The spans go in a trace of their own whose root is
+        linked to those contexts. It is written along with any of their
+        traces that is written, or if it fails or is slow itself. Callers
+        can mark it failed by setting ``error`` on the yielded trace.
+        """
+        trace = Trace()
+        origins = {}
+        for context in contexts:
+            if context is not None:
+                origin, span_id = context
+                origins[origin.trace_id] = origin
+                trace.links.append((origin.trace_id, span_id))
+        trace.links = sorted(set(trace.links))
+
+        previous = current()
+        _local.context = (trace, trace.root_id)
+        start = time.time_ns()
+        error = None
+        try:
+            yield trace
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+            raise
+        finally:
+            _local.context = previous
+            end = time.time_ns()
+            error = error or trace.error
+            trace.add((trace.root_id, None, name, KIND_INTERNAL, start,
+                       end, {'sink.linked_traces': len(origins)}, error))
+            if self._keep((end - start) / 1e9, error):
+                self._write(trace)
+            else:
+                for origin in origins.values():
+                    with origin._lock:
+                        if origin.kept is None:
+                            origin.followers.append(trace)
+                            continue
+                    if origin.kept:
+                        self._write(trace)
+
+
+_tracers = {}
+_tracers_lock = threading.Lock()
+
+
+def current():
+    """The ``(trace, parent span id)`` of this thread, if tracing."""
+    return getattr(_local, 'context', None)
+
+
+@contextlib.contextmanager
+def activate(context):
+    """Add the calls made in this thread to another thread's trace."""
+    previous = current()
+    _local.context = context
+    try:
+        yield
+    finally:
+        _local.context = previous
+
+
+@contextlib.contextmanager
+def _span(context, dependency, call):
+    trace, parent_id = context
+    span_id = '%016x' % random.getrandbits(64)
+    _local.context = (trace, span_id)
+    start = time.time_ns()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+        raise
+    finally:
+        _local.context = context
+        trace.add((span_id, parent_id, '%s %s' % (dependency, call),
+                   KIND_CLIENT, start, time.time_ns(),
+                   {'peer.service': dependency, 'sink.call': call}, error))
+
+
+def span(dependency, call):
+    """Record a remote call in the current trace, or None if there is
+    no trace.
+    """
+    context = current()
+    if context is None:
+        return None
+    return _span(context, dependency, call)
+
+
+class _Noop(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _Noop()
+
+
+def event(tracer, handler, event_type, resource_id):
+    """Trace one notification with ``tracer``, which may be None."""
+    if tracer is None:
+        return _NOOP
+    return tracer.event(handler, event_type, resource_id)
+
+
+def follow(tracer, name, contexts):
+    """Trace background work for earlier notifications with ``tracer``,
+    which may be None.
+    """
+    if tracer is None:
+        return _NOOP
+    return tracer.follow(name, contexts)
+
+
+def get_tracer(conf):
+    """Return the Tracer for a handler group, or None if tracing is off.
+
+    Handlers tracing to the same file share one Tracer.
+    """
+    if not conf.trace_file:
+        return None
+    with _tracers_lock:
+        tracer = _tracers.get(conf.trace_file)
+        if tracer is None:
+            tracer = _tracers[conf.trace_file] = Tracer(
+                conf.trace_file, slow_threshold=conf.trace_slow_threshold,
+                sample_rate=conf.trace_sample_rate)
+        return tracer
@@ -3,17 +3,32 @@
 from oslo_config import cfg
 from oslo_log import log as logging
 
+from designate import exceptions
 from designate.objects import Record
 from designate.notification_handler.base import BaseAddressHandler
 from designate.context import DesignateContext
 
-from keystoneauth1.identity import v3
-from keystoneauth1 import session
-from novaclient import client as nova_c
-
-from cybera_designate_sink_handler.ip_handler import IPHandler
-
+from cybera_designate_sink_handler import batching
+from cybera_designate_sink_handler import breaker
+from cybera_designate_sink_handler import capture
+from cybera_designate_sink_handler import clients
+from cybera_designate_sink_handler import dedup
+from cybera_designate_sink_handler import dispatcher
+from cybera_designate_sink_handler import executor
+from cybera_designate_sink_handler import hostnames
+from cybera_designate_sink_handler import lookup
+from cybera_designate_sink_handler import metrics
+from cybera_designate_sink_handler import netbox_queue
+from cybera_designate_sink_handler import prefixes
+from cybera_designate_sink_handler import record_index
+from cybera_designate_sink_handler import recordsets
+from cybera_designate_sink_handler import tracing
+from cybera_designate_sink_handler import warmup
+from cybera_designate_sink_handler import zone_cache
+
+import functools
 import ipaddress
+import time
 
 LOG = logging.getLogger(__name__)
 
@@ -35,11 +50,80 @@ cfg.CONF.register_opts([
     cfg.StrOpt('netbox_api_key')
 ], group='handler:nova_fixed_v6')
 
+cfg.CONF.register_opts(clients.client_opts + clients.netbox_opts +
+                       zone_cache.zone_cache_opts + batching.batching_opts +
+                       lookup.lookup_opts + hostnames.hostname_opts +
+                       netbox_queue.netbox_queue_opts + executor.executor_opts +
+                       metrics.metrics_opts + dedup.dedup_opts +
+                       recordsets.recordset_opts + breaker.breaker_opts +
+                       warmup.warmup_opts + capture.capture_opts +
+                       prefixes.prefix_opts + dispatcher.dispatcher_opts +
+                       record_index.record_index_opts + tracing.tracing_opts,
+                       group='handler:nova_fixed_v6')
+
 
 class NovaFixedV6Handler(BaseAddressHandler):
     """Handler for Nova's notifications"""
     __plugin_name__ = 'nova_fixed_v6'
 
+    def __init__(self, *args, **kwargs):
+        start = time.monotonic()
+        super(NovaFixedV6Handler, self).__init__(*args, **kwargs)
+        self.zone_cache = zone_cache.ZoneCache(
+            self.get_zone, None, ttl=cfg.CONF[self.name].zone_cache_ttl)
+
+        self.dispatcher = None
+        if cfg.CONF[self.name].dispatch_workers > 1:
+            self.dispatcher = dispatcher.ShardedDispatcher(
+                self.name, self._process_notification, self._resource_key,
+                workers=cfg.CONF[self.name].dispatch_workers,
+                queue_size=cfg.CONF[self.name].dispatch_queue_size)
+
+        self.batcher = None
+        if cfg.CONF[self.name].batching:
+            self.batcher = batching.EventBatcher(
+                self._dispatch, self._resource_key,
+                max_latency=cfg.CONF[self.name].batch_max_latency,
+                max_size=cfg.CONF[self.name].batch_max_size)
+
+        self.runner = executor.OperationRunner(
+            cfg.CONF[self.name].event_workers)
+        metrics.configure(cfg.CONF[self.name])
+        breaker.configure(cfg.CONF[self.name])
+        self.dedup = dedup.get_deduplicator(self.name, cfg.CONF[self.name])
+        self.recorder = capture.get_recorder(cfg.CONF[self.name])
+        self.managed = prefixes.get_filter(cfg.CONF[self.name])
+        self.index = record_index.get_index(cfg.CONF[self.name])
+        self.tracer = tracing.get_tracer(cfg.CONF[self.name])
+        if self.index is not None and \
+                cfg.CONF[self.name].record_index_rebuild:
+            self.index.rebuild_in_background(
+                self.get_plugin_name(), self._managed_records)
+
+        lookup.instance_cache.ttl = cfg.CONF[self.name].instance_cache_ttl
+        lookup.instance_cache.max_entries = \
+            cfg.CONF[self.name].instance_cache_size
+        recordsets.state.ttl = cfg.CONF[self.name].recordset_cache_ttl
+        hostnames.resolver.max_entries = \
+            cfg.CONF[self.name].hostname_cache_size
+        hostnames.resolver.trust_metadata = \
+            cfg.CONF[self.name].hostname_from_metadata
+
+        if cfg.CONF[self.name].warm_up:
+            warmup.warm_up(self.name, self._warm_up_steps())
+        LOG.info('%s started in %.3fs', self.name, time.monotonic() - start)
+
+    def _warm_up_steps(self):
+        conf = cfg.CONF[self.name]
+        return [
+            ('keystone token',
+             lambda: clients.get_client_manager(self.name).nova),
+            ('zones', lambda: self.zone_cache.warm(
+                [conf.zone_id, conf.reverse_zone_id])),
+            ('netbox prefix', lambda: clients.get_ip_handler(
+                self.name, 6, int(conf.floating_ip_prefix_id)).prefix),
+        ]
+
     def get_exchange_topics(self):
         exchange = cfg.CONF[self.name].control_exchange
         topics = [topic for topic in cfg.CONF[self.name].notification_topics]
@@ -50,61 +134,176 @@ class NovaFixedV6Handler(BaseAddressHandler):
         return [
             'compute.instance.create.end',
             'compute.instance.delete.start',
-        ]
+        ] + zone_cache.ZONE_EVENT_TYPES
+
+    def _resource_key(self, event_type, payload):
+        return payload.get('instance_id')
+
+    def _fingerprint(self, event_type, payload):
+        return dedup.fingerprint(event_type, sorted(
+            fixed_ip['address'] for fixed_ip in payload.get('fixed_ips', [])))
+
+    def _is_managed(self, event_type, payload):
+        if not self.managed.enabled or 'fixed_ips' not in payload:
+            # Deletes don't carry the addresses
+            return True
+        return any(fixed_ip['version'] == 6 and self.managed.fixed_ip(fixed_ip)
+                   for fixed_ip in payload['fixed_ips'])
 
     def process_notification(self, context, event_type, payload):
+        if self.recorder is not None:
+            self.recorder.record(self.name, event_type, context, payload)
+
+        # Events about unmanaged addresses go no further
+        if event_type not in zone_cache.ZONE_EVENT_TYPES and \
+                not self._is_managed(event_type, payload):
+            self.managed.drop(self.name, event_type,
+                              self._resource_key(event_type, payload))
+            return
+
+        if self.batcher is not None and \
+                event_type not in zone_cache.ZONE_EVENT_TYPES:
+            self.batcher.submit(context, event_type, payload)
+            return
+
+        # Zone events only invalidate caches and are handled right away
+        if event_type in zone_cache.ZONE_EVENT_TYPES:
+            self._process_notification(context, event_type, payload)
+            return
+
+        self._dispatch(context, event_type, payload)
+
+    def _dispatch(self, context, event_type, payload):
+        if self.dispatcher is not None:
+            self.dispatcher.submit(context, event_type, payload)
+            return
+
+        self._process_notification(context, event_type, payload)
+
+    def get_zone(self, zone_id):
+        with metrics.timed('designate', 'get_zone'):
+            return super(NovaFixedV6Handler, self).get_zone(zone_id)
+
+    def _create_or_update_recordset(self, context, records, zone_id, name,
+                                    type, ttl=None):
+        # Only writes that change something reach central
+        with metrics.timed('designate', 'create_or_update_recordset'):
+            recordset = recordsets.state.write(self.central_api, context,
+                                               records, zone_id, name, type,
+                                               ttl)
+        if recordset is not None and self.index is not None:
+            self.index.add(self.get_plugin_name(), zone_id, recordset)
+        return recordset
+
+    def _delete(self, *args, **kwargs):
+        recordsets.state.forget(kwargs.get('resource_id'))
+        if self.index is not None:
+            self.index.discard(self.get_plugin_name(),
+                               kwargs.get('resource_id'))
+        with metrics.timed('designate', 'delete'):
+            return super(NovaFixedV6Handler, self)._delete(*args, **kwargs)
+
+    def _managed_records(self):
+        context = DesignateContext.get_admin_context(
+            all_tenants=True, edit_managed_records=True)
+        return record_index.managed_records(
+            self.central_api, context, self.get_plugin_name(),
+            cfg.CONF[self.name].record_index_page_size)
+
+    def _indexed(self, resource_id):
+        """Return the index entry of a resource, or None if Designate
+        has to be searched for its records.
+        """
+        if self.index is None:
+            return None
+        return self.index.lookup(self.get_plugin_name(), resource_id)
+
+    def _delete_indexed(self, resource_id, entry):
+        """Delete the records of an index entry by id.
+
+        Returns False if the entry was out of date, and Designate still
+        has to be searched.
+        """
+        recordsets.state.forget(resource_id)
+        deleted = record_index.delete_records(self.central_api, entry)
+        self.index.discard(self.get_plugin_name(), resource_id)
+        return deleted
+
+    def _process_notification(self, context, event_type, payload):
+        # Checked here, where events for a resource are applied one after
+        # another, so nothing still queued can change the last one applied
+        if event_type not in zone_cache.ZONE_EVENT_TYPES and \
+                self.dedup.is_duplicate(
+                    self._resource_key(event_type, payload),
+                    self._fingerprint(event_type, payload)):
+            return
+
+        with tracing.event(self.tracer, self.name, event_type,
+                           self._resource_key(event_type, payload)), \
+                metrics.event(self.name, event_type):
+            self._handle_notification(context, event_type, payload)
+
+        if event_type not in zone_cache.ZONE_EVENT_TYPES:
+            self.dedup.applied(self._resource_key(event_type, payload),
+                               self._fingerprint(event_type, payload))
+
+    def _handle_notification(self, context, event_type, payload):
         body_context = context
         LOG.debug('NovaFixedV6Handler: Event type received %s', event_type)
         LOG.debug('NovaFixedV6Handler: Event body received %s', payload)
-        zone = self.get_zone(cfg.CONF[self.name].zone_id)
-        reverse_zone = self.get_zone(cfg.CONF[self.name].reverse_zone_id)
+        if event_type in zone_cache.ZONE_EVENT_TYPES:
+            self.zone_cache.invalidate(payload.get('id'))
+            recordsets.state.invalidate_zone(payload.get('id'))
+            return
+
+        zone = self.zone_cache.get_zone(cfg.CONF[self.name].zone_id)
+        reverse_zone = self.zone_cache.get_zone(
+            cfg.CONF[self.name].reverse_zone_id)
         domain_id = zone['id']
         reverse_domain_id = reverse_zone['id']
 
-        # For keystone auth
-        username = cfg.CONF[self.name].admin_user
-        password = cfg.CONF[self.name].admin_password
-        tenant_name = cfg.CONF[self.name].admin_tenant_name
-        auth_url = cfg.CONF[self.name].auth_url
-        auth = v3.Password(username=username, password=password,
-                           project_name=tenant_name, project_domain_name='default',
-                           user_domain_name='default', auth_url=auth_url)
-        sess = session.Session(auth=auth)
-        nvc = nova_c.Client(2.1, session=sess)
-
-        instance = nvc.servers.get(payload['instance_id'])
-
-        # Determine the hostname
-        ec2id = getattr(instance, 'OS-EXT-SRV-ATTR:instance_name')
-        ec2id = ec2id.split('-', 1)[1].lstrip('0')
-        hostname = '%s.%s' % (ec2id, zone['name'])
+        # Instances are fetched from Nova at most once per event
+        nova_lookup = lookup.InstanceLookup(
+            lambda: clients.get_client_manager(self.name).nova)
+
         try:
-            ip_handler_dns = hostname
             ip_handler_project = context['project_name']
 
-            netbox_api_key = str(cfg.CONF[self.name].netbox_api_key)
             prefix_id = int(cfg.CONF[self.name].floating_ip_prefix_id)
-            ip_handler = IPHandler(
-                ip_ver=6,
-                netbox_api_key=netbox_api_key,
-                floating_ip_prefix_id=prefix_id
-            )
+            netbox = clients.get_netbox_queue(self.name, 6, prefix_id)
         except Exception as e:
             LOG.warning("ip_handler did not initialize: {0}".format(e))
 
         if event_type == 'compute.instance.create.end':
+            # Determine the hostname, only asking Nova if we have to
+            instance_id = payload['instance_id']
+            hostname = hostnames.resolver.resolve(
+                instance_id, zone['name'], nova_lookup, payload=payload)
+            ip_handler_dns = hostname
+
+            # Remember the fixed IPs so floating IP events can be named
+            # without a Nova lookup
+            hostnames.resolver.remember(
+                instance_id, hostname.split('.', 1)[0],
+                [ip['address'] for ip in payload['fixed_ips']],
+                payload.get('tenant_id'))
+
             LOG.debug('NovaFixedV6Handler creating AAAA record (%s) for - %s',
                       hostname, payload['instance_id'])
             # Become Designate Admin to manage records
             context = DesignateContext.get_admin_context(all_tenants=True)
 
-            # 1 recordset of an A and AAAA record
-
-            for fixed_ip in payload['fixed_ips']:
-                # Don't create an A record for the private address.
-                if fixed_ip['version'] == 4:
-                    continue
-
+            # 1 recordset holding an AAAA record for every v6 address.
+            # Don't create an A record for the private address.
+            v6_addresses = [fixed_ip['address']
+                            for fixed_ip in payload['fixed_ips']
+                            if fixed_ip['version'] == 6 and
+                            self.managed.fixed_ip(fixed_ip)]
+
+            # The forward, reverse and metadata writes don't depend on each
+            # other so they may run concurrently.
+            operations = []
+            if v6_addresses:
                 record_type = 'AAAA'
 
                 recordset_values = {
@@ -113,28 +312,32 @@ class NovaFixedV6Handler(BaseAddressHandler):
                     'type': record_type
                 }
 
-                record_values = {
-                    'data': fixed_ip['address'],
-                    'managed': True,
-                    'managed_plugin_name': self.get_plugin_name(),
-                    'managed_plugin_type': self.get_plugin_type(),
-                    'managed_resource_type': 'instance',
-                    'managed_resource_id': payload['instance_id']
-                }
-
-                LOG.debug('NovaFixedV6Handler Creating AAAA record in %s / %s with values %r' %
-                          (domain_id, hostname, record_values))
-
-                recordset = self._create_or_update_recordset(
-                    context,
-                    [Record(**record_values)],
-                    **recordset_values)
-
+                records = []
+                for address in v6_addresses:
+                    record_values = {
+                        'data': address,
+                        'managed': True,
+                        'managed_plugin_name': self.get_plugin_name(),
+                        'managed_plugin_type': self.get_plugin_type(),
+                        'managed_resource_type': 'instance',
+                        'managed_resource_id': payload['instance_id']
+                    }
+
+                    LOG.debug('NovaFixedV6Handler Creating AAAA record in %s / %s with values %r' %
+                              (domain_id, hostname, record_values))
+                    records.append(Record(**record_values))
+
+                operations.append((
+                    'AAAA %s' % hostname,
+                    functools.partial(self._create_or_update_recordset,
+                                      context, records, **recordset_values)))
+
+            for address in v6_addresses:
                 # Create PTR
                 record_type = 'PTR'
 
                 # Calculate reverse address
-                v6address = ipaddress.ip_address(fixed_ip['address'])
+                v6address = ipaddress.ip_address(address)
                 reverse_address = v6address.reverse_pointer + '.'
 
                 recordset_values = {
@@ -155,85 +358,161 @@ class NovaFixedV6Handler(BaseAddressHandler):
                 LOG.debug('NovaFixedV6Handler Creating PTR record in %s / %s with values %r' %
                           (reverse_domain_id, reverse_address, record_values))
 
-                reverse_recordset = self._create_or_update_recordset(
-                    context,
-                    [Record(**record_values)],
-                    **recordset_values)
-
-                nvc.servers.set_meta_item(instance, 'dns', hostname[:-1])
+                operations.append((
+                    'PTR %s' % reverse_address,
+                    functools.partial(self._create_or_update_recordset,
+                                      context, [Record(**record_values)],
+                                      **recordset_values)))
+
+            # The metadata in the payload is whatever was set before this
+            # event, so it only tells us when the write can be skipped
+            metadata = payload.get('metadata') or {}
+            if v6_addresses and metadata.get('dns') == hostname[:-1]:
+                LOG.debug('dns metadata of %s is already set', instance_id)
+                metrics.skipped('nova', 'servers.set_meta_item')
+            elif v6_addresses:
+                operations.append((
+                    'nova metadata %s' % instance_id,
+                    lambda: self._set_dns_metadata(
+                        nova_lookup, instance_id, hostname[:-1])))
+
+            self.runner.run(operations)
 
-                try:
-                    ip_handler_address = fixed_ip['address']
-
-                    # Get netbox ip object, will create one if it's not found
-                    LOG.debug(
-                        'Fetching netbox IP entry for %s' %
-                        (ip_handler_address)
-                    )
-                    nb_ip = ip_handler.get_ip(ip_handler_address)
-
-                    LOG.debug(
-                        'Updating netbox with IP address assignment - IP: "%s" DNS: "%s" PROJECT: "%s"' %
-                        (ip_handler_address, ip_handler_dns, ip_handler_project)
-                    )
-                    ip_handler.assign_ip(
-                        nb_ip, ip_handler_dns, ip_handler_project)
+            try:
+                # NetBox entries are created for any addresses not found
+                LOG.debug(
+                    'Updating netbox with IP address assignment - IPS: "%s" DNS: "%s" PROJECT: "%s"' %
+                    (', '.join(v6_addresses), ip_handler_dns, ip_handler_project)
+                )
+                netbox.assign(
+                    v6_addresses, ip_handler_dns, ip_handler_project)
 
-                except Exception as e:
-                    LOG.warning(
-                        "v6 assignment in netbox failed: {0}".format(e))
+            except Exception as e:
+                LOG.warning(
+                    "v6 assignment in netbox failed: {0}".format(e))
 
         elif event_type == 'compute.instance.delete.start':
             # Nova Delete Event does not include fixed_ips. Hence why we had the instance ID in the records.
             LOG.debug(
                 'NovaFixedV6Handler delete A and AAAA record for - %s', payload['instance_id'])
 
-            self._delete(zone_id=domain_id,
-                         resource_id=payload['instance_id'],
-                         resource_type='instance')
-            self._delete(zone_id=reverse_domain_id,
-                         resource_id=payload['instance_id'],
-                         resource_type='instance')
-
-            # search for and delete floating IPs
-            elevated_context = DesignateContext.get_admin_context(
-                all_tenants=True, edit_managed_records=True)
-
-            criterion = {
-                'managed': True,
-                'managed_plugin_name': 'neutron_floating',
-                'managed_resource_type': 'instance',
-                'managed_extra': 'instance:%s' % (payload['instance_id']),
-            }
-            records = self.central_api.find_records(
-                elevated_context, criterion)
-            LOG.debug('Found %d floating ip records to delete for %s' %
-                      (len(records), payload['instance_id']))
-            for record in records:
-                zones = self.central_api.find_zones(elevated_context)
-                for zone in zones:
-                    try:
-                        recordset = self.central_api.get_recordset(
-                            elevated_context, zone['id'], record['recordset_id'])
-                        LOG.debug('Deleting record %s from %s / %s' %
-                                  (record['id'], zone['id'], record['recordset_id']))
-                        self.central_api.delete_recordset(
-                            elevated_context, zone['id'], record['recordset_id'])
-                    except:
-                        pass
+            instance_id = payload['instance_id']
+
+            def delete_records(zone_id):
+                self._delete(zone_id=zone_id,
+                             resource_id=instance_id,
+                             resource_type='instance')
+
+            def fetch_v6_addresses():
+                try:
+                    instance = nova_lookup.get(instance_id)
+                    addresses = getattr(instance, 'addresses')
+
+                    return [address['addr']
+                            for address in addresses['default']
+                            if address['version'] == 6]
+                except Exception as e:
+                    LOG.warning("v6 ip lookup failed: {0}".format(e))
+                    return []
+
+            def delete_indexed_records():
+                if not self._delete_indexed(instance_id, entry):
+                    delete_records(domain_id)
+                    delete_records(reverse_domain_id)
+
+            # The index knows the records and addresses of the instance,
+            # otherwise Designate is searched and Nova asked
+            entry = self._indexed(instance_id)
+            if entry is not None:
+                v6_addresses = sorted(entry.addresses)
+                operations = [('delete indexed records',
+                               delete_indexed_records)]
+            else:
+                operations = [
+                    ('nova instance %s' % instance_id, fetch_v6_addresses),
+                    ('delete forward records',
+                     lambda: delete_records(domain_id)),
+                    ('delete reverse records',
+                     lambda: delete_records(reverse_domain_id)),
+                ]
+            operations.append(('delete floating ip records',
+                               lambda: self._delete_floating_records(
+                                   instance_id)))
+
+            # None of these depend on each other
+            results = self.runner.run(operations)
+            if entry is None:
+                v6_addresses = results[0]
 
             try:
-                instance = nvc.servers.get(payload['instance_id'])
-                addresses = getattr(instance, 'addresses')
-
-                for address in addresses['default']:
-                    LOG.debug("%s" % (address))
-                    if address['version'] == 6:
-                        LOG.debug("Deleting v6 IP from netbox %s" %
-                                  (address['addr']))
-                        ip_handler_address = address['addr']
-                        nb_ip = ip_handler.get_ip(ip_handler_address)
-                        ip_handler.unassign_ip(nb_ip)
+                LOG.debug("Deleting v6 IPs from netbox %s" %
+                          (', '.join(v6_addresses)))
+                netbox.unassign(v6_addresses)
 
             except Exception as e:
                 LOG.warning("v6 ip unassignment failed: {0}".format(e))
+
+            # The instance is going away, stop handing out its name
+            lookup.instance_cache.invalidate(instance_id)
+            hostnames.resolver.forget(instance_id)
+
+    def _set_dns_metadata(self, nova_lookup, instance_id, dns):
+        # The metadata is only a hint for later events, so a failing Nova
+        # mustn't fail the event once the records are written
+        try:
+            nova = nova_lookup.nova
+            with breaker.get('nova'), \
+                    metrics.timed('nova', 'servers.set_meta_item'):
+                nova.servers.set_meta_item(instance_id, 'dns', dns)
+        except Exception as e:
+            LOG.warning("Couldn't set dns metadata of {0}: {1}".format(
+                instance_id, e))
+
+    def _delete_floating_records(self, instance_id):
+        """Delete the neutron_floating records tagged with an instance."""
+        elevated_context = DesignateContext.get_admin_context(
+            all_tenants=True, edit_managed_records=True)
+
+        criterion = {
+            'managed': True,
+            'managed_plugin_name': 'neutron_floating',
+            'managed_resource_type': 'instance',
+            'managed_extra': 'instance:%s' % (instance_id),
+        }
+        with metrics.timed('designate', 'find_records'):
+            records = self.central_api.find_records(
+                elevated_context, criterion)
+        recordsets.state.forget(instance_id)
+        rpc_calls = 1
+        LOG.debug('Found %d floating ip records to delete for %s' %
+                  (len(records), instance_id))
+
+        # Records carry their zone, so group them by zone and delete
+        # each recordset once rather than probing every zone.
+        zone_recordsets = {}
+        for record in records:
+            zone_recordsets.setdefault(record['zone_id'], set()).add(
+                record['recordset_id'])
+
+        for record_zone_id, recordset_ids in zone_recordsets.items():
+            for recordset_id in recordset_ids:
+                LOG.debug('Deleting recordset %s from %s' %
+                          (recordset_id, record_zone_id))
+                rpc_calls += 1
+                try:
+                    with metrics.timed('designate', 'delete_recordset'):
+                        self.central_api.delete_recordset(
+                            elevated_context, record_zone_id, recordset_id)
+                except exceptions.RecordSetNotFound:
+                    pass
+                except Exception as e:
+                    LOG.warning('Failed to delete recordset %s from %s: '
+                                '%s' % (recordset_id, record_zone_id, e))
+
+        LOG.debug('Floating ip cleanup for %s issued %d central calls '
+                  'for %d records' % (instance_id, rpc_calls, len(records)))
+
+        if self.index is not None:
+            for fip_id in set(record['managed_resource_id']
+                              for record in records):
+                self.index.discard('neutron_floating', fip_id)
@@ -0,0 +1,45 @@
+# Background warm-up of handler state after a restart
+
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+warmup_opts = [
+    cfg.BoolOpt('warm-up', default=False,
+                help='When the handler starts, fetch the Keystone token, '
+                     'configured zones and NetBox prefix in the background '
+                     'so the first events find them cached'),
+]
+
+
+def _run(name, steps):
+    start = time.monotonic()
+    for step, func in steps:
+        step_start = time.monotonic()
+        try:
+            func()
+        except Exception as e:
+            LOG.warning("{0}: warming up {1} failed: {2}".format(
+                name, step, e))
+            continue
+        LOG.info('%s: warmed up %s in %.3fs', name, step,
+                 time.monotonic() - step_start)
+    LOG.info('%s: warm-up finished in %.3fs', name,
+             time.monotonic() - start)
+
+
+def warm_up(name, steps):
+    """Run ``(step, callable)`` pairs one by one in a daemon thread.
+
+    A failed step is logged and the rest still run; the events that
+    need it will simply fetch it themselves.
+    """
+    thread = threading.Thread(target=_run, args=(name, steps),
+                              name='warm-up %s' % name)
+    thread.daemon = True
+    thread.start()
+    return thread
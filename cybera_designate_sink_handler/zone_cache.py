@@ -0,0 +1,142 @@
+# Zone metadata cache
+
+import re
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+zone_cache_opts = [
+    cfg.IntOpt('zone-cache-ttl', default=300,
+               help='Seconds to cache zone details and the reverse zone '
+                    'index'),
+]
+
+# First label of an RFC 2317 classless in-addr.arpa zone, such as the
+# "0/26" of 0/26.2.0.192.in-addr.arpa. or the "0-63" of
+# 0-63.2.0.192.in-addr.arpa.
+CLASSLESS_LABEL = re.compile(r'^(\d+)([/-])(\d+)$')
+
+# Designate notifications that make cached zone details stale
+ZONE_EVENT_TYPES = [
+    'dns.zone.create',
+    'dns.zone.update',
+    'dns.zone.delete',
+]
+
+
+class ZoneCache(object):
+    """Caches zones by id and indexes reverse zones by name.
+
+    ``get_zone`` loads a single zone by id and ``find_zones`` lists the
+    zones matching a criterion; both are usually bound to the handler and
+    central API. Entries expire after ``ttl`` seconds or when
+    ``invalidate`` is called from a ``dns.zone.*`` notification.
+    """
+
+    def __init__(self, get_zone, find_zones, ttl=300):
+        self._get_zone = get_zone
+        self._find_zones = find_zones
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._zones = {}
+        self._reverse = {}
+
+    def get_zone(self, zone_id):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._zones.get(zone_id)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+
+        zone = self._get_zone(zone_id)
+        with self._lock:
+            self._zones[zone_id] = (now + self.ttl, zone)
+        return zone
+
+    def _reverse_index(self, tenant_id):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._reverse.get(tenant_id)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+
+        index = {}
+        # Parent /24 zone name -> [(first, last, zone name, zone id)]
+        classless = {}
+        for zone in self._find_zones({'tenant_id': tenant_id}):
+            if not zone.name.endswith('.arpa.'):
+                continue
+            index[zone.name] = zone.id
+            label, parent = zone.name.split('.', 1)
+            match = CLASSLESS_LABEL.match(label)
+            if match is not None and parent.endswith('.in-addr.arpa.'):
+                first, sep, end = match.groups()
+                first = int(first)
+                if sep == '/':
+                    last = first + 2 ** (32 - int(end)) - 1
+                else:
+                    last = int(end)
+                classless.setdefault(parent, []).append(
+                    (first, last, zone.name, zone.id))
+        LOG.debug('Indexed %d reverse zones for tenant %s',
+                  len(index), tenant_id)
+
+        with self._lock:
+            self._reverse[tenant_id] = (now + self.ttl, (index, classless))
+        return index, classless
+
+    def find_reverse_zone(self, reverse_pointer, tenant_id):
+        """Return the closest reverse zone for a PTR name.
+
+        ``reverse_pointer`` is the fully qualified PTR record name. Returns
+        ``(zone_id, name)``, where ``name`` is the PTR record name to use
+        in that zone, or ``(None, reverse_pointer)`` if no zone owned by
+        ``tenant_id`` matches.
+
+        Zones are matched on the longest parent suffix, so /8, /16 and /24
+        in-addr.arpa zones and ip6.arpa zones on any nibble boundary are
+        found. An RFC 2317 classless zone such as 0/26.2.0.192.in-addr.arpa.
+        or 0-63.2.0.192.in-addr.arpa. is preferred for the addresses it
+        covers. The record is then named inside it, e.g.
+        1.0/26.2.0.192.in-addr.arpa. The /24 zone has to hold the CNAMEs
+        pointing there.
+        """
+        index, classless = self._reverse_index(tenant_id)
+        labels = reverse_pointer.rstrip('.').split('.')
+
+        ranges = classless.get('.'.join(labels[1:]) + '.')
+        if ranges and labels[0].isdigit():
+            host = int(labels[0])
+            for first, last, name, zone_id in ranges:
+                if first <= host <= last:
+                    return zone_id, '%s.%s' % (labels[0], name)
+
+        for i in range(1, len(labels)):
+            zone_id = index.get('.'.join(labels[i:]) + '.')
+            if zone_id is not None:
+                return zone_id, reverse_pointer
+        return None, reverse_pointer
+
+    def warm(self, zone_ids, tenant_id=None):
+        """Load zones, and a tenant's reverse index, ahead of events."""
+        for zone_id in zone_ids:
+            self.get_zone(zone_id)
+        if tenant_id is not None:
+            self._reverse_index(tenant_id)
+
+    def invalidate(self, zone_id=None):
+        """Drop a cached zone, or everything if no id is given.
+
+        The reverse index is always dropped since a created or deleted
+        zone can change which zone a pointer belongs to.
+        """
+        with self._lock:
+            if zone_id is None:
+                self._zones.clear()
+            else:
+                self._zones.pop(zone_id, None)
+            self._reverse.clear()